@@ -0,0 +1,118 @@
+import math
+import random
+
+from result_analysis import get_instability_bucket
+
+
+BUCKET_RANGES = dict()
+
+
+def get_bucket_ranges(num_attacks):
+    """Get the (bucket, lowest, highest) numbers of wrong attacks of each instability bucket of an instance."""
+    if num_attacks not in BUCKET_RANGES:
+        bucket_ranges = dict()
+        for num_wrong in range(num_attacks + 1):
+            bucket = get_instability_bucket(num_wrong, num_attacks)
+            low, _ = bucket_ranges.get(bucket, (num_wrong, num_wrong))
+            bucket_ranges[bucket] = (low, num_wrong)
+        BUCKET_RANGES[num_attacks] = [(bucket, low, high) for bucket, (low, high) in bucket_ranges.items()]
+    return BUCKET_RANGES[num_attacks]
+
+
+def log_comb(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+def hypergeometric_tail(num_observed, num_wrong, num_attacks, num_drawn, upper):
+    """Probability of observing at most (or at least if upper) num observed wrong attacks among num drawn ones,
+       when num wrong of num attacks are wrong.
+    """
+    min_observed = max(0, num_drawn - (num_attacks - num_wrong))
+    max_observed = min(num_drawn, num_wrong)
+    observed_range = range(max(num_observed, min_observed), max_observed + 1) if upper else range(min_observed, min(num_observed, max_observed) + 1)
+    log_total = log_comb(num_attacks, num_drawn)
+    return sum(math.exp(log_comb(num_wrong, x) + log_comb(num_attacks - num_wrong, num_drawn - x) - log_total)
+               for x in observed_range)
+
+
+def decide_instability_bucket(num_observed, num_drawn, num_attacks, alpha):
+    """Decide the instability bucket of an instance from the wrong attacks observed among the first num drawn of its attacks,
+       or return None. Numbers of wrong attacks outside a bucket are rejected when they are impossible or, if alpha is positive,
+       when the observation falls in a one-sided tail of probability below alpha / 2.
+    """
+    max_wrong = num_observed + num_attacks - num_drawn
+    for bucket, low, high in get_bucket_ranges(num_attacks):
+        if low > max_wrong or high < num_observed:
+            continue
+        below_rejected = low <= num_observed or (alpha > 0 and hypergeometric_tail(num_observed, low - 1, num_attacks, num_drawn, True) < alpha / 2)
+        above_rejected = high >= max_wrong or (alpha > 0 and hypergeometric_tail(num_observed, high + 1, num_attacks, num_drawn, False) < alpha / 2)
+        if below_rejected and above_rejected:
+            return bucket
+    return None
+
+
+class AdaptiveAttackScheduler:
+    """Attack instances in rounds and stop issuing the attacks of an instance once its instability bucket is decided.
+       The attacks of an instance are drawn in a seeded random order, a round doubles the attacks of the previous one,
+       a confidence of 1 only stops when the bucket can no longer change.
+    """
+
+    def __init__(self, inst_attacks_stream, confidence=0.95, round_size=16, seed=0):
+        self.inst_attacks_stream = iter(inst_attacks_stream)
+        self.alpha = 1 - confidence
+        self.round_size = round_size
+        self.seed = seed
+        self.states = dict()
+
+    def draw_round(self, inst_id, state):
+        """Draw the attacks of the next round of an instance."""
+        num_drawn = state["num_drawn"]
+        state["num_drawn"] = min(num_drawn + self.round_size * 2 ** state["num_rounds"], len(state["attacks"]))
+        state["num_rounds"] += 1
+        return inst_id, state["attacks"][num_drawn:state["num_drawn"]]
+
+    def next_batch(self, batch_size):
+        """Get the next round of every undecided instance, topped up with new instances to at least batch size attacks."""
+        attack_batch = [self.draw_round(inst_id, state) for inst_id, state in self.states.items()]
+        num_attacks = sum(len(inst_attacks) for _, inst_attacks in attack_batch)
+        while num_attacks < batch_size:
+            next_inst = next(self.inst_attacks_stream, None)
+            if next_inst is None:
+                break
+            inst_id, inst_attacks = next_inst
+            inst_attacks = list(inst_attacks)
+            random.Random(f"{self.seed}:{inst_id}").shuffle(inst_attacks)
+            self.states[inst_id] = {"attacks": inst_attacks, "num_drawn": 0, "num_rounds": 0,
+                                    "success_attack": list(), "failed_attack": list()}
+            attack_batch.append(self.draw_round(inst_id, self.states[inst_id]))
+            num_attacks += len(attack_batch[-1][1])
+        return attack_batch
+
+    def batches(self, batch_size):
+        """Yield the attack batches, the results of each batch are recorded before the next one is drawn."""
+        while True:
+            attack_batch = self.next_batch(batch_size)
+            if len(attack_batch) == 0:
+                return
+            yield attack_batch
+
+    def record_results(self, attack_results):
+        """Merge the results of a round and return the results of the instances decided by it,
+           which carry the number of attacks of the instance and its instability bucket.
+        """
+        decided_results = list()
+        for attack_result in attack_results:
+            inst_id = attack_result["instance_id"]
+            state = self.states[inst_id]
+            state["success_attack"].extend(attack_result["success_attack"])
+            state["failed_attack"].extend(attack_result["failed_attack"])
+            num_attacks = len(state["attacks"])
+            bucket = decide_instability_bucket(len(state["success_attack"]), state["num_drawn"], num_attacks, self.alpha)
+            if bucket is not None:
+                del self.states[inst_id]
+                decided_results.append({"instance_id": inst_id,
+                                        "success_attack": state["success_attack"],
+                                        "failed_attack": state["failed_attack"],
+                                        "num_attacks": num_attacks,
+                                        "instability_bucket": bucket})
+        return decided_results
@@ -0,0 +1,401 @@
+import os
+import json
+import mmap
+import time
+import shutil
+import array
+import bisect
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+    fcntl = None
+
+from file_io import read_json_file, read_txt_file, write_json_file, get_file_signature
+
+
+INDEX_ARRAYS = {
+    "string_offsets": "q",
+    "prototypes": "i",
+    "english": "b",
+    "related_offsets": "q",
+    "related_ids": "i",
+    "random_ids": "i",
+    "normalized_offsets": "q",
+    "normalized_ids": "i",
+    "synonym_offsets": "q",
+    "synonym_ids": "i",
+}
+
+INDEX_FORMAT = 3
+
+
+def is_inflected(concept):
+    """Check whether a lowercased concept may be an inflected form with a FormOf prototype."""
+    return concept.endswith(("s", "ed", "ing")) and not concept.endswith("ss")
+
+
+def map_file(file_path):
+    """Memory-map a file read-only, an empty file maps to empty bytes."""
+    if os.path.getsize(file_path) == 0:
+        return b""
+    with open(file_path, "rb") as fp:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def map_array(file_path, typecode):
+    """Memory-map an array file written by write_array as a typed memoryview."""
+    return memoryview(map_file(file_path)).cast(typecode)
+
+
+@contextlib.contextmanager
+def lock_index(index_dir):
+    """Hold an exclusive lock on an index across processes, so that it is checked, built and mapped by one at a time."""
+    os.makedirs(os.path.dirname(os.path.abspath(index_dir)), exist_ok=True)
+    with open(f"{index_dir}.lock", "a+b") as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        else:
+            fp.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            else:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_array(file_path, typecode, values):
+    """Write values as a native binary array file."""
+    with open(file_path, "wb") as fp:
+        array.array(typecode, values).tofile(fp)
+
+
+class ConceptNetIndex:
+    """Memory-mapped ConceptNet index.
+       Concept strings are interned into ids by their sorted order, FormOf maps an id to its prototype id and
+       RelatedTo and Synonym are stored as CSR adjacency arrays, so nothing is loaded into Python objects until it is looked up.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.strings = map_file(os.path.join(index_dir, "strings.bin"))
+        for name, typecode in INDEX_ARRAYS.items():
+            setattr(self, name, map_array(os.path.join(index_dir, f"{name}.bin"), typecode))
+        self.num_concepts = len(self.string_offsets) - 1
+
+    def get_string(self, concept_id):
+        """Get the concept string of an id."""
+        return self[concept_id].decode("utf-8")
+
+    def get_id(self, concept):
+        """Get the id of a concept string by binary search, None if it is not interned."""
+        key = concept.encode("utf-8")
+        concept_id = bisect.bisect_left(self, key)
+        if concept_id < self.num_concepts and self[concept_id] == key:
+            return concept_id
+        return None
+
+    def __len__(self):
+        return self.num_concepts
+
+    def __getitem__(self, concept_id):
+        return self.strings[self.string_offsets[concept_id]:self.string_offsets[concept_id + 1]]
+
+    def get_prototype_id(self, concept_id):
+        """Get the FormOf prototype id of an id, None if it has none."""
+        prototype_id = self.prototypes[concept_id]
+        return None if prototype_id < 0 else prototype_id
+
+    def is_english(self, concept_id):
+        """Check whether an id is a word of the English vocabulary."""
+        return self.english[concept_id] == 1
+
+    def get_related_ids(self, concept_id):
+        """Get the RelatedTo neighbour ids of an id."""
+        return self.related_ids[self.related_offsets[concept_id]:self.related_offsets[concept_id + 1]]
+
+    def get_normalized_related_ids(self, concept_id):
+        """Get the neighbour ids of an id after prototype collapsing, English filtering and deduplication."""
+        return self.normalized_ids[self.normalized_offsets[concept_id]:self.normalized_offsets[concept_id + 1]]
+
+    def get_normalized_degree(self, concept_id):
+        """Get the number of normalized neighbours of an id."""
+        return self.normalized_offsets[concept_id + 1] - self.normalized_offsets[concept_id]
+
+    def get_synonym_ids(self, concept_id):
+        """Get the deduplicated Synonym neighbour ids of an id."""
+        return self.synonym_ids[self.synonym_offsets[concept_id]:self.synonym_offsets[concept_id + 1]]
+
+
+def is_index_built(index_dir):
+    """Check whether a directory holds an index in the current format."""
+    manifest_file_path = os.path.join(index_dir, "manifest.json")
+    return os.path.exists(manifest_file_path) and read_json_file(manifest_file_path).get("format") == INDEX_FORMAT
+
+
+def get_index_options(index_dir):
+    """Get the build options recorded in the manifest of an index, an empty dict if there is no index."""
+    manifest_file_path = os.path.join(index_dir, "manifest.json")
+    if not os.path.exists(manifest_file_path):
+        return dict()
+    return read_json_file(manifest_file_path).get("options", dict())
+
+
+def is_index_current(index_dir, sources, options):
+    """Check whether the index in a directory was built from the same sources and options."""
+    if not is_index_built(index_dir):
+        return False
+    manifest = read_json_file(os.path.join(index_dir, "manifest.json"))
+    signatures = {name: get_file_signature(file_path) for name, file_path in sources.items()}
+    return manifest.get("sources") == signatures and manifest.get("options") == options
+
+
+def build_adjacency(num_concepts, new_ids, edges, deduplicate=False):
+    """Counting sort (source, target) edge id arrays by source into CSR arrays of renumbered ids, keeping the neighbours
+       in edge order, and only the first edge to each neighbour if deduplicate.
+    """
+    offsets = array.array("q", [0]) * (num_concepts + 1)
+    for source_id in edges[0]:
+        offsets[new_ids[source_id] + 1] += 1
+    for concept_id in range(num_concepts):
+        offsets[concept_id + 1] += offsets[concept_id]
+    neighbour_ids = array.array("i", [0]) * len(edges[0])
+    positions = array.array("q", offsets[:-1])
+    for source_id, target_id in zip(*edges):
+        source_id = new_ids[source_id]
+        neighbour_ids[positions[source_id]] = new_ids[target_id]
+        positions[source_id] += 1
+    if not deduplicate:
+        return offsets, neighbour_ids
+
+    unique_offsets = array.array("q", [0])
+    unique_ids = array.array("i")
+    for concept_id in range(num_concepts):
+        seen_ids = {concept_id}
+        for neighbour_id in neighbour_ids[offsets[concept_id]:offsets[concept_id + 1]]:
+            if neighbour_id not in seen_ids:
+                seen_ids.add(neighbour_id)
+                unique_ids.append(neighbour_id)
+        unique_offsets.append(len(unique_ids))
+    return unique_offsets, unique_ids
+
+
+def write_conceptnet_index(index_dir, concept_ids, prototype_edges, related_edges, synonym_edges, english_ids, random_ids, manifest):
+    """Write the index from interned concepts and edge id arrays, renumbering the ids by the sorted concept strings."""
+    strings = sorted(concept.encode("utf-8") for concept in concept_ids)
+    new_ids = [0] * len(strings)
+    for new_id, string in enumerate(strings):
+        new_ids[concept_ids[string.decode("utf-8")]] = new_id
+
+    string_offsets = [0]
+    for string in strings:
+        string_offsets.append(string_offsets[-1] + len(string))
+
+    # The first FormOf edge of a form wins.
+    prototypes = array.array("i", [-1]) * len(strings)
+    for form_id, prototype_id in zip(*prototype_edges):
+        if prototypes[new_ids[form_id]] < 0:
+            prototypes[new_ids[form_id]] = new_ids[prototype_id]
+
+    english = array.array("b", [0]) * len(strings)
+    for english_id in english_ids:
+        english[new_ids[english_id]] = 1
+
+    related_offsets, related_ids = build_adjacency(len(strings), new_ids, related_edges)
+    normalized_offsets, normalized_ids = normalize_related_ids(strings, prototypes, english, related_offsets, related_ids)
+    synonym_offsets, synonym_ids = build_adjacency(len(strings), new_ids, synonym_edges, deduplicate=True)
+
+    arrays = {
+        "string_offsets": string_offsets,
+        "prototypes": prototypes,
+        "english": english,
+        "related_offsets": related_offsets,
+        "related_ids": related_ids,
+        "random_ids": [new_ids[random_id] for random_id in random_ids],
+        "normalized_offsets": normalized_offsets,
+        "normalized_ids": normalized_ids,
+        "synonym_offsets": synonym_offsets,
+        "synonym_ids": synonym_ids,
+    }
+
+    # Write into a private directory and move it into place, concurrent workers never map a partial index.
+    temp_index_dir = f"{index_dir}.tmp{os.getpid()}"
+    old_index_dir = f"{index_dir}.old{os.getpid()}"
+    try:
+        write_index_files(temp_index_dir, strings, arrays, manifest)
+        # The live index is renamed aside rather than removed, a process that mapped it keeps reading its files.
+        if os.path.exists(index_dir):
+            os.rename(index_dir, old_index_dir)
+        os.rename(temp_index_dir, index_dir)
+    finally:
+        shutil.rmtree(temp_index_dir, ignore_errors=True)
+    shutil.rmtree(old_index_dir, ignore_errors=True)
+
+
+def write_index_files(temp_index_dir, strings, arrays, manifest):
+    """Write the strings, arrays and manifest of an index into a directory."""
+    os.makedirs(temp_index_dir, exist_ok=True)
+    with open(os.path.join(temp_index_dir, "strings.bin"), "wb") as fp:
+        fp.write(b"".join(strings))
+    for name, typecode in INDEX_ARRAYS.items():
+        write_array(os.path.join(temp_index_dir, f"{name}.bin"), typecode, arrays[name])
+    manifest.update({"format": INDEX_FORMAT, "num_concepts": len(strings), "num_related": len(arrays["related_ids"]),
+                     "num_normalized": len(arrays["normalized_ids"]), "num_synonyms": len(arrays["synonym_ids"])})
+    write_json_file(os.path.join(temp_index_dir, "manifest.json"), manifest)
+
+
+def normalize_related_ids(strings, prototypes, english, related_offsets, related_ids):
+    """Precompute what get_related_concepts returns for every concept as CSR arrays: the prototypes of its
+       neighbours that are English words other than itself, deduplicated in edge order.
+    """
+    string_ids = {string: concept_id for concept_id, string in enumerate(strings)}
+    normalized_concepts = dict()
+
+    def normalize_concept(concept_id):
+        # Mirror get_prototype, a lowercased form that is not interned cannot be an English word.
+        if concept_id not in normalized_concepts:
+            lower_string = strings[concept_id].decode("utf-8").lower().encode("utf-8")
+            lower_id = string_ids.get(lower_string, -1)
+            if lower_id >= 0 and prototypes[lower_id] >= 0 and is_inflected(lower_string.decode("utf-8")):
+                lower_id = prototypes[lower_id]
+            normalized_concepts[concept_id] = lower_id
+        return normalized_concepts[concept_id]
+
+    normalized_offsets = array.array("q", [0])
+    normalized_ids = array.array("i")
+    for concept_id in range(len(strings)):
+        seen_ids = {concept_id}
+        for related_id in related_ids[related_offsets[concept_id]:related_offsets[concept_id + 1]]:
+            normalized_id = normalize_concept(related_id)
+            if normalized_id >= 0 and english[normalized_id] == 1 and normalized_id not in seen_ids:
+                seen_ids.add(normalized_id)
+                normalized_ids.append(normalized_id)
+        normalized_offsets.append(len(normalized_ids))
+    return normalized_offsets, normalized_ids
+
+
+def intern_concept(concept_ids, concept):
+    """Get the id of a concept, assigning the next id to a new concept."""
+    concept_id = concept_ids.get(concept)
+    if concept_id is None:
+        concept_id = concept_ids[concept] = len(concept_ids)
+    return concept_id
+
+
+def intern_word_lists(concept_ids, vocabulary_file_path, concepts_file_path):
+    """Intern the English vocabulary and the random concept list, return their ids."""
+    english_ids = set(intern_concept(concept_ids, line.strip().lower()) for line in read_txt_file(vocabulary_file_path))
+    random_ids = list(intern_concept(concept_ids, line.strip().lower()) for line in read_txt_file(concepts_file_path))
+    return english_ids, random_ids
+
+
+def parse_concept_uri(concept_uri):
+    """Parse an English ConceptNet concept uri like /c/en/ice_cream/n into a concept, None for other languages."""
+    parts = concept_uri.split("/")
+    if len(parts) < 4 or parts[1] != "c" or parts[2] != "en":
+        return None
+    return parts[3].replace("_", " ").lower()
+
+
+def read_conceptnet_edges(file_path, relations, min_weight=0.0):
+    """Stream the (relation, start, end) English edges of a ConceptNet assertion file with the given relations
+       and at least the given weight, one line at a time. A Git LFS pointer in place of the file is rejected.
+    """
+    relation_uris = {f"/r/{relation}": relation for relation in relations}
+    with open(file_path, "r", encoding="utf-8") as fp:
+        for line_idx, line in enumerate(fp):
+            if line_idx == 0 and line.startswith("version https://git-lfs"):
+                raise ValueError(f"Please fetch {file_path} with git lfs pull, it is a Git LFS pointer.")
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 4 or fields[1] not in relation_uris:
+                continue
+            start, end = parse_concept_uri(fields[2]), parse_concept_uri(fields[3])
+            if start is None or end is None:
+                continue
+            if min_weight > 0.0:
+                weight = json.loads(fields[4]).get("weight", 1.0) if len(fields) > 4 else 1.0
+                if weight < min_weight:
+                    continue
+            yield relation_uris[fields[1]], start, end
+
+
+def build_conceptnet_index(index_dir, edges_file_path="conceptnet/conceptnet_english.txt", vocabulary_file_path="vocabulary/full_network.txt",
+                           concepts_file_path="conceptnet/concepts.txt", related_relations=("RelatedTo",), min_weight=0.0, force=False):
+    """Build the index in one pass over the ConceptNet edge file, skipped when the sources and options are unchanged.
+       FormOf edges map a form to its prototype, edges of the related relations and Synonym edges are added in both directions.
+       Only interned concepts and packed id arrays are held in memory, never the edge lines or per-concept lists.
+       A file that yields no FormOf or no related edges is rejected rather than indexed empty.
+    """
+    sources = {"edges": edges_file_path, "vocabulary": vocabulary_file_path, "concepts": concepts_file_path}
+    options = {"related_relations": list(related_relations), "min_weight": min_weight}
+    if not force and is_index_current(index_dir, sources, options):
+        return False
+
+    concept_ids = dict()
+    english_ids, random_ids = intern_word_lists(concept_ids, vocabulary_file_path, concepts_file_path)
+    prototype_edges = (array.array("i"), array.array("i"))
+    related_edges = (array.array("i"), array.array("i"))
+    synonym_edges = (array.array("i"), array.array("i"))
+    for relation, start, end in read_conceptnet_edges(edges_file_path, ("FormOf", "Synonym") + tuple(related_relations), min_weight):
+        start_id, end_id = intern_concept(concept_ids, start), intern_concept(concept_ids, end)
+        if relation == "FormOf":
+            prototype_edges[0].append(start_id)
+            prototype_edges[1].append(end_id)
+        elif start_id != end_id:
+            if relation == "Synonym":
+                synonym_edges[0].extend((start_id, end_id))
+                synonym_edges[1].extend((end_id, start_id))
+            if relation in related_relations:
+                related_edges[0].extend((start_id, end_id))
+                related_edges[1].extend((end_id, start_id))
+    if len(prototype_edges[0]) == 0 or len(related_edges[0]) == 0:
+        raise ValueError(f"Please check {edges_file_path}, no FormOf or {'/'.join(related_relations)} edges were parsed from it.")
+
+    manifest = {"sources": {name: get_file_signature(file_path) for name, file_path in sources.items()}, "options": options}
+    write_conceptnet_index(index_dir, concept_ids, prototype_edges, related_edges, synonym_edges, english_ids, random_ids, manifest)
+    return True
+
+
+def build_conceptnet_index_from_json(index_dir, form_of_file_path="conceptnet/form_of.json", related_to_file_path="conceptnet/related_to.json",
+                                     vocabulary_file_path="vocabulary/full_network.txt", concepts_file_path="conceptnet/concepts.txt",
+                                     synonym_file_path=None):
+    """Build the index from existing FormOf, RelatedTo and optionally Synonym json tables instead of the ConceptNet edge file."""
+    concept_ids = dict()
+    english_ids, random_ids = intern_word_lists(concept_ids, vocabulary_file_path, concepts_file_path)
+    prototype_edges = (array.array("i"), array.array("i"))
+    for form, prototype in read_json_file(form_of_file_path).items():
+        prototype_edges[0].append(intern_concept(concept_ids, form))
+        prototype_edges[1].append(intern_concept(concept_ids, prototype))
+    related_edges = (array.array("i"), array.array("i"))
+    for concept, related_concepts in read_json_file(related_to_file_path).items():
+        concept_id = intern_concept(concept_ids, concept)
+        for related_concept in related_concepts:
+            related_edges[0].append(concept_id)
+            related_edges[1].append(intern_concept(concept_ids, related_concept))
+    synonym_edges = (array.array("i"), array.array("i"))
+    if synonym_file_path is not None:
+        for concept, synonyms in read_json_file(synonym_file_path).items():
+            concept_id = intern_concept(concept_ids, concept)
+            for synonym in synonyms:
+                synonym_edges[0].append(concept_id)
+                synonym_edges[1].append(intern_concept(concept_ids, synonym))
+
+    sources = {"form_of": form_of_file_path, "related_to": related_to_file_path, "vocabulary": vocabulary_file_path, "concepts": concepts_file_path}
+    if synonym_file_path is not None:
+        sources["synonym"] = synonym_file_path
+    manifest = {"sources": {name: get_file_signature(file_path) for name, file_path in sources.items()}, "options": {"json": True}}
+    write_conceptnet_index(index_dir, concept_ids, prototype_edges, related_edges, synonym_edges, english_ids, random_ids, manifest)
+
+
+if __name__ == "__main__":
+    build_conceptnet_index("conceptnet/index")
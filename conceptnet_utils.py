@@ -1,45 +1,134 @@
 import random
 
-from file_io import read_json_file, read_txt_file
+from conceptnet_index import ConceptNetIndex, build_conceptnet_index, get_index_options, is_inflected, lock_index
 
 
-PROTOTYPE_MAP = read_json_file("conceptnet/form_of.json")
-RELATED_MAP = read_json_file("conceptnet/related_to.json")
+CONCEPTNET_INDEX_DIR = "conceptnet/index"
+CONCEPTNET_INDEX = None
 
-ENGLISH_WORDS = set(line.strip().lower() for line in read_txt_file("vocabulary/full_network.txt"))
-ALL_CONCEPTS = list(line.strip().lower() for line in read_txt_file("conceptnet/concepts.txt"))
+
+def get_conceptnet_index():
+    """Load the memory-mapped ConceptNet index on first use, building it from the edge file if it does not exist
+       or rebuilding it with its recorded options if its sources changed. Indexes built from json tables are kept.
+       Processes take turns under a lock, so the index is built by the first one and mapped by the others.
+    """
+    global CONCEPTNET_INDEX
+    if CONCEPTNET_INDEX is None:
+        with lock_index(CONCEPTNET_INDEX_DIR):
+            index_options = get_index_options(CONCEPTNET_INDEX_DIR)
+            if not index_options.get("json"):
+                build_conceptnet_index(CONCEPTNET_INDEX_DIR, **index_options)
+            CONCEPTNET_INDEX = ConceptNetIndex(CONCEPTNET_INDEX_DIR)
+    return CONCEPTNET_INDEX
 
 
 def get_prototype(query_concept):
     """Remove tense and plurality for query concept using ConceptNet."""
     query_concept = query_concept.lower()
 
-    if query_concept.endswith(("s", "ed", "ing")) and not query_concept.endswith("ss"):
-        if query_concept in PROTOTYPE_MAP:
-            return PROTOTYPE_MAP[query_concept]
+    if is_inflected(query_concept):
+        conceptnet_index = get_conceptnet_index()
+        query_id = conceptnet_index.get_id(query_concept)
+        if query_id is not None:
+            prototype_id = conceptnet_index.get_prototype_id(query_id)
+            if prototype_id is not None:
+                return conceptnet_index.get_string(prototype_id)
 
     return query_concept
 
 
 def get_related_concepts(query_concept):
-    """Get related concepts for query concept using ConceptNet."""
-    related_concepts = list()
+    """Get related concepts for query concept using ConceptNet.
+       Neighbours are normalized when the index is built, so this only reads the precomputed list.
+    """
+    conceptnet_index = get_conceptnet_index()
+    query_id = conceptnet_index.get_id(get_prototype(query_concept))
+    if query_id is None:
+        return list()
+    return [conceptnet_index.get_string(related_id) for related_id in conceptnet_index.get_normalized_related_ids(query_id)]
+
+
+def get_related_concepts_batch(query_concepts):
+    """Get related concepts for a list of query concepts, each distinct query concept is looked up once."""
+    related_concepts = dict()
+    for query_concept in query_concepts:
+        if query_concept not in related_concepts:
+            related_concepts[query_concept] = get_related_concepts(query_concept)
+    return [list(related_concepts[query_concept]) for query_concept in query_concepts]
+
+
+def get_synonym_concepts(query_concept):
+    """Get the synonyms of query concept from the Synonym edges of ConceptNet, or those of its prototype if it has none."""
+    conceptnet_index = get_conceptnet_index()
+    query_concept = query_concept.lower()
+    synonym_ids = list()
+    for concept in (query_concept, get_prototype(query_concept)):
+        query_id = conceptnet_index.get_id(concept)
+        if query_id is not None:
+            synonym_ids = conceptnet_index.get_synonym_ids(query_id)
+            if len(synonym_ids) > 0:
+                break
+    return [conceptnet_index.get_string(synonym_id) for synonym_id in synonym_ids]
+
+
+def get_synonym_concepts_batch(query_concepts):
+    """Get synonyms for a list of query concepts, each distinct query concept is looked up once."""
+    synonym_concepts = dict()
+    for query_concept in query_concepts:
+        if query_concept not in synonym_concepts:
+            synonym_concepts[query_concept] = get_synonym_concepts(query_concept)
+    return [list(synonym_concepts[query_concept]) for query_concept in query_concepts]
+
+
+def sample_by_degree(conceptnet_index, concept_ids, num_samples, rng):
+    """Sample concept ids without replacement, a concept with degree d is weighted 1 / (1 + d) so hubs are rarely kept.
+       The sampled ids keep their order.
+    """
+    if len(concept_ids) <= num_samples:
+        return list(concept_ids)
+    # Weighted sampling by the largest keys u ** (1 / weight).
+    sample_keys = {concept_id: rng.random() ** (1 + conceptnet_index.get_normalized_degree(concept_id)) for concept_id in concept_ids}
+    sampled_ids = set(sorted(concept_ids, key=lambda concept_id: sample_keys[concept_id], reverse=True)[:num_samples])
+    return [concept_id for concept_id in concept_ids if concept_id in sampled_ids]
+
+
+def expand_related_concepts(query_concept, max_hops=2, max_frontier=50, max_concepts=200, seed=0):
+    """Get the concepts within max hops of query concept using ConceptNet, by a breadth-first search over the related concepts.
+       At most max frontier concepts of a hop are expanded to the next hop and at most max concepts are returned,
+       both sampled by degree with a seed fixed per query concept. Concepts come in hop order, the first hop in the
+       order of get_related_concepts.
+    """
+    conceptnet_index = get_conceptnet_index()
+    query_id = conceptnet_index.get_id(get_prototype(query_concept))
+    if query_id is None:
+        return list()
 
-    query_concept = get_prototype(query_concept)
-    if query_concept in RELATED_MAP:
-        all_related_concepts = RELATED_MAP[query_concept]
-        for related_concept in all_related_concepts:
-            related_concept = get_prototype(related_concept)
-            if related_concept in ENGLISH_WORDS:
-                if related_concept != query_concept:
-                    if related_concept not in related_concepts:
-                        related_concepts.append(related_concept)
+    rng = random.Random(f"{seed}:{query_concept}")
+    visited_ids = {query_id}
+    expanded_ids = list()
+    frontier_ids = [query_id]
+    for _ in range(max_hops):
+        hop_ids = list()
+        for concept_id in frontier_ids:
+            for related_id in conceptnet_index.get_normalized_related_ids(concept_id):
+                if related_id not in visited_ids:
+                    visited_ids.add(related_id)
+                    hop_ids.append(related_id)
+        if max_concepts is not None:
+            hop_ids = sample_by_degree(conceptnet_index, hop_ids, max_concepts - len(expanded_ids), rng)
+        expanded_ids.extend(hop_ids)
+        if max_frontier is not None:
+            hop_ids = sample_by_degree(conceptnet_index, hop_ids, max_frontier, rng)
+        if len(hop_ids) == 0 or (max_concepts is not None and len(expanded_ids) >= max_concepts):
+            break
+        frontier_ids = hop_ids
 
-    return related_concepts
+    return [conceptnet_index.get_string(expanded_id) for expanded_id in expanded_ids]
 
 
 def get_random_concept():
     """Get a random concept from ConceptNet."""
-    random_concept = random.choice(ALL_CONCEPTS)
-    random_concept = get_prototype(random_concept)
+    conceptnet_index = get_conceptnet_index()
+    random_id = random.choice(conceptnet_index.random_ids)
+    random_concept = get_prototype(conceptnet_index.get_string(random_id))
     return random_concept
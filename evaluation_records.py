@@ -0,0 +1,99 @@
+class EvaluationRecord:
+    """Naive evaluation record of a task.
+       The id lists keep their order for the json layout, sets index them so membership tests take constant time.
+    """
+
+    def __init__(self, rec_eval=None):
+        if rec_eval is None:
+            rec_eval = {"evaluate_ids": list(), "evaluate_instances": dict(),
+                        "right_predict_ids": list(), "right_predict_history": dict(),
+                        "wrong_predict_ids": list(), "wrong_predict_history": dict()}
+        self.evaluate_ids = rec_eval["evaluate_ids"]
+        self.instances = rec_eval["evaluate_instances"]
+        self.right_predict_ids = rec_eval["right_predict_ids"]
+        self.right_predict_history = rec_eval["right_predict_history"]
+        self.wrong_predict_ids = rec_eval["wrong_predict_ids"]
+        self.wrong_predict_history = rec_eval["wrong_predict_history"]
+        self.right_ids = set(self.right_predict_ids)
+
+    def add_instance(self, inst_id, inst):
+        """Add an instance to be evaluated."""
+        self.evaluate_ids.append(inst_id)
+        self.instances[inst_id] = inst
+
+    def record_prediction(self, inst_id, eval_history, is_right):
+        """Record the naive prediction of an instance as right or wrong."""
+        if is_right:
+            self.right_predict_ids.append(inst_id)
+            self.right_predict_history[inst_id] = eval_history
+            self.right_ids.add(inst_id)
+        else:
+            self.wrong_predict_ids.append(inst_id)
+            self.wrong_predict_history[inst_id] = eval_history
+
+    def is_right(self, inst_id):
+        """Check whether an instance is predicted right without attack."""
+        return inst_id in self.right_ids
+
+    def to_json(self):
+        """Convert the record to its json layout."""
+        return {"evaluate_ids": self.evaluate_ids,
+                "evaluate_instances": self.instances,
+                "right_predict_ids": self.right_predict_ids,
+                "right_predict_history": self.right_predict_history,
+                "wrong_predict_ids": self.wrong_predict_ids,
+                "wrong_predict_history": self.wrong_predict_history}
+
+
+class AttackRecord:
+    """Attack record of a task with one causes file.
+       The id lists keep their order for the json layout, a set indexes every attacked instance.
+       Adaptive attacks also count the issued and skipped attack calls.
+    """
+
+    def __init__(self, rec_attack=None):
+        if rec_attack is None:
+            rec_attack = {"success_attack_ids": list(), "success_attack_history": dict(),
+                          "failed_attack_ids": list(), "failed_attack_history": dict()}
+        self.success_attack_ids = rec_attack["success_attack_ids"]
+        self.success_attack_history = rec_attack["success_attack_history"]
+        self.failed_attack_ids = rec_attack["failed_attack_ids"]
+        self.failed_attack_history = rec_attack["failed_attack_history"]
+        self.attacked_ids = set(self.success_attack_ids) | set(self.failed_attack_ids)
+        self.attack_calls = rec_attack.get("attack_calls")
+
+    def is_attacked(self, inst_id):
+        """Check whether the result of an instance is recorded."""
+        return inst_id in self.attacked_ids
+
+    def record_result(self, attack_result):
+        """Record the result of an instance, it is attacked successfully if any of its attacks changes the prediction.
+           Results of adaptive attacks carry the number of attacks of the instance and the decided instability bucket.
+        """
+        inst_id = attack_result["instance_id"]
+        if "num_attacks" in attack_result:
+            if self.attack_calls is None:
+                self.attack_calls = {"issued": 0, "skipped": 0}
+            num_issued = len(attack_result["success_attack"]) + len(attack_result["failed_attack"])
+            self.attack_calls["issued"] += num_issued
+            self.attack_calls["skipped"] += attack_result["num_attacks"] - num_issued
+        if len(attack_result["success_attack"]) > 0:
+            self.success_attack_ids.append(inst_id)
+            self.success_attack_history[inst_id] = {"success_attack": attack_result["success_attack"],
+                                                    "failed_attack": attack_result["failed_attack"]}
+            if "instability_bucket" in attack_result:
+                self.success_attack_history[inst_id]["instability_bucket"] = attack_result["instability_bucket"]
+        else:
+            self.failed_attack_ids.append(inst_id)
+            self.failed_attack_history[inst_id] = attack_result["failed_attack"]
+        self.attacked_ids.add(inst_id)
+
+    def to_json(self):
+        """Convert the record to its json layout."""
+        rec_attack = {"success_attack_ids": self.success_attack_ids,
+                      "success_attack_history": self.success_attack_history,
+                      "failed_attack_ids": self.failed_attack_ids,
+                      "failed_attack_history": self.failed_attack_history}
+        if self.attack_calls is not None:
+            rec_attack["attack_calls"] = self.attack_calls
+        return rec_attack
@@ -1,3 +1,4 @@
+import os
 import csv
 import json
 import xlrd
@@ -83,3 +84,48 @@ def write_json_file(file_path, dicts):
     """Write a list of dicts to a json file."""
     with open(file_path, 'w', encoding='utf-8', newline='') as fp:
         json.dump(dicts, fp, indent=2, ensure_ascii=False)
+
+
+def replace_json_file(file_path, dicts):
+    """Write a list of dicts to a json file atomically, readers never see a partially written file."""
+    temp_file_path = file_path + ".tmp"
+    with open(temp_file_path, 'w', encoding='utf-8', newline='') as fp:
+        json.dump(dicts, fp, indent=2, ensure_ascii=False)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temp_file_path, file_path)
+
+
+def get_file_signature(file_path):
+    """Get the size and modification time of a file, used to tell whether a file derived from it is stale."""
+    file_stat = os.stat(file_path)
+    return {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+
+def append_jsonl_file(file_path, dicts):
+    """Append a list of dicts to a jsonl file in one write and flush it to disk."""
+    with open(file_path, 'a', encoding='utf-8', newline='') as fp:
+        fp.write("".join(json.dumps(d, ensure_ascii=False) + '\n' for d in dicts))
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def recover_jsonl_file(file_path):
+    """Read an append-only jsonl file then return its dicts in a list, a partially written last line is cut off."""
+    dicts = list()
+    if not os.path.exists(file_path):
+        return dicts
+    valid_size = 0
+    with open(file_path, 'rb') as fp:
+        for line in fp:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                dicts.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                break
+            valid_size += len(line)
+    if valid_size < os.path.getsize(file_path):
+        with open(file_path, 'r+b') as fp:
+            fp.truncate(valid_size)
+    return dicts
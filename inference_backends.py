@@ -0,0 +1,465 @@
+import math
+import torch
+import random
+import asyncio
+import hashlib
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from query_interface import encode_prompt
+from token_budget import order_by_length
+from llms_causal_discovery import get_prompt_tokenizer, compute_span_log_probabilities, render_prompt, render_prompt_spans, get_model_id, get_model_path_id
+
+
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def get_options_key(options):
+    """Get the hashable key of generation options."""
+    return options["max_tokens"], tuple(options.get("stop") or ()), tuple(options.get("choices") or ())
+
+
+def cut_at_stop(text, stop):
+    """Cut a generated text before the first of its stop strings."""
+    for stop_text in stop or ():
+        if stop_text in text:
+            text = text[:text.index(stop_text)]
+    return text
+
+
+class InferenceBackend:
+    """Engine behind evaluation and discovery, it generates answers, scores candidate labels and scores concept spans.
+       Generation options are dicts of max tokens, stop strings and, to constrain decoding, the label choices.
+       Label scores are natural log-likelihoods of the answer lines, span scores are log10 probabilities of the
+       query concepts of build_*_prompt queries as compute_span_log_probabilities returns them.
+    """
+
+    backend_name = None
+    name_or_path = None
+    tokenizer = None
+
+    @property
+    def model_id(self):
+        """Identify the backend and model that compute the scores, the probability store keys them by it."""
+        return f"{self.backend_name}:{get_model_path_id(self.name_or_path)}"
+
+    def generate(self, prompts, options):
+        """Generate the greedy answer text of each prompt with its generation options."""
+        raise NotImplementedError
+
+    def score_labels(self, prompt_labels):
+        """Score the labels of each (prompt, labels) by the log-likelihood of their answer lines after the prompt,
+           return the (best label, {label: log-likelihood}) of each prompt.
+        """
+        raise NotImplementedError
+
+    def span_log_probabilities(self, queries, batch_size=32, share_prefix=True):
+        """Compute the log10 probabilities of the query concepts of each query, engines that can reuse the KV cache
+           of prefixes shared by several queries only do so if share prefix is set.
+        """
+        raise NotImplementedError
+
+
+class VllmBackend(InferenceBackend):
+    """Backend of an in-process vLLM engine, prompts are passed as token ids in buckets of similar length."""
+
+    backend_name = "vllm"
+
+    def __init__(self, model_path, model=None, max_model_len=None, max_num_batched_tokens=None, gpu_memory_utilization=0.9):
+        import vllm
+        from vllm import SamplingParams
+        try:
+            from vllm.sampling_params import GuidedDecodingParams
+        except ImportError:
+            GuidedDecodingParams = None
+        self.sampling_params_type = SamplingParams
+        self.guided_decoding_type = GuidedDecodingParams
+
+        self.name_or_path = model_path
+        if model is None:
+            model = vllm.LLM(model=model_path, gpu_memory_utilization=gpu_memory_utilization, max_model_len=max_model_len,
+                             max_num_batched_tokens=max_num_batched_tokens, enable_prefix_caching=True)
+        self.model = model
+        self.tokenizer = model.get_tokenizer()
+        self.sampling_params = dict()
+
+    @property
+    def model_id(self):
+        model_config = getattr(getattr(self.model, "llm_engine", None), "model_config", None)
+        dtype = str(getattr(model_config, "dtype", "")).replace("torch.", "")
+        return f"{self.backend_name}:{get_model_path_id(self.name_or_path)}:{dtype}"
+
+    def get_sampling_params(self, options):
+        """Get the sampling params of generation options, created once per distinct options."""
+        options_key = get_options_key(options)
+        if options_key not in self.sampling_params:
+            if options.get("choices"):
+                if self.guided_decoding_type is None:
+                    raise ValueError("Guided choice decoding is not supported by the installed vllm.")
+                self.sampling_params[options_key] = self.sampling_params_type(
+                    temperature=0, max_tokens=options["max_tokens"], guided_decoding=self.guided_decoding_type(choice=options["choices"]))
+            else:
+                self.sampling_params[options_key] = self.sampling_params_type(temperature=0, max_tokens=options["max_tokens"],
+                                                                              stop=options.get("stop"))
+        return self.sampling_params[options_key]
+
+    def generate(self, prompts, options):
+        prompts_ids = [encode_prompt(self.tokenizer, prompt) for prompt in prompts]
+        prompts_order = order_by_length([len(prompt_ids) for prompt_ids in prompts_ids])
+        outputs = self.model.generate([{"prompt_token_ids": prompts_ids[pos]} for pos in prompts_order],
+                                      [self.get_sampling_params(options[pos]) for pos in prompts_order])
+        assert len(outputs) == len(prompts)
+        texts = [None] * len(prompts)
+        for pos, output in zip(prompts_order, outputs):
+            texts[pos] = output.outputs[0].text
+        return texts
+
+    def prompt_log_probabilities(self, prompts_ids):
+        """Get the natural log probability of every prompt token after the first, None for the first token."""
+        scoring_params = self.sampling_params_type(temperature=0, max_tokens=1, prompt_logprobs=0)
+        outputs = self.model.generate([{"prompt_token_ids": prompt_ids} for prompt_ids in prompts_ids], scoring_params)
+        prompts_log_probabilities = list()
+        for output in outputs:
+            prompt_ids = output.prompt_token_ids
+            prompts_log_probabilities.append([None] + [output.prompt_logprobs[pos][prompt_ids[pos]].logprob
+                                                       for pos in range(1, len(prompt_ids))])
+        return prompts_log_probabilities
+
+    def score_labels(self, prompt_labels):
+        label_prompts = list()
+        label_starts = list()
+        for prompt, labels in prompt_labels:
+            prompt_ids = encode_prompt(self.tokenizer, prompt)
+            for label in labels:
+                label_ids = encode_prompt(self.tokenizer, prompt + f" {label}\n")
+                label_start = 0
+                while label_start < min(len(prompt_ids), len(label_ids)) and prompt_ids[label_start] == label_ids[label_start]:
+                    label_start += 1
+                label_prompts.append(label_ids)
+                label_starts.append(max(label_start, 1))
+
+        labels_log_probabilities = iter(self.prompt_log_probabilities(label_prompts))
+        label_starts = iter(label_starts)
+        scored_answers = list()
+        for _, labels in prompt_labels:
+            label_scores = dict()
+            for label in labels:
+                label_scores[label] = sum(next(labels_log_probabilities)[next(label_starts):])
+            scored_answers.append((max(labels, key=lambda label: label_scores[label]), label_scores))
+        return scored_answers
+
+    def span_log_probabilities(self, queries, batch_size=32, share_prefix=True):
+        prompt_tokenizer = get_prompt_tokenizer(self.tokenizer)
+        encoded_queries = [prompt_tokenizer.encode(query) for query in queries]
+        prompts_log_probabilities = self.prompt_log_probabilities([prompt_ids for prompt_ids, _ in encoded_queries])
+        span_log_probabilities = list()
+        for (_, query_spans), log_probabilities in zip(encoded_queries, prompts_log_probabilities):
+            log_probability = sum(sum(log_probabilities[query_start: query_start + len(query_ids)])
+                                  for query_start, query_ids in query_spans)
+            span_log_probabilities.append(log_probability / math.log(10))
+        return span_log_probabilities
+
+
+class HfBackend(InferenceBackend):
+    """Backend of a transformers causal LM on CPU or GPU, CUDA devices fall back to CPU if unavailable.
+       Choices are answered by the label of highest log-likelihood. Span scores share the KV cache of common query
+       prefixes unless share prefix is unset here or by the caller.
+    """
+
+    backend_name = "hf"
+
+    def __init__(self, model_path, model=None, tokenizer=None, batch_size=8, share_prefix=True, device="cuda:0"):
+        if device.startswith("cuda") and not torch.cuda.is_available():
+            device = "cpu"
+        self.device = device
+        self.batch_size = batch_size
+        self.share_prefix = share_prefix
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path) if tokenizer is None else tokenizer
+        self.model = AutoModelForCausalLM.from_pretrained(model_path, device_map=device) if model is None else model
+        self.name_or_path = getattr(self.model, "name_or_path", None) or model_path
+        self.pad_id = self.tokenizer.pad_token_id
+        if self.pad_id is None:
+            self.pad_id = self.tokenizer.eos_token_id if self.tokenizer.eos_token_id is not None else 0
+
+    @property
+    def model_id(self):
+        # Spans are scored as for the bare transformers model, so both share their stored probabilities.
+        return get_model_id(self.model)
+
+    def generate(self, prompts, options):
+        texts = [None] * len(prompts)
+        choice_idxs = [idx for idx in range(len(prompts)) if options[idx].get("choices")]
+        scored_answers = self.score_labels([(prompts[idx], options[idx]["choices"]) for idx in choice_idxs])
+        for idx, (label, _) in zip(choice_idxs, scored_answers):
+            texts[idx] = label
+
+        option_groups = dict()
+        for idx in range(len(prompts)):
+            if not options[idx].get("choices"):
+                option_groups.setdefault(get_options_key(options[idx]), list()).append(idx)
+        for idxs in option_groups.values():
+            prompts_ids = [encode_prompt(self.tokenizer, prompts[idx]) for idx in idxs]
+            prompts_order = order_by_length([len(prompt_ids) for prompt_ids in prompts_ids])
+            for batch_start in range(0, len(prompts_order), self.batch_size):
+                batch_order = prompts_order[batch_start: batch_start + self.batch_size]
+                batch_texts = self.generate_batch([prompts_ids[pos] for pos in batch_order], options[idxs[0]]["max_tokens"])
+                for pos, text in zip(batch_order, batch_texts):
+                    texts[idxs[pos]] = cut_at_stop(text, options[idxs[pos]].get("stop"))
+        return texts
+
+    def generate_batch(self, prompts_ids, max_tokens):
+        """Greedily generate from a batch of prompt ids, left padded so that generation continues every prompt."""
+        max_length = max(len(prompt_ids) for prompt_ids in prompts_ids)
+        input_ids = torch.full((len(prompts_ids), max_length), self.pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts_ids), max_length), dtype=torch.long)
+        for num_row, prompt_ids in enumerate(prompts_ids):
+            input_ids[num_row, max_length - len(prompt_ids):] = torch.tensor(prompt_ids, dtype=torch.long)
+            attention_mask[num_row, max_length - len(prompt_ids):] = 1
+        with torch.no_grad():
+            output_ids = self.model.generate(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device),
+                                             max_new_tokens=max_tokens, do_sample=False, pad_token_id=self.pad_id)
+        return self.tokenizer.batch_decode(output_ids[:, max_length:], skip_special_tokens=True)
+
+    def score_labels(self, prompt_labels):
+        label_prompts = list()
+        for prompt, labels in prompt_labels:
+            prompt_ids = encode_prompt(self.tokenizer, prompt)
+            for label in labels:
+                label_ids = encode_prompt(self.tokenizer, prompt + f" {label}\n")
+                label_start = 0
+                while label_start < min(len(prompt_ids), len(label_ids)) and prompt_ids[label_start] == label_ids[label_start]:
+                    label_start += 1
+                label_prompts.append((label_ids, max(label_start, 1)))
+
+        label_log_likelihoods = [None] * len(label_prompts)
+        prompts_order = order_by_length([len(label_ids) for label_ids, _ in label_prompts])
+        for batch_start in range(0, len(prompts_order), self.batch_size):
+            batch_order = prompts_order[batch_start: batch_start + self.batch_size]
+            batch_log_likelihoods = self.compute_batch_log_likelihoods([label_prompts[pos] for pos in batch_order])
+            for pos, log_likelihood in zip(batch_order, batch_log_likelihoods):
+                label_log_likelihoods[pos] = log_likelihood
+
+        label_log_likelihoods = iter(label_log_likelihoods)
+        scored_answers = list()
+        for _, labels in prompt_labels:
+            label_scores = {label: next(label_log_likelihoods) for label in labels}
+            scored_answers.append((max(labels, key=lambda label: label_scores[label]), label_scores))
+        return scored_answers
+
+    def compute_batch_log_likelihoods(self, batch):
+        """Compute the natural log-likelihood of the tokens from the start of each (ids, start) with one forward pass."""
+        max_length = max(len(prompt_ids) for prompt_ids, _ in batch)
+        input_ids = torch.full((len(batch), max_length), self.pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_length), dtype=torch.long)
+        for num_row, (prompt_ids, _) in enumerate(batch):
+            input_ids[num_row, :len(prompt_ids)] = torch.tensor(prompt_ids, dtype=torch.long)
+            attention_mask[num_row, :len(prompt_ids)] = 1
+        log_likelihoods = list()
+        with torch.no_grad():
+            logits = self.model(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device)).logits
+            for num_row, (prompt_ids, start) in enumerate(batch):
+                # Each token is scored by the logits at the position before it.
+                log_probabilities = logits[num_row, start - 1: len(prompt_ids) - 1].float().log_softmax(dim=-1)
+                ids = torch.tensor(prompt_ids[start:], dtype=torch.long, device=log_probabilities.device)
+                log_likelihoods.append(log_probabilities.gather(1, ids.unsqueeze(1)).sum().item())
+        return log_likelihoods
+
+    def span_log_probabilities(self, queries, batch_size=32, share_prefix=True):
+        return compute_span_log_probabilities(self.tokenizer, self.model, queries, batch_size,
+                                              share_prefix=share_prefix and self.share_prefix, device=self.device)
+
+
+class OpenAIBackend(InferenceBackend):
+    """Backend of an OpenAI-compatible completions server such as a local vLLM or TGI server.
+       Label and span scores are read from the log probabilities of the echoed prompt tokens, choices are passed
+       as the guided choice of the vLLM server.
+       Requests of batch size prompts are sent by an asyncio client with up to concurrency requests in flight over
+       pooled connections, failed requests are retried with exponential backoff and results keep the prompt order.
+    """
+
+    backend_name = "openai"
+
+    def __init__(self, model_path, base_url="http://localhost:8000/v1", model_name=None, api_key=None, batch_size=32, timeout=600,
+                 concurrency=8, max_retries=5, retry_backoff=0.5):
+        self.name_or_path = model_path
+        self.base_url = base_url.rstrip("/")
+        self.model_name = model_name if model_name is not None else model_path
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key is not None:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    @property
+    def model_id(self):
+        return f"{self.backend_name}:{self.base_url}:{self.model_name}"
+
+    def post_completions(self, payload):
+        """Post a completions request once, return its response or None if the connection failed or timed out."""
+        try:
+            return self.session.post(f"{self.base_url}/completions", json=dict(payload, model=self.model_name), timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            return None
+
+    def get_retry_delay(self, attempt, response):
+        """Get the delay before a retry, the Retry-After seconds of the response or an exponential backoff with jitter."""
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        if retry_after.isdigit():
+            return float(retry_after)
+        return self.retry_backoff * 2 ** attempt * (0.5 + random.random() / 2)
+
+    async def complete(self, payload, executor):
+        """Complete a request on the pooled threads of the executor and return its choices in the order of the prompts.
+           Connection errors, timeouts and retryable status codes are retried up to max retries times.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            response = await loop.run_in_executor(executor, self.post_completions, payload)
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                break
+            if attempt == self.max_retries:
+                if response is None:
+                    raise requests.ConnectionError(f"Failed to reach {self.base_url} after {attempt + 1} attempts.")
+                break
+            await asyncio.sleep(self.get_retry_delay(attempt, response))
+        response.raise_for_status()
+        return sorted(response.json()["choices"], key=lambda choice: choice["index"])
+
+    async def complete_concurrently(self, payloads):
+        """Complete the requests with at most concurrency of them in flight, gathered in the order of the payloads."""
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return await asyncio.gather(*[self.complete(payload, executor) for payload in payloads])
+
+    def complete_in_batches(self, prompts, payload):
+        """Complete prompts in concurrent requests of batch size prompts each. Called inside a running event loop,
+           e.g. of a notebook or an async server, the requests are completed by a worker thread with its own loop.
+        """
+        payloads = [dict(payload, prompt=prompts[batch_start: batch_start + self.batch_size])
+                    for batch_start in range(0, len(prompts), self.batch_size)]
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            batches_choices = asyncio.run(self.complete_concurrently(payloads))
+        else:
+            with ThreadPoolExecutor(1) as executor:
+                batches_choices = executor.submit(asyncio.run, self.complete_concurrently(payloads)).result()
+        choices = list()
+        for batch_choices in batches_choices:
+            choices.extend(batch_choices)
+        return choices
+
+    def generate(self, prompts, options):
+        texts = [None] * len(prompts)
+        option_groups = dict()
+        for idx in range(len(prompts)):
+            option_groups.setdefault(get_options_key(options[idx]), list()).append(idx)
+        for idxs in option_groups.values():
+            group_options = options[idxs[0]]
+            payload = {"max_tokens": group_options["max_tokens"], "temperature": 0}
+            if group_options.get("choices"):
+                payload["guided_choice"] = group_options["choices"]
+            elif group_options.get("stop"):
+                payload["stop"] = group_options["stop"]
+            for idx, choice in zip(idxs, self.complete_in_batches([prompts[idx] for idx in idxs], payload)):
+                texts[idx] = choice["text"]
+        return texts
+
+    def echo_log_probabilities(self, texts):
+        """Get the (text offset, natural log probability) of every echoed token of each text, the first is None."""
+        choices = self.complete_in_batches(texts, {"max_tokens": 1, "temperature": 0, "echo": True, "logprobs": 0})
+        texts_log_probabilities = list()
+        for text, choice in zip(texts, choices):
+            logprobs = choice["logprobs"]
+            texts_log_probabilities.append([(offset, log_probability)
+                                            for offset, log_probability in zip(logprobs["text_offset"], logprobs["token_logprobs"])
+                                            if offset < len(text)])
+        return texts_log_probabilities
+
+    def score_labels(self, prompt_labels):
+        label_texts = [prompt + f" {label}\n" for prompt, labels in prompt_labels for label in labels]
+        labels_log_probabilities = iter(self.echo_log_probabilities(label_texts))
+        scored_answers = list()
+        for prompt, labels in prompt_labels:
+            label_scores = dict()
+            for label in labels:
+                label_scores[label] = sum(log_probability for offset, log_probability in next(labels_log_probabilities)
+                                          if offset >= len(prompt) and log_probability is not None)
+            scored_answers.append((max(labels, key=lambda label: label_scores[label]), label_scores))
+        return scored_answers
+
+    def span_log_probabilities(self, queries, batch_size=32, share_prefix=True):
+        rendered_queries = [render_prompt_spans(query) for query in queries]
+        prompts_log_probabilities = self.echo_log_probabilities([prompt for prompt, _ in rendered_queries])
+        span_log_probabilities = list()
+        for (prompt, query_spans), log_probabilities in zip(rendered_queries, prompts_log_probabilities):
+            token_ends = [offset for offset, _ in log_probabilities[1:]] + [len(prompt)]
+            log_probability = 0.0
+            for span_start, span_end in query_spans:
+                # The space before a concept is scored together with it, as encode_query_concept does.
+                log_probability += sum(token_log_probability for (offset, token_log_probability), token_end in zip(log_probabilities, token_ends)
+                                       if offset < span_end and token_end > span_start - 1 and token_log_probability is not None)
+            span_log_probabilities.append(log_probability / math.log(10))
+        return span_log_probabilities
+
+
+def get_mock_score(text):
+    """Get a deterministic score of a text in [0, 1)."""
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16) / 2 ** 32
+
+
+class MockBackend(InferenceBackend):
+    """Deterministic stand-in without a model for tests and benchmarks of the rest of the pipeline on CPU.
+       Answers are drawn by a hash of the prompt from its choices or from the last candidate line of the prompt,
+       scores are hashes of the prompt and label or query.
+    """
+
+    backend_name = "mock"
+
+    def __init__(self, model_path="mock"):
+        self.name_or_path = "mock"
+
+    def generate(self, prompts, options):
+        texts = list()
+        for prompt, prompt_options in zip(prompts, options):
+            choices = prompt_options.get("choices")
+            if not choices:
+                candidate_lines = [line for line in prompt.split("\n") if line.startswith("Candidate")]
+                choices = candidate_lines[-1].split(": ", 1)[-1].split(", ") if len(candidate_lines) > 0 else [""]
+            texts.append(f" {choices[int(get_mock_score(prompt) * len(choices))]}\n")
+        return texts
+
+    def score_labels(self, prompt_labels):
+        scored_answers = list()
+        for prompt, labels in prompt_labels:
+            label_scores = {label: -10 * get_mock_score(prompt + f" {label}\n") for label in labels}
+            scored_answers.append((max(labels, key=lambda label: label_scores[label]), label_scores))
+        return scored_answers
+
+    def span_log_probabilities(self, queries, batch_size=32, share_prefix=True):
+        span_log_probabilities = list()
+        for query in queries:
+            prompt, query_concepts = render_prompt(query)
+            span_log_probabilities.append(-len(query_concepts) * (1 + 4 * get_mock_score(prompt)))
+        return span_log_probabilities
+
+
+INFERENCE_BACKENDS = {
+    "vllm": VllmBackend,
+    "hf": HfBackend,
+    "openai": OpenAIBackend,
+    "mock": MockBackend,
+}
+
+
+def load_inference_backend(backend_name, model_path, **backend_options):
+    """Load an inference backend by its name."""
+    if backend_name not in INFERENCE_BACKENDS:
+        raise ValueError("Please select backend from vllm, hf, openai or mock.")
+    return INFERENCE_BACKENDS[backend_name](model_path, **backend_options)
@@ -1,9 +1,26 @@
+import os
+import copy
 import math
 import tqdm
 import torch
+import string
+import weakref
 import itertools
+from collections import OrderedDict, deque
 
-from conceptnet_utils import get_related_concepts
+from conceptnet_utils import get_related_concepts, expand_related_concepts
+
+
+# Each template is paired with the slots of its query concepts, whose log probabilities are summed.
+PROMPT_TEMPLATES = {
+    "probability": ("The most likely appear is {0}", (0,)),
+    "conditional": ("When {1} appears, the next most likely to appear is {0}", (0,)),
+    "conditional2": ("When {1} appears, the next most likely to appear is {2}, the next most likely to appear is {0}", (0,)),
+    "joint": ("The most likely to appear simultaneously with {0} is {1}", (0, 1)),
+    "joint3": ("The most likely to appear simultaneously with {0} are {1} and {2}", (0, 1, 2)),
+}
+
+PROMPT_TOKENIZERS = weakref.WeakKeyDictionary()
 
 
 def locate_start_index(seq_list, sub_seq_list):
@@ -13,178 +30,467 @@ def locate_start_index(seq_list, sub_seq_list):
             return index
 
 
-def compute_probability(tokenizer, model, query_concept, device="cuda:0"):
-    """Compute the probability of query concept generated by LLMs."""
-    prompt = f"The most likely appear is {query_concept}"
-
-    pos_assist = f"placeholder {query_concept}"
-    pos_start = len(tokenizer.encode("placeholder test")) - 1
-    query_ids = tokenizer.encode(pos_assist)[pos_start:]
-
-    prompt_ids = tokenizer.encode(prompt)
-    query_start = locate_start_index(prompt_ids, query_ids)
-
-    with torch.no_grad():
-        inputs = tokenizer(prompt, return_tensors="pt").to(device)
-        outputs = model(**inputs)
-        scores = outputs.logits[0]
-        query_scores = scores[query_start-1: query_start-1 + len(query_ids)]
-        query_probability_distributions = query_scores.softmax(dim=-1)
+class ProbabilityCache:
+    """A LRU cache of span log10 probabilities keyed by model id, prompt template and concepts.
+       If a persistent store is given, missed keys are looked up in it and new results are appended to it.
+    """
 
-        assert len(query_ids) == len(query_probability_distributions)
+    def __init__(self, max_size=1000000, store=None):
+        self.max_size = max_size
+        self.store = store
+        self.records = OrderedDict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        """Get the cached log probability of a key, None means the key is missed."""
+        if key in self.records:
+            self.hits += 1
+            self.records.move_to_end(key)
+            return self.records[key]
+
+        if self.store is not None:
+            log_probability = self.store.get(key)
+            if log_probability is not None:
+                self.store_hits += 1
+                self._remember(key, log_probability)
+                return log_probability
+
+        self.misses += 1
+        return None
+
+    def put_many(self, records):
+        """Cache the log probabilities of (key, log probability) records and append them to the store."""
+        for key, log_probability in records:
+            self._remember(key, log_probability)
+        if self.store is not None:
+            self.store.put_many(records)
+
+    def _remember(self, key, log_probability):
+        self.records[key] = log_probability
+        self.records.move_to_end(key)
+        while len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+
+    def stats(self):
+        """Report the hit and miss counts of the cache."""
+        return {"hits": self.hits, "store_hits": self.store_hits, "misses": self.misses, "size": len(self.records)}
+
+
+def get_model_path_id(name_or_path):
+    """Identify a model path, local paths by their resolved absolute path and hub names as they are."""
+    if os.path.exists(name_or_path):
+        return os.path.realpath(name_or_path)
+    return name_or_path
+
+
+def get_model_id(model):
+    """Get the identifier of a model used to key its cached probabilities. Inference backends identify themselves,
+       a transformers model is identified by its path and dtype, which change the computed probabilities.
+    """
+    model_id = getattr(model, "model_id", None)
+    if model_id:
+        return model_id
+    name_or_path = getattr(model, "name_or_path", None)
+    if not name_or_path:
+        return model.__class__.__name__
+    dtype = str(getattr(model, "dtype", "")).replace("torch.", "")
+    return f"hf:{get_model_path_id(name_or_path)}:{dtype}"
 
-        query_probability = float(1.0)
-        for num_id, query_id in enumerate(query_ids):
-            query_probability *= query_probability_distributions[num_id][query_id].item()
 
-        return query_probability
+def build_probability_prompt(query_concept):
+    """Build the query for the probability of query concept."""
+    return "probability", (query_concept,)
 
 
-def compute_conditional_probability(tokenizer, model, query_concept, given_concept1, given_concept2=None, device="cuda:0"):
-    """Compute the probability of LLMs generating query concept based on given concept(s)."""
+def build_conditional_prompt(query_concept, given_concept1, given_concept2=None):
+    """Build the query for the probability of query concept based on given concept(s)."""
     if given_concept2 is None:
-        prompt_type = 0
-    else:
-        prompt_type = 1
+        return "conditional", (query_concept, given_concept1)
+    return "conditional2", (query_concept, given_concept1, given_concept2)
 
-    prompts = {0: f"When {given_concept1} appears, the next most likely to appear is {query_concept}",
-               1: (f"When {given_concept1} appears, the next most likely to appear is {given_concept2},"
-                   f" the next most likely to appear is {query_concept}")}
-    prompt = prompts[prompt_type]
 
+def build_joint_prompt(query_concept1, query_concept2, query_concept3=None):
+    """Build the query for the joint probability of several query concepts."""
+    if query_concept3 is None:
+        return "joint", (query_concept1, query_concept2)
+    return "joint3", (query_concept1, query_concept2, query_concept3)
+
+
+def render_prompt(query):
+    """Render a query into its prompt and the query concepts whose log probabilities are summed."""
+    template_name, concepts = query
+    template, query_slots = PROMPT_TEMPLATES[template_name]
+    prompt = template.format(*concepts)
+    query_concepts = [concepts[query_slot] for query_slot in query_slots]
+    return prompt, query_concepts
+
+
+def render_prompt_spans(query):
+    """Render a query into its prompt and the (start, end) character spans of its query concepts."""
+    template_name, concepts = query
+    template, query_slots = PROMPT_TEMPLATES[template_name]
+    prompt = ""
+    slot_spans = dict()
+    for literal_text, field_name, _, _ in string.Formatter().parse(template):
+        prompt += literal_text
+        if field_name is not None:
+            slot = int(field_name)
+            slot_spans.setdefault(slot, list()).append((len(prompt), len(prompt) + len(concepts[slot])))
+            prompt += concepts[slot]
+    return prompt, [span for query_slot in query_slots for span in slot_spans[query_slot]]
+
+
+def encode_query_concept(tokenizer, query_concept):
+    """Encode query concept as it appears after a space in the middle of a prompt."""
     pos_assist = f"placeholder {query_concept}"
     pos_start = len(tokenizer.encode("placeholder test")) - 1
     query_ids = tokenizer.encode(pos_assist)[pos_start:]
+    return query_ids
 
+
+def encode_query(tokenizer, query):
+    """Encode a query into its prompt ids and the (start, ids) spans of its query concepts by a full tokenization."""
+    prompt, query_concepts = render_prompt(query)
     prompt_ids = tokenizer.encode(prompt)
-    query_start = locate_start_index(prompt_ids, query_ids)
+    query_spans = list()
+    for query_concept in query_concepts:
+        query_ids = encode_query_concept(tokenizer, query_concept)
+        query_start = locate_start_index(prompt_ids, query_ids)
+        assert query_start is not None
+        query_spans.append((query_start, query_ids))
+    return prompt_ids, query_spans
+
+
+class PromptTokenizer:
+    """Tokenize queries by concatenating the cached token ids of template segments and concepts,
+       so the spans of query concepts are known without tokenizing and scanning the whole prompt.
+       Each concept is checked once per template slot against a full tokenization, queries whose concepts merge
+       with the neighbouring template text fall back to encode_query.
+    """
 
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.placeholder_ids = tokenizer.encode("placeholder")
+        self.concepts_ids = dict()
+        self.templates_ids = dict()
+        self.stable_slots = dict()
+
+    def encode_concept(self, concept):
+        """Encode a concept once and cache its ids."""
+        if concept not in self.concepts_ids:
+            self.concepts_ids[concept] = encode_query_concept(self.tokenizer, concept)
+        return self.concepts_ids[concept]
+
+    def encode_template(self, template_name):
+        """Encode the text segments around the slots of a template once, None if a segment cannot be split off."""
+        if template_name not in self.templates_ids:
+            template, _ = PROMPT_TEMPLATES[template_name]
+            segments_ids = list()
+            slots = list()
+            for literal_text, field_name, _, _ in string.Formatter().parse(template):
+                if field_name is not None:
+                    # The space before a slot is encoded together with the concept, as encode_query_concept does.
+                    assert literal_text.endswith(" ")
+                    literal_text = literal_text[:-1]
+                    slots.append(int(field_name))
+                if len(segments_ids) == 0:
+                    segments_ids.append(self.tokenizer.encode(literal_text))
+                else:
+                    segments_ids.append(self.encode_continuation(literal_text))
+            if len(segments_ids) == len(slots):
+                segments_ids.append(list())
+            if any(segment_ids is None for segment_ids in segments_ids):
+                self.templates_ids[template_name] = None
+            else:
+                self.templates_ids[template_name] = (segments_ids, slots)
+        return self.templates_ids[template_name]
+
+    def encode_continuation(self, text):
+        """Encode text that continues a prompt, None if it merges with the text before it."""
+        if len(text) == 0:
+            return list()
+        continuation_ids = self.tokenizer.encode("placeholder" + text)
+        if continuation_ids[:len(self.placeholder_ids)] != self.placeholder_ids:
+            return None
+        return continuation_ids[len(self.placeholder_ids):]
+
+    def concatenate(self, template_name, concepts):
+        """Concatenate the ids of a template and its concepts, return the prompt ids and the start of each slot."""
+        segments_ids, slots = self.templates_ids[template_name]
+        prompt_ids = list(segments_ids[0])
+        slot_starts = dict()
+        for num_slot, slot in enumerate(slots):
+            slot_starts[slot] = len(prompt_ids)
+            prompt_ids.extend(self.encode_concept(concepts[slot]))
+            prompt_ids.extend(segments_ids[num_slot + 1])
+        return prompt_ids, slot_starts
+
+    def is_stable_slot(self, template_name, slot, concept):
+        """Check once whether a concept keeps its own tokens when placed in a slot of a template."""
+        key = (template_name, slot, concept)
+        if key not in self.stable_slots:
+            _, slots = self.templates_ids[template_name]
+            probe_concepts = ["test"] * len(slots)
+            probe_concepts[slot] = concept
+            prompt_ids, _ = self.concatenate(template_name, probe_concepts)
+            prompt, _ = render_prompt((template_name, tuple(probe_concepts)))
+            self.stable_slots[key] = prompt_ids == self.tokenizer.encode(prompt)
+        return self.stable_slots[key]
+
+    def encode(self, query):
+        """Encode a query into its prompt ids and the (start, ids) spans of its query concepts."""
+        template_name, concepts = query
+        if self.encode_template(template_name) is None:
+            return encode_query(self.tokenizer, query)
+        for slot, concept in enumerate(concepts):
+            if not self.is_stable_slot(template_name, slot, concept):
+                return encode_query(self.tokenizer, query)
+
+        prompt_ids, slot_starts = self.concatenate(template_name, concepts)
+        query_spans = list()
+        for query_slot in PROMPT_TEMPLATES[template_name][1]:
+            query_spans.append((slot_starts[query_slot], self.encode_concept(concepts[query_slot])))
+        return prompt_ids, query_spans
+
+
+def get_prompt_tokenizer(tokenizer):
+    """Get the prompt tokenizer of a tokenizer, its caches live as long as the tokenizer."""
+    if tokenizer not in PROMPT_TOKENIZERS:
+        PROMPT_TOKENIZERS[tokenizer] = PromptTokenizer(tokenizer)
+    return PROMPT_TOKENIZERS[tokenizer]
+
+
+def compute_span_log_probabilities(tokenizer, model, queries, batch_size=32, cache=None, share_prefix=True,
+                                   device="cuda:0"):
+    """Compute the log10 probabilities of many queries with batched forward passes.
+       Each query is built by a build_*_prompt function, the log probabilities of all its query concepts are summed.
+       If a cache is given, only the queries missed by the cache are computed.
+       If share_prefix is set, the prefix shared by several queries is encoded once and reused through its KV cache.
+    """
+    log_probabilities = [None] * len(queries)
+    if cache is not None:
+        model_id = get_model_id(model)
+        query_keys = [(model_id, PROMPT_TEMPLATES[template_name][0], concepts) for template_name, concepts in queries]
+        # Each distinct key is looked up once, so repeated queries count as one hit or miss.
+        key_queries = dict()
+        for num_query, query_key in enumerate(query_keys):
+            key_queries.setdefault(query_key, list()).append(num_query)
+        missed_queries = dict()
+        for query_key, nums_query in key_queries.items():
+            log_probability = cache.get(query_key)
+            if log_probability is None:
+                missed_queries[query_key] = nums_query
+            for num_query in nums_query:
+                log_probabilities[num_query] = log_probability
+        if len(missed_queries) == 0:
+            return log_probabilities
+
+        missed_log_probabilities = compute_span_log_probabilities(tokenizer, model,
+                                                                  [queries[nums[0]] for nums in missed_queries.values()],
+                                                                  batch_size, share_prefix=share_prefix, device=device)
+        cache.put_many(list(zip(missed_queries.keys(), missed_log_probabilities)))
+        for nums_query, log_probability in zip(missed_queries.values(), missed_log_probabilities):
+            for num_query in nums_query:
+                log_probabilities[num_query] = log_probability
+        return log_probabilities
+
+    # Inference backends score spans with their own engines.
+    if hasattr(model, "span_log_probabilities"):
+        return model.span_log_probabilities(queries, batch_size, share_prefix=share_prefix)
+
+    prompt_tokenizer = get_prompt_tokenizer(tokenizer)
+    encoded_queries = [prompt_tokenizer.encode(query) for query in queries]
+
+    pad_id = tokenizer.pad_token_id
+    if pad_id is None:
+        pad_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
+
+    # Queries sharing the tokens before their first scored position, e.g. all conditional prompts given the same
+    # concept, are grouped so that this prefix is encoded once and its past key values are reused by every suffix.
+    prefix_groups = dict()
+    unshared_queries = list()
+    for num_query, (prompt_ids, query_spans) in enumerate(encoded_queries):
+        prefix_length = min(query_start for query_start, _ in query_spans) - 1
+        if share_prefix and prefix_length > 0:
+            prefix_groups.setdefault(tuple(prompt_ids[:prefix_length]), list()).append(num_query)
+        else:
+            unshared_queries.append(num_query)
+
+    for prefix_ids, nums_query in prefix_groups.items():
+        if len(nums_query) < 2:
+            unshared_queries.extend(nums_query)
+            continue
+
+        prefix_past_key_values = encode_prefix(model, prefix_ids, device=device)
+        for batch_start in range(0, len(nums_query), batch_size):
+            nums_batch = nums_query[batch_start: batch_start + batch_size]
+            batch = [encoded_queries[num_query] for num_query in nums_batch]
+            batch_log_probabilities = compute_batch_log_probabilities(model, batch, pad_id, len(prefix_ids),
+                                                                      prefix_past_key_values, device=device)
+            for num_query, log_probability in zip(nums_batch, batch_log_probabilities):
+                log_probabilities[num_query] = log_probability
+
+    unshared_queries.sort()
+    for batch_start in range(0, len(unshared_queries), batch_size):
+        nums_batch = unshared_queries[batch_start: batch_start + batch_size]
+        batch = [encoded_queries[num_query] for num_query in nums_batch]
+        batch_log_probabilities = compute_batch_log_probabilities(model, batch, pad_id, device=device)
+        for num_query, log_probability in zip(nums_batch, batch_log_probabilities):
+            log_probabilities[num_query] = log_probability
+
+    return log_probabilities
+
+
+def encode_prefix(model, prefix_ids, device="cuda:0"):
+    """Encode a prompt prefix once and return its past key values."""
     with torch.no_grad():
-        inputs = tokenizer(prompt, return_tensors="pt").to(device)
-        outputs = model(**inputs)
-        scores = outputs.logits[0]
-        query_scores = scores[query_start-1: query_start-1 + len(query_ids)]
-        query_probability_distributions = query_scores.softmax(dim=-1)
+        input_ids = torch.tensor([list(prefix_ids)], dtype=torch.long, device=device)
+        outputs = model(input_ids=input_ids, use_cache=True)
+    return outputs.past_key_values
 
-        assert len(query_ids) == len(query_probability_distributions)
 
-        query_probability = float(1.0)
-        for num_id, query_id in enumerate(query_ids):
-            query_probability *= query_probability_distributions[num_id][query_id].item()
+def expand_past_key_values(past_key_values, batch_size):
+    """Repeat the past key values of a single prefix for every row of a batch."""
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        # Cache objects are extended in place by the forward pass, so each batch gets its own copy.
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+    return tuple(tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer) for layer in past_key_values)
 
-        return query_probability
 
+def compute_batch_log_probabilities(model, batch, pad_id, prefix_length=0, prefix_past_key_values=None, device="cuda:0"):
+    """Compute the log10 probabilities of a batch of encoded queries with a single forward pass.
+       If prefix past key values are given, only the tokens after the shared prefix are fed to the model.
+    """
+    suffixes_ids = [prompt_ids[prefix_length:] for prompt_ids, _ in batch]
+    max_length = max(len(suffix_ids) for suffix_ids in suffixes_ids)
+
+    # Right padding keeps the positions of real tokens unchanged for causal LMs.
+    input_ids = torch.full((len(batch), max_length), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), prefix_length + max_length), dtype=torch.long)
+    attention_mask[:, :prefix_length] = 1
+    for num_row, suffix_ids in enumerate(suffixes_ids):
+        input_ids[num_row, :len(suffix_ids)] = torch.tensor(suffix_ids, dtype=torch.long)
+        attention_mask[num_row, prefix_length: prefix_length + len(suffix_ids)] = 1
+
+    # Each query token is scored by the logits at the position before it.
+    score_rows = list()
+    score_positions = list()
+    score_ids = list()
+    for num_row, (_, query_spans) in enumerate(batch):
+        for query_start, query_ids in query_spans:
+            for num_id, query_id in enumerate(query_ids):
+                score_rows.append(num_row)
+                score_positions.append(query_start - 1 + num_id - prefix_length)
+                score_ids.append(query_id)
 
-def compute_joint_probability(tokenizer, model, query_concept1, query_concept2, query_concept3=None, device="cuda:0"):
-    """Compute joint probability of LLMs generating several query concepts simultaneously."""
-    if query_concept3 is None:
-        prompt_type = 0
-    else:
-        prompt_type = 1
+    with torch.no_grad():
+        if prefix_past_key_values is None:
+            outputs = model(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+        else:
+            past_key_values = expand_past_key_values(prefix_past_key_values, len(batch))
+            outputs = model(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device),
+                            past_key_values=past_key_values, use_cache=True)
+        rows = torch.tensor(score_rows, dtype=torch.long, device=device)
+        positions = torch.tensor(score_positions, dtype=torch.long, device=device)
+        ids = torch.tensor(score_ids, dtype=torch.long, device=device)
 
-    prompts = {0: f"The most likely to appear simultaneously with {query_concept1} is {query_concept2}",
-               1: (f"The most likely to appear simultaneously with {query_concept1} are {query_concept2}"
-                   f" and {query_concept3}")}
-    prompt = prompts[prompt_type]
+        query_scores = outputs.logits[rows, positions].float()
+        token_log_probabilities = query_scores.log_softmax(dim=-1).gather(1, ids.unsqueeze(1)).squeeze(1)
+        batch_log_probabilities = torch.zeros(len(batch), dtype=torch.float, device=device)
+        batch_log_probabilities.index_add_(0, rows, token_log_probabilities)
+        return (batch_log_probabilities / math.log(10)).tolist()
 
-    pos_assists = {0: [f"placeholder {query_concept1}", f"placeholder {query_concept2}"],
-                   1: [f"placeholder {query_concept1}", f"placeholder {query_concept2}",
-                       f"placeholder {query_concept3}"]}
-    pos_assists = pos_assists[prompt_type]
 
-    queries_ids = list()
-    pos_start = len(tokenizer.encode("placeholder test")) - 1
-    for pos_assist in pos_assists:
-        queries_ids.append(tokenizer.encode(pos_assist)[pos_start:])
+def compute_log_probability(tokenizer, model, query_concept, cache=None, device="cuda:0"):
+    """Compute the log10 probability of query concept generated by LLMs."""
+    query = build_probability_prompt(query_concept)
+    return compute_span_log_probabilities(tokenizer, model, [query], cache=cache, device=device)[0]
 
-    prompt_ids = tokenizer.encode(prompt)
-    query_starts = list()
-    for query_ids in queries_ids:
-        query_starts.append(locate_start_index(prompt_ids, query_ids))
 
-    assert len(queries_ids) == len(query_starts)
+def compute_conditional_log_probability(tokenizer, model, query_concept, given_concept1, given_concept2=None, cache=None,
+                                    device="cuda:0"):
+    """Compute the log10 probability of LLMs generating query concept based on given concept(s)."""
+    query = build_conditional_prompt(query_concept, given_concept1, given_concept2)
+    return compute_span_log_probabilities(tokenizer, model, [query], cache=cache, device=device)[0]
 
-    with torch.no_grad():
-        inputs = tokenizer(prompt, return_tensors="pt").to(device)
-        outputs = model(**inputs)
-        scores = outputs.logits[0]
 
-        queries_probability = float(1.0)
-        for num_query, query_ids in enumerate(queries_ids):
-            query_start = query_starts[num_query]
-            query_scores = scores[query_start-1: query_start-1 + len(query_ids)]
-            query_probability_distributions = query_scores.softmax(dim=-1)
+def compute_joint_log_probability(tokenizer, model, query_concept1, query_concept2, query_concept3=None, cache=None,
+                              device="cuda:0"):
+    """Compute joint log10 probability of LLMs generating several query concepts simultaneously."""
+    query = build_joint_prompt(query_concept1, query_concept2, query_concept3)
+    return compute_span_log_probabilities(tokenizer, model, [query], cache=cache, device=device)[0]
 
-            assert len(query_ids) == len(query_probability_distributions)
 
-            query_probability = float(1.0)
-            for num_id, query_id in enumerate(query_ids):
-                query_probability *= query_probability_distributions[num_id][query_id].item()
+def is_approximately_equal(log_num1, log_num2, tolerance):
+    """Check if two numbers given in log10 space are equal within an acceptable tolerance."""
+    return abs(log_num1 - log_num2) <= tolerance
 
-            queries_probability *= query_probability
 
-        return queries_probability
+def judge_correlate(log_probability_concept1, log_probability_concept1_on_concept2, strength):
+    """Judge correlation from the log probability of concept1 and its log probability conditioned on concept2."""
+    if not is_approximately_equal(log_probability_concept1, log_probability_concept1_on_concept2, strength):
+        if log_probability_concept1_on_concept2 > log_probability_concept1:
+            return True
+    return False
 
 
-def is_approximately_equal(num1, num2, tolerance):
-    """Check if two numbers are equal within an acceptable tolerance."""
-    if num1 == 0:
-        scale_num1 = 1e-100
+def judge_independent(log_probability_concept1, log_probability_concept1_on_concept2, tolerance):
+    """Judge independence from the log probability of concept1 and its log probability conditioned on concept2."""
+    if is_approximately_equal(log_probability_concept1, log_probability_concept1_on_concept2, tolerance):
+        return True
     else:
-        scale_num1 = math.log10(num1)
+        if log_probability_concept1 > log_probability_concept1_on_concept2:
+            return True
+        else:
+            return False
 
-    if num2 == 0:
-        scale_num2 = 1e-100
-    else:
-        scale_num2 = math.log10(num2)
 
-    return abs(scale_num1 - scale_num2) <= tolerance
+def judge_conditional_correlate(log_probability_concept1_on_given_concept, log_probability_concept1_on_given_concept_concept2,
+                                tolerance):
+    """Judge conditional correlation from the log probabilities of concept1 conditioned on given concept (and concept2)."""
+    if is_approximately_equal(log_probability_concept1_on_given_concept, log_probability_concept1_on_given_concept_concept2, tolerance):
+        return True
+    else:
+        if log_probability_concept1_on_given_concept < log_probability_concept1_on_given_concept_concept2:
+            return True
+        else:
+            return False
 
 
-def is_correlate(tokenizer, model, concept1, concept2, strength, device="cuda:0"):
+def is_correlate(tokenizer, model, concept1, concept2, strength, cache=None, device="cuda:0"):
     """Check if two concepts are statistically correlated for LLMs.
        Strength indicates correlated degree, larger means more correlated.
     """
-    probability_concept1 = compute_probability(tokenizer, model, concept1, device=device)
-    probability_concept1_on_concept2 = compute_conditional_probability(tokenizer, model, concept1, concept2, device=device)
+    log_probability_concept1 = compute_log_probability(tokenizer, model, concept1, cache=cache, device=device)
+    log_probability_concept1_on_concept2 = compute_conditional_log_probability(tokenizer, model, concept1, concept2, cache=cache, device=device)
+    return judge_correlate(log_probability_concept1, log_probability_concept1_on_concept2, strength)
 
-    if not is_approximately_equal(probability_concept1, probability_concept1_on_concept2, strength):
-        if probability_concept1_on_concept2 > probability_concept1:
-            return True
-    return False
 
-
-def is_independent(tokenizer, model, concept1, concept2, tolerance, device="cuda:0"):
+def is_independent(tokenizer, model, concept1, concept2, tolerance, cache=None, device="cuda:0"):
     """Check if two concepts are statistically independent for LLMs.
        Tolerance indicates acceptable fluctuation, lower means more independent.
     """
-    probability_concept1 = compute_probability(tokenizer, model, concept1, device=device)
-    probability_concept1_on_concept2 = compute_conditional_probability(tokenizer, model, concept1, concept2, device=device)
-
-    if is_approximately_equal(probability_concept1, probability_concept1_on_concept2, tolerance):
-        return True
-    else:
-        if probability_concept1 > probability_concept1_on_concept2:
-            return True
-        else:
-            return False
+    log_probability_concept1 = compute_log_probability(tokenizer, model, concept1, cache=cache, device=device)
+    log_probability_concept1_on_concept2 = compute_conditional_log_probability(tokenizer, model, concept1, concept2, cache=cache, device=device)
+    return judge_independent(log_probability_concept1, log_probability_concept1_on_concept2, tolerance)
 
 
-def is_conditional_correlate(tokenizer, model, concept1, concept2, given_concept, tolerance, device="cuda:0"):
+def is_conditional_correlate(tokenizer, model, concept1, concept2, given_concept, tolerance, cache=None,
+                             device="cuda:0"):
     """Check if two concepts are statistically correlated conditioned on another concept for LLMs.
        Note that we assume concept1 is correlated with the conditional concept in this function.
        Tolerance indicates acceptable fluctuation, lower means more correlated.
     """
-    probability_concept1_on_given_concept = compute_conditional_probability(tokenizer, model, concept1, given_concept, device=device)
-    probability_concept1_on_given_concept_concept2 = compute_conditional_probability(tokenizer, model, concept1, given_concept, concept2, device=device)
-
-    if is_approximately_equal(probability_concept1_on_given_concept, probability_concept1_on_given_concept_concept2, tolerance):
-        return True
-    else:
-        if probability_concept1_on_given_concept < probability_concept1_on_given_concept_concept2:
-            return True
-        else:
-            return False
+    log_probability_concept1_on_given_concept = compute_conditional_log_probability(tokenizer, model, concept1, given_concept, cache=cache, device=device)
+    log_probability_concept1_on_given_concept_concept2 = compute_conditional_log_probability(tokenizer, model, concept1, given_concept, concept2, cache=cache, device=device)
+    return judge_conditional_correlate(log_probability_concept1_on_given_concept, log_probability_concept1_on_given_concept_concept2, tolerance)
 
 
 def combine_elements(element_list, size=2):
@@ -193,24 +499,174 @@ def combine_elements(element_list, size=2):
     return combinations
 
 
-def discover_cause_concepts(tokenizer, model, effect_concept, strength, tolerance, device="cuda:0"):
-    """Discover the cause concepts that driver LLms to generate the given effect concept."""
+def evaluate_pairs(tokenizer, model, effect_concept, correlated_tuples, tolerance, batch_size=32, cache=None,
+                   device="cuda:0"):
+    """Check which pairs of correlated concepts are causes of the effect concept.
+       The cheap independence test runs first, the conditional test only runs for independent pairs.
+    """
+    is_cause_pairs = [False] * len(correlated_tuples)
+
+    independent_queries = list()
+    for correlated_concept1, correlated_concept2 in correlated_tuples:
+        independent_queries.append(build_probability_prompt(correlated_concept1))
+        independent_queries.append(build_conditional_prompt(correlated_concept1, correlated_concept2))
+    independent_log_probabilities = compute_span_log_probabilities(tokenizer, model, independent_queries, batch_size, cache, device=device)
+
+    nums_independent = list()
+    for num_tuple in range(len(correlated_tuples)):
+        log_probability_concept1 = independent_log_probabilities[2 * num_tuple]
+        log_probability_concept1_on_concept2 = independent_log_probabilities[2 * num_tuple + 1]
+        if judge_independent(log_probability_concept1, log_probability_concept1_on_concept2, tolerance):
+            nums_independent.append(num_tuple)
+    if len(nums_independent) == 0:
+        return is_cause_pairs
+
+    conditional_queries = list()
+    for num_tuple in nums_independent:
+        correlated_concept1, correlated_concept2 = correlated_tuples[num_tuple]
+        conditional_queries.append(build_conditional_prompt(correlated_concept1, effect_concept))
+        conditional_queries.append(build_conditional_prompt(correlated_concept1, effect_concept, correlated_concept2))
+    conditional_log_probabilities = compute_span_log_probabilities(tokenizer, model, conditional_queries, batch_size, cache, device=device)
+
+    for num_independent, num_tuple in enumerate(nums_independent):
+        log_probability_concept1_on_effect = conditional_log_probabilities[2 * num_independent]
+        log_probability_concept1_on_effect_concept2 = conditional_log_probabilities[2 * num_independent + 1]
+        if judge_conditional_correlate(log_probability_concept1_on_effect, log_probability_concept1_on_effect_concept2, tolerance):
+            is_cause_pairs[num_tuple] = True
+
+    return is_cause_pairs
+
+
+def search_exhaustively(tokenizer, model, effect_concept, correlated_concepts, tolerance, batch_size=32, cache=None,
+                        device="cuda:0"):
+    """Test all pairs of correlated concepts, only skipping pairs whose concepts are both already causes.
+       Return the cause concepts and the number of evaluated pairs.
+    """
+    cause_concepts = list()
+    num_evaluated = 0
+
+    # Pairs are handled in chunks so that pairs whose concepts are both already causes are still skipped.
+    correlated_tuples = combine_elements(correlated_concepts)
+    for chunk_start in tqdm.tqdm(range(0, len(correlated_tuples), batch_size)):
+        chunk_tuples = list()
+        for correlated_concept1, correlated_concept2 in correlated_tuples[chunk_start: chunk_start + batch_size]:
+            if correlated_concept1 not in cause_concepts or correlated_concept2 not in cause_concepts:
+                chunk_tuples.append((correlated_concept1, correlated_concept2))
+        if len(chunk_tuples) == 0:
+            continue
+
+        num_evaluated += len(chunk_tuples)
+        is_cause_pairs = evaluate_pairs(tokenizer, model, effect_concept, chunk_tuples, tolerance, batch_size, cache, device=device)
+        for (correlated_concept1, correlated_concept2), is_cause_pair in zip(chunk_tuples, is_cause_pairs):
+            if is_cause_pair:
+                if correlated_concept1 not in cause_concepts:
+                    cause_concepts.append(correlated_concept1)
+                if correlated_concept2 not in cause_concepts:
+                    cause_concepts.append(correlated_concept2)
+
+    return cause_concepts, num_evaluated
+
+
+def search_in_order(tokenizer, model, effect_concept, correlated_concepts, tolerance, max_pairs=None, batch_size=32,
+                    cache=None, device="cuda:0"):
+    """Test pairs anchored on each correlated concept in the given order, and stop testing the pairs of an anchor
+       once it is confirmed as a cause. At most max_pairs pairs are tested.
+       Return the cause concepts and the number of evaluated pairs.
+    """
     cause_concepts = list()
+    num_evaluated = 0
+
+    pending_partners = dict()
+    for num_concept, correlated_concept in enumerate(correlated_concepts):
+        pending_partners[correlated_concept] = deque(correlated_concepts[num_concept + 1:])
+
+    while max_pairs is None or num_evaluated < max_pairs:
+        active_anchors = [anchor for anchor, partners in pending_partners.items()
+                          if anchor not in cause_concepts and len(partners) > 0]
+        if len(active_anchors) == 0:
+            break
+
+        # Each round takes a few pairs from every active anchor, so that a round fills one batch and an anchor
+        # confirmed in this round stops right after it.
+        round_size = batch_size
+        if max_pairs is not None:
+            round_size = min(round_size, max_pairs - num_evaluated)
+        num_per_anchor = max(1, round_size // len(active_anchors))
+
+        round_tuples = list()
+        for anchor in active_anchors:
+            partners = pending_partners[anchor]
+            num_taken = 0
+            while len(partners) > 0 and num_taken < num_per_anchor and len(round_tuples) < round_size:
+                round_tuples.append((anchor, partners.popleft()))
+                num_taken += 1
+
+        num_evaluated += len(round_tuples)
+        is_cause_pairs = evaluate_pairs(tokenizer, model, effect_concept, round_tuples, tolerance, batch_size, cache, device=device)
+        for (correlated_concept1, correlated_concept2), is_cause_pair in zip(round_tuples, is_cause_pairs):
+            if is_cause_pair:
+                if correlated_concept1 not in cause_concepts:
+                    cause_concepts.append(correlated_concept1)
+                if correlated_concept2 not in cause_concepts:
+                    cause_concepts.append(correlated_concept2)
+
+    return cause_concepts, num_evaluated
+
+
+def discover_cause_concepts(tokenizer, model, effect_concept, strength, tolerance, batch_size=32, cache=None,
+                            search_mode="exhaustive", max_candidates=None, max_pairs=None, candidate_mode="related",
+                            candidate_options=None, stats=None, device="cuda:0"):
+    """Discover the cause concepts that driver LLms to generate the given effect concept.
+       The probabilities needed by the statistical tests are computed in batches of batch_size prompts,
+       a shared cache avoids recomputing the marginal and conditional probabilities reused across pairs.
+       The "exhaustive" search mode tests all pairs of correlated concepts, the "ordered" mode tests pairs from the
+       most correlated concepts first and stops testing a concept once it is confirmed.
+       Max candidates keeps the top-k correlated concepts, max pairs bounds the number of pairs tested by the ordered mode.
+       The "related" candidate mode takes the direct ConceptNet neighbours of the effect concept, the "expanded" mode
+       takes a bounded multi-hop neighbourhood, candidate options are passed to expand_related_concepts.
+       If a stats dict is given, it records the numbers of candidate, correlated, evaluated and pruned pairs.
+    """
+    if candidate_mode == "related":
+        related_concepts = get_related_concepts(effect_concept)
+    elif candidate_mode == "expanded":
+        if candidate_options is None:
+            candidate_options = dict()
+        related_concepts = expand_related_concepts(effect_concept, **candidate_options)
+    else:
+        raise ValueError("Please select candidate mode from related or expanded.")
+    correlate_queries = [build_probability_prompt(effect_concept)]
+    for related_concept in related_concepts:
+        correlate_queries.append(build_conditional_prompt(effect_concept, related_concept))
+    correlate_log_probabilities = compute_span_log_probabilities(tokenizer, model, correlate_queries, batch_size, cache, device=device)
 
     correlated_concepts = list()
-    for related_concept in get_related_concepts(effect_concept):
-        if is_correlate(tokenizer, model, effect_concept, related_concept, strength, device=device):
+    correlation_strengths = dict()
+    log_probability_effect_concept = correlate_log_probabilities[0]
+    for related_concept, log_probability_effect_on_related in zip(related_concepts, correlate_log_probabilities[1:]):
+        if judge_correlate(log_probability_effect_concept, log_probability_effect_on_related, strength):
             correlated_concepts.append(related_concept)
-
-    correlated_tuples = combine_elements(correlated_concepts)
-    for correlated_tuple in tqdm.tqdm(correlated_tuples):
-        correlated_concept1, correlated_concept2 = correlated_tuple
-        if correlated_concept1 not in cause_concepts or correlated_concept2 not in cause_concepts:
-            if is_independent(tokenizer, model, correlated_concept1, correlated_concept2, tolerance, device=device):
-                if is_conditional_correlate(tokenizer, model, correlated_concept1, correlated_concept2, effect_concept, tolerance, device=device):
-                    if correlated_concept1 not in cause_concepts:
-                        cause_concepts.append(correlated_concept1)
-                    if correlated_concept2 not in cause_concepts:
-                        cause_concepts.append(correlated_concept2)
+            correlation_strengths[related_concept] = log_probability_effect_on_related - log_probability_effect_concept
+    num_pairs = len(correlated_concepts) * (len(correlated_concepts) - 1) // 2
+
+    if search_mode == "ordered" or max_candidates is not None:
+        correlated_concepts = sorted(correlated_concepts, key=lambda concept: correlation_strengths[concept], reverse=True)
+        if max_candidates is not None:
+            correlated_concepts = correlated_concepts[:max_candidates]
+
+    if search_mode == "exhaustive":
+        cause_concepts, num_evaluated = search_exhaustively(tokenizer, model, effect_concept, correlated_concepts,
+                                                            tolerance, batch_size, cache, device=device)
+    elif search_mode == "ordered":
+        cause_concepts, num_evaluated = search_in_order(tokenizer, model, effect_concept, correlated_concepts, tolerance,
+                                                        max_pairs, batch_size, cache, device=device)
+    else:
+        raise ValueError("Please select search mode from exhaustive or ordered.")
+
+    if stats is not None:
+        stats["related_concepts"] = len(related_concepts)
+        stats["correlated_concepts"] = len(correlation_strengths)
+        stats["pairs"] = num_pairs
+        stats["evaluated_pairs"] = num_evaluated
+        stats["pruned_pairs"] = num_pairs - num_evaluated
 
     return cause_concepts
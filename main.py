@@ -1,715 +1,408 @@
 import os
-import nltk
-import requests
-from copy import deepcopy
-from vllm import LLM, SamplingParams
-
-from file_io import read_json_file, write_json_file
-from query_interface import relation_extraction, entity_typing, event_detection
-
-
-def get_semeval_relation_info(file_path):
-    """Obtain all relations and roles from SemEval."""
-    samples = read_json_file(file_path)
-    head_roles = list()
-    tail_roles = list()
-
-    for sample in samples:
-        relation = sample["relation_type"].lower()
-        if relation != "other":
-            head_role, tail_role = relation.split("-")
-            if head_role not in head_roles:
-                head_roles.append(head_role)
-            if tail_role not in tail_roles:
-                tail_roles.append(tail_role)
-
-    return head_roles, tail_roles
-
-
-def get_few_nerd_type_info(file_path):
-    """Obtain all entity types from Few-NERD."""
-    samples = read_json_file(file_path)
-    entity_types = list()
-
-    for sample in samples:
-        entity_type = sample["entity_type"].lower()
-        if entity_type not in entity_types:
-            entity_types.append(entity_type)
-
-    return entity_types
-
-
-def get_ace05_type_info(file_path):
-    """Obtain all event types from ACE 2005."""
-    samples = read_json_file(file_path)
-    event_subtypes = list()
-
-    for sample in samples:
-        event_type = sample["event_type"].lower()
-        split_contents = event_type.split(":")
-        for split_content in split_contents:
-            if "-" in split_content:
-                sub_split_contents = split_content.split("-")
-                for sub_split_content in sub_split_contents:
-                    if sub_split_content not in event_subtypes:
-                        event_subtypes.append(sub_split_content)
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoConfig, AutoTokenizer
+
+from file_io import read_json_file, replace_json_file, append_jsonl_file, recover_jsonl_file
+from query_interface import encode_prompt
+from task_adapters import get_task_adapter
+from evaluation_records import EvaluationRecord, AttackRecord
+from attack_scheduler import AdaptiveAttackScheduler
+from token_budget import plan_token_budget
+from inference_backends import InferenceBackend, VllmBackend, load_inference_backend
+from synonym_providers import load_synonym_provider
+
+
+SYNONYM_PROVIDER = None
+
+
+def get_synonyms_batch(words, number, synonym_provider=None):
+    """Get the single-word synonyms of each word, padded with the word itself to at least number synonyms.
+       Synonyms come from the offline ConceptNet index unless a synonym provider is given.
+    """
+    global SYNONYM_PROVIDER
+    if synonym_provider is None:
+        if SYNONYM_PROVIDER is None:
+            SYNONYM_PROVIDER = load_synonym_provider()
+        synonym_provider = SYNONYM_PROVIDER
+
+    words_synonyms = list()
+    for word, synonyms in zip(words, synonym_provider.get_synonyms_batch(words)):
+        selected_synonyms = list()
+        for synonym in synonyms:
+            if len(synonym.split(" ")) == 1:
+                selected_synonyms.append(synonym)
+
+        if len(selected_synonyms) < number:
+            selected_synonyms.extend([word] * (number - len(selected_synonyms)))
+        words_synonyms.append(selected_synonyms)
+
+    return words_synonyms
+
+
+def get_synonyms(word, number, synonym_provider=None):
+    """Get the single-word synonyms of a word, padded with the word itself to at least number synonyms."""
+    return get_synonyms_batch([word], number, synonym_provider)[0]
+
+
+def answer_requests(backend, prompt_requests):
+    """Answer a list of (prompt, job) requests with an inference backend in the scoring modes of their jobs.
+       Return the (answer, label scores) of each request, label scores is None unless its job scores by likelihood.
+    """
+    answers = [None] * len(prompt_requests)
+    generate_idxs = [idx for idx, (_, job) in enumerate(prompt_requests) if job.scoring_mode != "likelihood"]
+    score_idxs = [idx for idx, (_, job) in enumerate(prompt_requests) if job.scoring_mode == "likelihood"]
+
+    if len(generate_idxs) > 0:
+        output_texts = backend.generate([prompt_requests[idx][0] for idx in generate_idxs],
+                                        [prompt_requests[idx][1].generation_options for idx in generate_idxs])
+        assert len(output_texts) == len(generate_idxs)
+        for idx, output_text in zip(generate_idxs, output_texts):
+            job = prompt_requests[idx][1]
+            answers[idx] = (job.task.parse_answer(output_text, job.prompt_type), None)
+
+    if len(score_idxs) > 0:
+        scored_answers = backend.score_labels([(prompt_requests[idx][0], prompt_requests[idx][1].labels) for idx in score_idxs])
+        for idx, scored_answer in zip(score_idxs, scored_answers):
+            answers[idx] = scored_answer
+
+    return answers
+
+
+def build_eval_requests(task, prompt_type):
+    """Build an empty naive evaluation record with the prompts and (label, instance id) essentials of a task."""
+    rec_eval = EvaluationRecord()
+
+    eval_prompts = list()
+    eval_essentials = list()
+    for inst_id, inst in enumerate(task.insts):
+        if task.is_evaluated(inst):
+            rec_eval.add_instance(str(inst_id), inst)
+            eval_essentials.append((task.get_label(inst), str(inst_id)))
+            eval_prompts.append(task.build_prompt(" ".join(inst["sentence"]), inst, prompt_type))
+    return rec_eval, eval_prompts, eval_essentials
+
+
+def record_eval_predictions(task, rec_eval, eval_essentials, eval_answers):
+    """Record the naive (prediction, label scores) answers of a task as right or wrong."""
+    assert len(eval_answers) == len(eval_essentials)
+    for (eval_pred, label_scores), (label, inst_id) in zip(eval_answers, eval_essentials):
+        eval_history = task.build_eval_history(rec_eval.instances[inst_id], label, eval_pred)
+        if label_scores is not None:
+            eval_history["label_scores"] = label_scores
+        rec_eval.record_prediction(inst_id, eval_history, eval_pred == label)
+
+
+def generate_attacks(task, rec_eval, rec_attack, causes, prompt_type):
+    """Yield the (instance id, [(prompt, variant), ...]) attacks of each correctly predicted instance that is not attacked yet."""
+    for inst_id, inst in rec_eval.instances.items():
+        if rec_eval.is_right(inst_id) and not rec_attack.is_attacked(inst_id):
+            attack_sentence = task.build_attack_sentence(inst)
+            inst_attacks = list()
+            for variant in task.generate_variants(inst_id, inst, causes):
+                attack_prompt = task.build_prompt(attack_sentence.render(variant), inst, prompt_type)
+                inst_attacks.append((attack_prompt, variant))
+            if len(inst_attacks) > 0:
+                yield inst_id, inst_attacks
+
+
+def batch_attacks(inst_attacks_stream, batch_size):
+    """Yield batches of whole instances holding at least batch size attacks, except the last one."""
+    attack_batch = list()
+    num_attacks = 0
+    for inst_id, inst_attacks in inst_attacks_stream:
+        attack_batch.append((inst_id, inst_attacks))
+        num_attacks += len(inst_attacks)
+        if num_attacks >= batch_size:
+            yield attack_batch
+            attack_batch = list()
+            num_attacks = 0
+    if len(attack_batch) > 0:
+        yield attack_batch
+
+
+def aggregate_attacks(task, rec_eval, attack_batch, attack_answers):
+    """Aggregate the (prediction, label scores) answers of the attacks of a batch of whole instances,
+       return one result per instance with its successful and failed attack histories.
+    """
+    attack_results = list()
+    attack_answers = iter(attack_answers)
+    for inst_id, inst_attacks in attack_batch:
+        inst = rec_eval.instances[inst_id]
+        label = task.get_label(inst)
+        attack_sentence = task.build_attack_sentence(inst)
+        success_attack_history = list()
+        failed_attack_history = list()
+        for (_, variant), (attack_pred, label_scores) in zip(inst_attacks, attack_answers):
+            attack_history = task.build_attack_history(attack_sentence, label, variant, attack_pred)
+            if label_scores is not None:
+                attack_history["label_scores"] = label_scores
+            if attack_pred != label:
+                success_attack_history.append(attack_history)
             else:
-                if split_content not in event_subtypes:
-                    event_subtypes.append(split_content)
-
-    return event_subtypes
-
-
-def get_synonyms(word, number):
-    url = f"https://api.datamuse.com/words?rel_syn={word}"
-    response = requests.get(url)
-    synonyms = [entry["word"] for entry in response.json()]
-
-    selected_synonyms = list()
-    for synonym in synonyms:
-        if len(synonym.split(" ")) == 1:
-            selected_synonyms.append(synonym)
-
-    if len(selected_synonyms) < number:
-        selected_synonyms.extend([word] * (number - len(selected_synonyms)))
-
-    return selected_synonyms
-
-
-def evaluate_on_semeval(model_path, causes_path, prompt_type="ic"):
-    """Evaluate the causal stability of LLMs under SemEval dataset."""
-    model = LLM(model=model_path, gpu_memory_utilization=0.9, max_model_len=512)
-    sampling_params = SamplingParams(temperature=0, max_tokens=512, stop=["</Instance>"])
-
-    rec_dir = os.path.join("evaluation_results", model_path.split("/")[-1])
-    rec_eval_file = os.path.join(rec_dir, f"semeval_naive_evaluation_{prompt_type}.json")
-    if os.path.exists(rec_dir) and os.path.exists(rec_eval_file):
-        rec_eval = read_json_file(rec_eval_file)
-    else:
-        if not os.path.exists(rec_dir):
-            os.makedirs(rec_dir)
-        rec_eval = dict()
-        rec_eval["evaluate_ids"] = list()
-        rec_eval["evaluate_instances"] = dict()
-        rec_eval["right_predict_ids"] = list()
-        rec_eval["right_predict_history"] = dict()
-        rec_eval["wrong_predict_ids"] = list()
-        rec_eval["wrong_predict_history"] = dict()
-
-        semeval_path = "datasets/semeval.json"
-        semeval_insts = read_json_file(semeval_path)
-        eval_prompts = list()
-        eval_essentials = list()
-        for inst_id, semeval_inst in enumerate(semeval_insts):
-            rel_label = semeval_inst["relation_type"].lower()
-            if rel_label != "other":
-                rec_eval["evaluate_ids"].append(str(inst_id))
-                rec_eval["evaluate_instances"][str(inst_id)] = semeval_inst
-                eval_essentials.append((rel_label, str(inst_id)))
-
-                sentence = " ".join(semeval_inst["sentence"])
-                h_entity = semeval_inst["head_entity"]["span"]
-                t_entity = semeval_inst["tail_entity"]["span"]
-                eval_prompt = relation_extraction(sentence, h_entity, t_entity, prompt_type)
-                eval_prompts.append(eval_prompt)
-
-        eval_outputs = model.generate(eval_prompts, sampling_params)
-        eval_preds = list()
-        for eval_output in eval_outputs:
-            eval_pred = eval_output.outputs[0].text.strip()
+                failed_attack_history.append(attack_history)
+        attack_results.append({"instance_id": inst_id,
+                               "success_attack": success_attack_history,
+                               "failed_attack": failed_attack_history})
+    return attack_results
+
+
+class EvaluationJob:
+    """Evaluation of one task with one prompt type and causes file, its records are kept in the records folder.
+       The "generate" scoring mode parses free-form generations, the "likelihood" mode picks the candidate label
+       of highest log-likelihood and records all label scores, the "choice" mode constrains decoding to the labels.
+       Records of the constrained modes carry the mode in their file names.
+       With a confidence the attacks are scheduled adaptively and stop once the instability bucket of an instance
+       is decided at that confidence level, the attack record then carries the confidence in its file name.
+       The attack record is named after the causes file, prefixed with the task name unless the causes file already is.
+    """
+
+    def __init__(self, task, prompt_type, causes_path, rec_dir, scoring_mode="generate", confidence=None):
+        self.task = task
+        self.prompt_type = prompt_type
+        self.causes_path = causes_path
+        self.scoring_mode = scoring_mode
+        self.confidence = confidence
+        self.labels = task.get_candidate_labels()
+        if scoring_mode == "generate":
+            self.generation_options = {"max_tokens": task.max_tokens, "stop": ["</Instance>"]}
+        elif scoring_mode in ("likelihood", "choice"):
             if prompt_type == "cot":
-                eval_pred = eval_pred.split("Relation Between the Head Entity and Tail Entity:")[-1].strip()
-            eval_preds.append(eval_pred)
-
-        assert len(eval_preds) == len(eval_essentials)
-        for idx in range(len(eval_preds)):
-            eval_pred = eval_preds[idx]
-            rel_label, inst_id = eval_essentials[idx]
-
-            semeval_inst = rec_eval["evaluate_instances"][inst_id]
-            sentence = " ".join(semeval_inst["sentence"])
-            h_entity = semeval_inst["head_entity"]["span"]
-            t_entity = semeval_inst["tail_entity"]["span"]
-            marked_h_entity = " ".join(["<h>", h_entity, "</h>"])
-            marked_t_entity = " ".join(["<t>", t_entity, "</t>"])
-            marked_sentence = sentence.replace(h_entity, marked_h_entity)
-            marked_sentence = marked_sentence.replace(t_entity, marked_t_entity)
-
-            if eval_pred == rel_label:
-                rec_eval["right_predict_ids"].append(inst_id)
-                rec_eval["right_predict_history"][inst_id] = {"sentence": marked_sentence,
-                                                              "relation_label": rel_label,
-                                                              "predict_relation": eval_pred}
+                raise ValueError("Please select scoring mode generate for cot prompts.")
+            if scoring_mode == "likelihood":
+                self.generation_options = None
             else:
-                rec_eval["wrong_predict_ids"].append(inst_id)
-                rec_eval["wrong_predict_history"][inst_id] = {"sentence": marked_sentence,
-                                                              "relation_label": rel_label,
-                                                              "predict_relation": eval_pred}
-
-        write_json_file(rec_eval_file, rec_eval)
-
-    rec_attack_file = os.path.join(rec_dir, causes_path.split("/")[-1].replace(".json", f"_{prompt_type}.json"))
-    if os.path.exists(rec_attack_file):
-        rec_attack = read_json_file(rec_attack_file)
-    else:
-        rec_attack = dict()
-        rec_attack["success_attack_ids"] = list()
-        rec_attack["success_attack_history"] = dict()
-        rec_attack["failed_attack_ids"] = list()
-        rec_attack["failed_attack_history"] = dict()
-
-    semeval_path = "datasets/semeval.json"
-    causes = read_json_file(causes_path)
-    head_roles, tail_roles = get_semeval_relation_info(semeval_path)
-
-    attack_prompts = list()
-    attack_essentials = list()
-    for inst_id, semeval_inst in rec_eval["evaluate_instances"].items():
-        if inst_id in rec_eval["right_predict_ids"]:
-            if inst_id not in rec_attack["success_attack_ids"]:
-                if inst_id not in rec_attack["failed_attack_ids"]:
-                    rel_label = semeval_inst["relation_type"].lower()
-                    h_entity = semeval_inst["head_entity"]["span"]
-                    t_entity = semeval_inst["tail_entity"]["span"]
-                    h_entity_role = rel_label.split("-")[0]
-                    t_entity_role = rel_label.split("-")[1]
-                    h_entity_idx = semeval_inst["head_entity"]["start_idx"]
-                    t_entity_idx = semeval_inst["tail_entity"]["start_idx"]
-
-                    for head_role in head_roles:
-                        if head_role != h_entity_role:
-                            confounders = causes.get(head_role)
-                            if confounders is not None:
-                                for confounder in confounders:
-                                    sentence_list_copy = deepcopy(semeval_inst["sentence"])
-                                    sentence_list_copy.insert(h_entity_idx, confounder)
-                                    attack_sentence = " ".join(sentence_list_copy)
-                                    attack_prompt = relation_extraction(attack_sentence, h_entity, t_entity, prompt_type)
-                                    attack_prompts.append(attack_prompt)
-                                    attack_essentials.append({
-                                        "instance_id": inst_id,
-                                        "confounder": confounder,
-                                        "attack_type": "head_attack",
-                                        "relation_label": rel_label,
-                                        "expected_relation": f"{head_role}-x"
-                                    })
-
-                    for tail_role in tail_roles:
-                        if tail_role != t_entity_role:
-                            confounders = causes.get(tail_role)
-                            if confounders is not None:
-                                for confounder in confounders:
-                                    sentence_list_copy = deepcopy(semeval_inst["sentence"])
-                                    sentence_list_copy.insert(t_entity_idx, confounder)
-                                    attack_sentence = " ".join(sentence_list_copy)
-                                    attack_prompt = relation_extraction(attack_sentence, h_entity, t_entity, prompt_type)
-                                    attack_prompts.append(attack_prompt)
-                                    attack_essentials.append({
-                                        "instance_id": inst_id,
-                                        "confounder": confounder,
-                                        "attack_type": "tail_attack",
-                                        "relation_label": rel_label,
-                                        "expected_relation": f"x-{tail_role}"
-                                    })
-
-    attack_outputs = model.generate(attack_prompts, sampling_params)
-    attack_preds = list()
-    for attack_output in attack_outputs:
-        attack_pred = attack_output.outputs[0].text.strip()
-        if prompt_type == "cot":
-            attack_pred = attack_pred.split("Relation Between the Head Entity and Tail Entity:")[-1].strip()
-        attack_preds.append(attack_pred)
-
-    assert len(attack_preds) == len(attack_essentials)
-    success_attack_history = list()
-    failed_attack_history = list()
-    curr_inst_id = None
-    is_attack = False
-
-    for idx in range(len(attack_preds)):
-        attack_pred = attack_preds[idx]
-        inst_id = attack_essentials[idx]["instance_id"]
-        confounder = attack_essentials[idx]["confounder"]
-        attack_type = attack_essentials[idx]["attack_type"]
-        rel_label = attack_essentials[idx]["relation_label"]
-        expected_rel = attack_essentials[idx]["expected_relation"]
-
-        semeval_inst = rec_eval["evaluate_instances"][inst_id]
-        sentence = " ".join(semeval_inst["sentence"])
-        h_entity = semeval_inst["head_entity"]["span"]
-        t_entity = semeval_inst["tail_entity"]["span"]
-        marked_h_entity = " ".join(["<h>", h_entity, "</h>"])
-        marked_t_entity = " ".join(["<t>", t_entity, "</t>"])
-        marked_sentence = sentence.replace(h_entity, marked_h_entity)
-        marked_sentence = marked_sentence.replace(t_entity, marked_t_entity)
-
-        marked_confounder = " ".join(["<c>", confounder, "</c>"])
-        if attack_type == "head_attack":
-            marked_attack_sentence = marked_sentence.replace(marked_h_entity, " ".join([marked_confounder, marked_h_entity]))
+                self.generation_options = {"max_tokens": task.max_tokens, "choices": self.labels}
         else:
-            marked_attack_sentence = marked_sentence.replace(marked_t_entity, " ".join([marked_confounder, marked_t_entity]))
-
-        attack_history = {"sentence": marked_attack_sentence,
-                          "relation_label": rel_label,
-                          "expected_relation": expected_rel,
-                          "prediction_relation": attack_pred}
-
-        if inst_id != curr_inst_id:
-            if curr_inst_id is not None:
-                success_attack_history_copy = deepcopy(success_attack_history)
-                failed_attack_history_copy = deepcopy(failed_attack_history)
-                if is_attack:
-                    rec_attack["success_attack_ids"].append(curr_inst_id)
-                    rec_attack["success_attack_history"][curr_inst_id] = {"success_attack": success_attack_history_copy,
-                                                                          "failed_attack": failed_attack_history_copy}
-                else:
-                    assert len(success_attack_history) == 0
-                    rec_attack["failed_attack_ids"].append(curr_inst_id)
-                    rec_attack["failed_attack_history"][curr_inst_id] = failed_attack_history_copy
-
-                success_attack_history.clear()
-                failed_attack_history.clear()
-                curr_inst_id = inst_id
-                is_attack = False
-
-                if attack_pred != rel_label:
-                    is_attack = True
-                    success_attack_history.append(attack_history)
-                else:
-                    failed_attack_history.append(attack_history)
-            else:
-                if attack_pred != rel_label:
-                    is_attack = True
-                    success_attack_history.append(attack_history)
-                else:
-                    failed_attack_history.append(attack_history)
-                curr_inst_id = inst_id
+            raise ValueError("Please select scoring mode from generate, likelihood or choice.")
+
+        rec_suffix = prompt_type if scoring_mode == "generate" else f"{prompt_type}_{scoring_mode}"
+        self.rec_eval_file = os.path.join(rec_dir, f"{task.name}_naive_evaluation_{rec_suffix}.json")
+        rec_attack_suffix = rec_suffix if confidence is None else f"{rec_suffix}_c{confidence}"
+        causes_file = causes_path.split("/")[-1]
+        if not causes_file.startswith(f"{task.name}_"):
+            causes_file = f"{task.name}_{causes_file}"
+        self.rec_attack_file = os.path.join(rec_dir, causes_file.replace(".json", f"_{rec_attack_suffix}.json"))
+        self.rec_attack_log_file = self.rec_attack_file.replace(".json", "_log.jsonl")
+        self.rec_eval = None
+        self.rec_attack = None
+        self.scheduler = None
+
+    def load_attack_record(self):
+        """Load the attack record to resume from, or start an empty one, then replay the results logged after it."""
+        if os.path.exists(self.rec_attack_file):
+            self.rec_attack = AttackRecord(read_json_file(self.rec_attack_file))
         else:
-            if attack_pred != rel_label:
-                is_attack = True
-                success_attack_history.append(attack_history)
+            self.rec_attack = AttackRecord()
+
+        for attack_result in recover_jsonl_file(self.rec_attack_log_file):
+            if not self.rec_attack.is_attacked(attack_result["instance_id"]):
+                self.rec_attack.record_result(attack_result)
+
+    def record_attack_batch(self, attack_batch, attack_answers):
+        """Log the results of a finished batch of instances to disk before recording them, so a crash loses no batch."""
+        attack_results = aggregate_attacks(self.task, self.rec_eval, attack_batch, attack_answers)
+        if self.scheduler is not None:
+            attack_results = self.scheduler.record_results(attack_results)
+        append_jsonl_file(self.rec_attack_log_file, attack_results)
+        for attack_result in attack_results:
+            self.rec_attack.record_result(attack_result)
+
+    def finish_attack_record(self):
+        """Write the attack record atomically and drop the log folded into it."""
+        replace_json_file(self.rec_attack_file, self.rec_attack.to_json())
+        if os.path.exists(self.rec_attack_log_file):
+            os.remove(self.rec_attack_log_file)
+        if self.rec_attack.attack_calls is not None:
+            num_issued, num_skipped = self.rec_attack.attack_calls["issued"], self.rec_attack.attack_calls["skipped"]
+            print(f"{self.rec_attack_file}: {num_skipped} of {num_issued + num_skipped} attack calls saved")
+
+    def attack_batches(self, batch_size):
+        """Yield the batches of whole instances still to be attacked."""
+        causes = read_json_file(self.causes_path)
+        inst_attacks_stream = generate_attacks(self.task, self.rec_eval, self.rec_attack, causes, self.prompt_type)
+        if self.confidence is None:
+            return batch_attacks(inst_attacks_stream, batch_size)
+        self.scheduler = AdaptiveAttackScheduler(inst_attacks_stream, self.confidence)
+        return self.scheduler.batches(batch_size)
+
+
+class EvaluationSession:
+    """Own one loaded model and evaluate a manifest of (task, prompt type, causes path[, scoring mode]) jobs with it.
+       The naive evaluations of all jobs are generated together and the attacks of the jobs are interleaved
+       into shared batches, each prompt carrying the generation options of its job. A confidence schedules the attacks
+       of all jobs adaptively. The model is served by the named inference backend, vLLM by default, or may be given
+       as a loaded vLLM engine or inference backend.
+    """
+
+    def __init__(self, model_path, model=None, max_model_len=None, gpu_memory_utilization=0.9, confidence=None,
+                 backend="vllm", backend_options=None):
+        self.model_path = model_path
+        self.confidence = confidence
+        self.model = model
+        self.backend = backend
+        self.backend_options = backend_options if backend_options is not None else dict()
+        self.max_model_len = max_model_len
+        self.gpu_memory_utilization = gpu_memory_utilization
+        self.rec_dir = os.path.join("evaluation_results", model_path.split("/")[-1])
+        self.tasks = dict()
+
+    def get_task(self, task):
+        """Get a task adapter by its name, the adapter of a name is created once per session."""
+        if not isinstance(task, str):
+            return task
+        if task not in self.tasks:
+            self.tasks[task] = get_task_adapter(task)
+        return self.tasks[task]
+
+    def plan_model(self, jobs):
+        """Plan the context and scheduling limits of the model from the token lengths of the prompts of the jobs.
+           An attack prompt inserts one confounder into the sentence of a naive prompt, so every naive prompt is
+           counted with the longest confounder of its job.
+        """
+        tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        prompt_lengths = list()
+        for job in jobs:
+            _, eval_prompts, _ = build_eval_requests(job.task, job.prompt_type)
+            causes = read_json_file(job.causes_path)
+            confounder_length = max((len(tokenizer.encode(f" {confounder}", add_special_tokens=False))
+                                     for confounders in causes.values() for confounder in confounders), default=0)
+            prompt_lengths.extend(len(encode_prompt(tokenizer, eval_prompt)) + confounder_length for eval_prompt in eval_prompts)
+        context_limit = getattr(AutoConfig.from_pretrained(self.model_path), "max_position_embeddings", None)
+        return plan_token_budget(prompt_lengths, max(job.task.max_tokens for job in jobs), context_limit)
+
+    def load_model(self, jobs):
+        """Load the backend of the model on first use. A vLLM engine gets the limits planned for the jobs, the context
+           length may be given instead, and prefix caching shares the KV cache of the in-context prefix of each prompt
+           template across prompts.
+        """
+        if self.model is None:
+            if self.backend == "vllm":
+                token_budget = self.plan_model(jobs)
+                print("token budget:", token_budget)
+                if self.max_model_len is None:
+                    self.max_model_len = token_budget["max_model_len"]
+                self.model = VllmBackend(self.model_path, max_model_len=self.max_model_len,
+                                         max_num_batched_tokens=max(self.max_model_len, token_budget["max_num_batched_tokens"]),
+                                         gpu_memory_utilization=self.gpu_memory_utilization)
             else:
-                failed_attack_history.append(attack_history)
-
-    if is_attack:
-        rec_attack["success_attack_ids"].append(curr_inst_id)
-        rec_attack["success_attack_history"][curr_inst_id] = {"success_attack": success_attack_history,
-                                                              "failed_attack": failed_attack_history}
-    else:
-        assert len(success_attack_history) == 0
-        rec_attack["failed_attack_ids"].append(curr_inst_id)
-        rec_attack["failed_attack_history"][curr_inst_id] = failed_attack_history
-
-    write_json_file(rec_attack_file, rec_attack)
-
-
-def evaluate_on_few_nerd(model_path, causes_path, prompt_type="ic"):
-    """Evaluate the causal stability of LLM under Few_NERD dataset."""
-    model = LLM(model=model_path, gpu_memory_utilization=0.9, max_model_len=512)
-    sampling_params = SamplingParams(temperature=0, max_tokens=512, stop=["</Instance>"])
-
-    rec_dir = os.path.join("evaluation_results", model_path.split("/")[-1])
-    rec_eval_file = os.path.join(rec_dir, f"few_nerd_naive_evaluation_{prompt_type}.json")
-    if os.path.exists(rec_dir) and os.path.exists(rec_eval_file):
-        rec_eval = read_json_file(rec_eval_file)
-    else:
-        if not os.path.exists(rec_dir):
-            os.makedirs(rec_dir)
-        rec_eval = dict()
-        rec_eval["evaluate_ids"] = list()
-        rec_eval["evaluate_instances"] = dict()
-        rec_eval["right_predict_ids"] = list()
-        rec_eval["right_predict_history"] = dict()
-        rec_eval["wrong_predict_ids"] = list()
-        rec_eval["wrong_predict_history"] = dict()
-
-        few_nerd_path = "datasets/few_nerd.json"
-        few_nerd_insts = read_json_file(few_nerd_path)
-        eval_prompts = list()
-        eval_essentials = list()
-        for inst_id, few_nerd_inst in enumerate(few_nerd_insts):
-            type_label = few_nerd_inst["entity_type"].lower()
-            rec_eval["evaluate_ids"].append(str(inst_id))
-            rec_eval["evaluate_instances"][str(inst_id)] = few_nerd_inst
-            eval_essentials.append((type_label, str(inst_id)))
-
-            sentence = " ".join(few_nerd_inst["sentence"])
-            entity = few_nerd_inst["entity"]["span"]
-            eval_prompt = entity_typing(sentence, entity, prompt_type)
-            eval_prompts.append(eval_prompt)
-
-        eval_outputs = model.generate(eval_prompts, sampling_params)
-        eval_preds = list()
-        for eval_output in eval_outputs:
-            eval_pred = eval_output.outputs[0].text.strip()
-            eval_preds.append(eval_pred)
-
-        assert len(eval_preds) == len(eval_essentials)
-        for idx in range(len(eval_preds)):
-            eval_pred = eval_preds[idx]
-            type_label, inst_id = eval_essentials[idx]
-
-            few_nerd_inst = rec_eval["evaluate_instances"][inst_id]
-            sentence = " ".join(few_nerd_inst["sentence"])
-            entity = few_nerd_inst["entity"]["span"]
-            marked_entity = " ".join(["<e>", entity, "</e>"])
-            marked_sentence = sentence.replace(entity, marked_entity)
-
-            if eval_pred == type_label:
-                rec_eval["right_predict_ids"].append(inst_id)
-                rec_eval["right_predict_history"][inst_id] = {"sentence": marked_sentence,
-                                                              "type_label": type_label,
-                                                              "predict_type": eval_pred}
-            else:
-                rec_eval["wrong_predict_ids"].append(inst_id)
-                rec_eval["wrong_predict_history"][inst_id] = {"sentence": marked_sentence,
-                                                              "type_label": type_label,
-                                                              "predict_type": eval_pred}
-
-        write_json_file(rec_eval_file, rec_eval)
-
-    rec_attack_file = os.path.join(rec_dir, causes_path.split("/")[-1].replace(".json", f"_{prompt_type}.json"))
-    if os.path.exists(rec_attack_file):
-        rec_attack = read_json_file(rec_attack_file)
-    else:
-        rec_attack = dict()
-        rec_attack["success_attack_ids"] = list()
-        rec_attack["success_attack_history"] = dict()
-        rec_attack["failed_attack_ids"] = list()
-        rec_attack["failed_attack_history"] = dict()
-
-    few_nerd_path = "datasets/few_nerd.json"
-    causes = read_json_file(causes_path)
-    entity_types = get_few_nerd_type_info(few_nerd_path)
-
-    attack_prompts = list()
-    attack_essentials = list()
-    for inst_id, few_nerd_inst in rec_eval["evaluate_instances"].items():
-        if inst_id in rec_eval["right_predict_ids"]:
-            if inst_id not in rec_attack["success_attack_ids"]:
-                if inst_id not in rec_attack["failed_attack_ids"]:
-                    type_label = few_nerd_inst["entity_type"].lower()
-                    entity = few_nerd_inst["entity"]["span"]
-                    entity_end_idx = few_nerd_inst["entity"]["end_idx"]
-
-                    for entity_type in entity_types:
-                        if entity_type != type_label:
-                            confounders = causes.get(entity_type)
-                            if confounders is not None:
-                                for confounder in confounders:
-                                    sentence_list_copy = deepcopy(few_nerd_inst["sentence"])
-                                    pos_tags = nltk.pos_tag(sentence_list_copy)
-                                    insert_idx = None
-                                    for candidate_idx in range(entity_end_idx + 1, len(pos_tags)):
-                                        _, pos_tag = pos_tags[candidate_idx]
-                                        if pos_tag[0] == "N":
-                                            insert_idx = candidate_idx
-                                            break
-
-                                    if insert_idx is not None:
-                                        sentence_list_copy.insert(insert_idx, confounder)
-                                    else:
-                                        insert_idx = len(sentence_list_copy) - 1
-                                        sentence_list_copy.insert(insert_idx, confounder)
-
-                                    attack_sentence = " ".join(sentence_list_copy)
-                                    attack_prompt = entity_typing(attack_sentence, entity, prompt_type)
-                                    attack_prompts.append(attack_prompt)
-                                    attack_essentials.append({
-                                        "instance_id": inst_id,
-                                        "confounder": confounder,
-                                        "insert_pos": insert_idx,
-                                        "type_label": type_label,
-                                        "expected_type": f"{entity_type}"})
-
-    attack_prompts = attack_prompts
-    attack_essentials = attack_essentials
-    attack_outputs = model.generate(attack_prompts, sampling_params)
-    attack_preds = list()
-    for attack_output in attack_outputs:
-        attack_pred = attack_output.outputs[0].text.strip()
-        attack_preds.append(attack_pred)
-
-    assert len(attack_preds) == len(attack_essentials)
-    success_attack_history = list()
-    failed_attack_history = list()
-    curr_inst_id = None
-    is_attack = False
-
-    for idx in range(len(attack_preds)):
-        attack_pred = attack_preds[idx]
-        inst_id = attack_essentials[idx]["instance_id"]
-        confounder = attack_essentials[idx]["confounder"]
-        insert_pos = attack_essentials[idx]["insert_pos"]
-        type_label = attack_essentials[idx]["type_label"]
-        expected_type = attack_essentials[idx]["expected_type"]
-
-        few_nerd_inst_copy = deepcopy(rec_eval["evaluate_instances"][inst_id])
-        sentence_list = few_nerd_inst_copy["sentence"]
-        marked_confounder = " ".join(["<c>", confounder, "</c>"])
-        sentence_list.insert(insert_pos, marked_confounder)
-        attack_sentence = " ".join(sentence_list)
-
-        entity = few_nerd_inst_copy["entity"]["span"]
-        marked_entity = " ".join(["<e>", entity, "</e>"])
-        marked_attack_sentence = attack_sentence.replace(entity, marked_entity)
-        attack_history = {"sentence": marked_attack_sentence,
-                          "type_label": type_label,
-                          "expected_type": expected_type,
-                          "prediction_type": attack_pred}
-
-        if inst_id != curr_inst_id:
-            if curr_inst_id is not None:
-                success_attack_history_copy = deepcopy(success_attack_history)
-                failed_attack_history_copy = deepcopy(failed_attack_history)
-                if is_attack:
-                    rec_attack["success_attack_ids"].append(curr_inst_id)
-                    rec_attack["success_attack_history"][curr_inst_id] = {"success_attack": success_attack_history_copy,
-                                                                          "failed_attack": failed_attack_history_copy}
-                else:
-                    assert len(success_attack_history) == 0
-                    rec_attack["failed_attack_ids"].append(curr_inst_id)
-                    rec_attack["failed_attack_history"][curr_inst_id] = failed_attack_history_copy
-
-                success_attack_history.clear()
-                failed_attack_history.clear()
-                curr_inst_id = inst_id
-                is_attack = False
-
-                if attack_pred != type_label:
-                    is_attack = True
-                    success_attack_history.append(attack_history)
-                else:
-                    failed_attack_history.append(attack_history)
-            else:
-                if attack_pred != type_label:
-                    is_attack = True
-                    success_attack_history.append(attack_history)
+                self.model = load_inference_backend(self.backend, self.model_path, **self.backend_options)
+        elif not isinstance(self.model, InferenceBackend):
+            self.model = VllmBackend(self.model_path, model=self.model)
+        return self.model
+
+    def run(self, manifest, batch_size=4096):
+        """Evaluate the (task, prompt type, causes path[, scoring mode]) jobs of a manifest, given as a list or a json file of such lists."""
+        if isinstance(manifest, str):
+            manifest = read_json_file(manifest)
+        if not os.path.exists(self.rec_dir):
+            os.makedirs(self.rec_dir)
+        jobs = [EvaluationJob(self.get_task(task), prompt_type, causes_path, self.rec_dir, *job_options, confidence=self.confidence)
+                for task, prompt_type, causes_path, *job_options in manifest]
+        model = self.load_model(jobs)
+        self.run_naive_evaluations(model, jobs)
+        self.run_attacks(model, jobs, batch_size)
+
+    def run_naive_evaluations(self, model, jobs):
+        """Run the naive evaluations missing for the jobs in one generation, jobs of the same task and prompt type share one."""
+        pending_evals = dict()
+        for job in jobs:
+            if not os.path.exists(job.rec_eval_file) and job.rec_eval_file not in pending_evals:
+                pending_evals[job.rec_eval_file] = (job,) + build_eval_requests(job.task, job.prompt_type)
+
+        prompt_requests = list()
+        for job, _, eval_prompts, _ in pending_evals.values():
+            prompt_requests.extend((eval_prompt, job) for eval_prompt in eval_prompts)
+        eval_answers = iter(answer_requests(model, prompt_requests))
+        for rec_eval_file, (job, rec_eval, _, eval_essentials) in pending_evals.items():
+            record_eval_predictions(job.task, rec_eval, eval_essentials, list(itertools.islice(eval_answers, len(eval_essentials))))
+            replace_json_file(rec_eval_file, rec_eval.to_json())
+
+        rec_evals = {rec_eval_file: rec_eval for rec_eval_file, (_, rec_eval, _, _) in pending_evals.items()}
+        for job in jobs:
+            if job.rec_eval_file not in rec_evals:
+                rec_evals[job.rec_eval_file] = EvaluationRecord(read_json_file(job.rec_eval_file))
+            job.rec_eval = rec_evals[job.rec_eval_file]
+
+    def run_attacks(self, model, jobs, batch_size):
+        """Attack the jobs round robin, every round generates one batch of whole instances of each unfinished job together.
+           Finished batches are logged as they complete, an interrupted run resumes after the last logged batch.
+        """
+        job_batches = list()
+        for job in jobs:
+            job.load_attack_record()
+            job_batches.append((job, job.attack_batches(max(1, batch_size // len(jobs)))))
+
+        while len(job_batches) > 0:
+            round_batches = list()
+            unfinished_job_batches = list()
+            for job, attack_batches in job_batches:
+                attack_batch = next(attack_batches, None)
+                if attack_batch is None:
+                    job.finish_attack_record()
                 else:
-                    failed_attack_history.append(attack_history)
-                curr_inst_id = inst_id
-        else:
-            if attack_pred != type_label:
-                is_attack = True
-                success_attack_history.append(attack_history)
-            else:
-                failed_attack_history.append(attack_history)
+                    round_batches.append((job, attack_batch))
+                    unfinished_job_batches.append((job, attack_batches))
+            job_batches = unfinished_job_batches
+            if len(round_batches) == 0:
+                break
+
+            prompt_requests = list()
+            for job, attack_batch in round_batches:
+                for _, inst_attacks in attack_batch:
+                    prompt_requests.extend((attack_prompt, job) for attack_prompt, _ in inst_attacks)
+            attack_answers = iter(answer_requests(model, prompt_requests))
+            for job, attack_batch in round_batches:
+                num_attacks = sum(len(inst_attacks) for _, inst_attacks in attack_batch)
+                job.record_attack_batch(attack_batch, list(itertools.islice(attack_answers, num_attacks)))
+
+
+def evaluate_task(model, model_path, task, causes_path, prompt_type="ic", scoring_mode="generate", confidence=None):
+    """Evaluate the causal stability of a loaded LLM, a vLLM engine or an inference backend, under the dataset of a task adapter."""
+    EvaluationSession(model_path, model=model, confidence=confidence).run([(task, prompt_type, causes_path, scoring_mode)])
+
+
+def run_sessions(session_manifests, batch_size=4096):
+    """Run the manifests of several sessions concurrently, one thread per (session, manifest), e.g. to evaluate models
+       served by inference servers from one process. An error of any session is raised once all sessions stop.
+    """
+    if len(session_manifests) == 0:
+        return
+    with ThreadPoolExecutor(len(session_manifests)) as executor:
+        futures = [executor.submit(session.run, manifest, batch_size) for session, manifest in session_manifests]
+    for future in futures:
+        future.result()
+
+
+def evaluate_on_semeval(model_path, causes_path, prompt_type="ic", scoring_mode="generate", confidence=None, backend="vllm",
+                        backend_options=None):
+    """Evaluate the causal stability of LLMs under SemEval dataset."""
+    session = EvaluationSession(model_path, confidence=confidence, backend=backend, backend_options=backend_options)
+    session.run([("semeval", prompt_type, causes_path, scoring_mode)])
 
-    if is_attack:
-        rec_attack["success_attack_ids"].append(curr_inst_id)
-        rec_attack["success_attack_history"][curr_inst_id] = {"success_attack": success_attack_history,
-                                                              "failed_attack": failed_attack_history}
-    else:
-        assert len(success_attack_history) == 0
-        rec_attack["failed_attack_ids"].append(curr_inst_id)
-        rec_attack["failed_attack_history"][curr_inst_id] = failed_attack_history
 
-    write_json_file(rec_attack_file, rec_attack)
+def evaluate_on_few_nerd(model_path, causes_path, prompt_type="ic", scoring_mode="generate", confidence=None, backend="vllm",
+                         backend_options=None):
+    """Evaluate the causal stability of LLM under Few_NERD dataset."""
+    session = EvaluationSession(model_path, confidence=confidence, backend=backend, backend_options=backend_options)
+    session.run([("few_nerd", prompt_type, causes_path, scoring_mode)])
 
 
-def evaluate_on_ace05(model_path, causes_path, prompt_type="ic"):
+def evaluate_on_ace05(model_path, causes_path, prompt_type="ic", scoring_mode="generate", confidence=None, backend="vllm",
+                      backend_options=None):
     """Evaluate the causal stability of LLM under ACE 2005 dataset."""
-    model = LLM(model=model_path, gpu_memory_utilization=0.9, max_model_len=600)
-    sampling_params = SamplingParams(temperature=0, max_tokens=600, stop=["</Instance>"])
-
-    rec_dir = os.path.join("evaluation_results", model_path.split("/")[-1])
-    rec_eval_file = os.path.join(rec_dir, f"ace05_naive_evaluation_{prompt_type}.json")
-    if os.path.exists(rec_dir) and os.path.exists(rec_eval_file):
-        rec_eval = read_json_file(rec_eval_file)
-    else:
-        if not os.path.exists(rec_dir):
-            os.makedirs(rec_dir)
-        rec_eval = dict()
-        rec_eval["evaluate_ids"] = list()
-        rec_eval["evaluate_instances"] = dict()
-        rec_eval["right_predict_ids"] = list()
-        rec_eval["right_predict_history"] = dict()
-        rec_eval["wrong_predict_ids"] = list()
-        rec_eval["wrong_predict_history"] = dict()
-
-        ace05_path = "datasets/ace05.json"
-        ace05_insts = read_json_file(ace05_path)
-        eval_prompts = list()
-        eval_essentials = list()
-        for inst_id, ace05_inst in enumerate(ace05_insts):
-            type_label = ace05_inst["event_type"].lower()
-            rec_eval["evaluate_ids"].append(str(inst_id))
-            rec_eval["evaluate_instances"][str(inst_id)] = ace05_inst
-            eval_essentials.append((type_label, str(inst_id)))
-
-            sentence = " ".join(ace05_inst["sentence"])
-            trigger = ace05_inst["trigger"]["text"]
-            eval_prompt = event_detection(sentence, trigger, prompt_type)
-            eval_prompts.append(eval_prompt)
-
-        eval_outputs = model.generate(eval_prompts, sampling_params)
-        eval_preds = list()
-        for eval_output in eval_outputs:
-            eval_pred = eval_output.outputs[0].text.strip()
-            eval_preds.append(eval_pred)
-
-        assert len(eval_preds) == len(eval_essentials)
-        for idx in range(len(eval_preds)):
-            eval_pred = eval_preds[idx]
-            type_label, inst_id = eval_essentials[idx]
-
-            ace05_inst = rec_eval["evaluate_instances"][inst_id]
-            sentence = " ".join(ace05_inst["sentence"])
-            trigger = ace05_inst["trigger"]["text"]
-            marked_trigger = " ".join(["<t>", trigger, "</t>"])
-            marked_sentence = sentence.replace(trigger, marked_trigger)
-
-            if eval_pred == type_label:
-                rec_eval["right_predict_ids"].append(inst_id)
-                rec_eval["right_predict_history"][inst_id] = {"sentence": marked_sentence,
-                                                              "type_label": type_label,
-                                                              "predict_type": eval_pred}
-            else:
-                rec_eval["wrong_predict_ids"].append(inst_id)
-                rec_eval["wrong_predict_history"][inst_id] = {"sentence": marked_sentence,
-                                                              "type_label": type_label,
-                                                              "predict_type": eval_pred}
-
-        write_json_file(rec_eval_file, rec_eval)
-
-    rec_attack_file = os.path.join(rec_dir, causes_path.split("/")[-1].replace(".json", f"_{prompt_type}.json"))
-    if os.path.exists(rec_attack_file):
-        rec_attack = read_json_file(rec_attack_file)
-    else:
-        rec_attack = dict()
-        rec_attack["success_attack_ids"] = list()
-        rec_attack["success_attack_history"] = dict()
-        rec_attack["failed_attack_ids"] = list()
-        rec_attack["failed_attack_history"] = dict()
-
-    ace05_path = "datasets/ace05.json"
-    causes = read_json_file(causes_path)
-    event_subtypes = get_ace05_type_info(ace05_path)
-
-    attack_prompts = list()
-    attack_essentials = list()
-    for inst_id, ace05_inst in rec_eval["evaluate_instances"].items():
-        if inst_id in rec_eval["right_predict_ids"]:
-            if inst_id not in rec_attack["success_attack_ids"]:
-                if inst_id not in rec_attack["failed_attack_ids"]:
-                    type_label = ace05_inst["event_type"].lower()
-                    trigger = ace05_inst["trigger"]["text"]
-                    trigger_end_idx = ace05_inst["trigger"]["end"] - 1
-
-                    for event_subtype in event_subtypes:
-                        if event_subtype not in type_label:
-                            confounders = causes.get(event_subtype)
-                            if confounders is not None:
-                                for confounder in confounders:
-                                    sentence_list_copy = deepcopy(ace05_inst["sentence"])
-                                    pos_tags = nltk.pos_tag(sentence_list_copy)
-                                    insert_idx = None
-                                    for candidate_idx in range(trigger_end_idx + 1, len(pos_tags)):
-                                        _, pos_tag = pos_tags[candidate_idx]
-                                        if pos_tag[0] == "N":
-                                            insert_idx = candidate_idx
-                                            break
-
-                                    if insert_idx is not None:
-                                        sentence_list_copy.insert(insert_idx, confounder)
-                                    else:
-                                        insert_idx = len(sentence_list_copy) - 1
-                                        sentence_list_copy.insert(insert_idx, confounder)
-
-                                    attack_sentence = " ".join(sentence_list_copy)
-                                    attack_prompt = event_detection(attack_sentence, trigger, prompt_type)
-                                    attack_prompts.append(attack_prompt)
-                                    attack_essentials.append({
-                                        "instance_id": inst_id,
-                                        "confounder": confounder,
-                                        "insert_pos": insert_idx,
-                                        "type_label": type_label,
-                                        "expected_type": f"{event_subtype}"})
-
-    attack_outputs = model.generate(attack_prompts, sampling_params)
-    attack_preds = list()
-    for attack_output in attack_outputs:
-        attack_pred = attack_output.outputs[0].text.strip()
-        attack_preds.append(attack_pred)
-
-    assert len(attack_preds) == len(attack_essentials)
-    success_attack_history = list()
-    failed_attack_history = list()
-    curr_inst_id = None
-    is_attack = False
-
-    for idx in range(len(attack_preds)):
-        attack_pred = attack_preds[idx]
-        inst_id = attack_essentials[idx]["instance_id"]
-        confounder = attack_essentials[idx]["confounder"]
-        insert_pos = attack_essentials[idx]["insert_pos"]
-        type_label = attack_essentials[idx]["type_label"]
-        expected_type = attack_essentials[idx]["expected_type"]
-
-        ace05_inst_copy = deepcopy(rec_eval["evaluate_instances"][inst_id])
-        sentence_list = ace05_inst_copy["sentence"]
-        marked_confounder = " ".join(["<c>", confounder, "</c>"])
-        sentence_list.insert(insert_pos, marked_confounder)
-        attack_sentence = " ".join(sentence_list)
-
-        trigger = ace05_inst_copy["trigger"]["text"]
-        marked_trigger = " ".join(["<t>", trigger, "</t>"])
-        marked_attack_sentence = attack_sentence.replace(trigger, marked_trigger)
-        attack_history = {"sentence": marked_attack_sentence,
-                          "type_label": type_label,
-                          "expected_type": expected_type,
-                          "prediction_type": attack_pred}
-
-        if inst_id != curr_inst_id:
-            if curr_inst_id is not None:
-                success_attack_history_copy = deepcopy(success_attack_history)
-                failed_attack_history_copy = deepcopy(failed_attack_history)
-                if is_attack:
-                    rec_attack["success_attack_ids"].append(curr_inst_id)
-                    rec_attack["success_attack_history"][curr_inst_id] = {"success_attack": success_attack_history_copy,
-                                                                          "failed_attack": failed_attack_history_copy}
-                else:
-                    assert len(success_attack_history) == 0
-                    rec_attack["failed_attack_ids"].append(curr_inst_id)
-                    rec_attack["failed_attack_history"][curr_inst_id] = failed_attack_history_copy
-
-                success_attack_history.clear()
-                failed_attack_history.clear()
-                curr_inst_id = inst_id
-                is_attack = False
-
-                if attack_pred != type_label:
-                    is_attack = True
-                    success_attack_history.append(attack_history)
-                else:
-                    failed_attack_history.append(attack_history)
-            else:
-                if attack_pred != type_label:
-                    is_attack = True
-                    success_attack_history.append(attack_history)
-                else:
-                    failed_attack_history.append(attack_history)
-                curr_inst_id = inst_id
-        else:
-            if attack_pred != type_label:
-                is_attack = True
-                success_attack_history.append(attack_history)
-            else:
-                failed_attack_history.append(attack_history)
-
-    if is_attack:
-        rec_attack["success_attack_ids"].append(curr_inst_id)
-        rec_attack["success_attack_history"][curr_inst_id] = {"success_attack": success_attack_history,
-                                                              "failed_attack": failed_attack_history}
-    else:
-        assert len(success_attack_history) == 0
-        rec_attack["failed_attack_ids"].append(curr_inst_id)
-        rec_attack["failed_attack_history"][curr_inst_id] = failed_attack_history
-
-    write_json_file(rec_attack_file, rec_attack)
+    session = EvaluationSession(model_path, confidence=confidence, backend=backend, backend_options=backend_options)
+    session.run([("ace05", prompt_type, causes_path, scoring_mode)])
 
 
 if __name__ == '__main__':
     evaluate_on_semeval("../llms/qwen2-7b-instruct-gptq-int8", "cause_concepts/semeval_qwen2-7b-instruct-gptq-int8_s1.3_t0.3_top10.json", "ic")
     # evaluate_on_few_nerd("../llms/qwen2-7b-instruct-gptq-int8", "cause_concepts/semeval_qwen2-7b-instruct-gptq-int8_s1.3_t0.3_top10.json", "ic")
     # evaluate_on_ace05("../llms/qwen2-7b-instruct-gptq-int8", "cause_concepts/semeval_qwen2-7b-instruct-gptq-int8_s1.3_t0.3_top10.json", "ic")
+    # run_sessions([(EvaluationSession(model_path, backend="openai", backend_options={"base_url": base_url}),
+    #                [("semeval", "ic", "cause_concepts/semeval_qwen2-7b-instruct-gptq-int8_s1.3_t0.3_top10.json")])
+    #               for model_path, base_url in [("../llms/qwen2-7b-instruct-gptq-int8", "http://localhost:8000/v1"),
+    #                                            ("../llms/llama3-8b-instruct", "http://localhost:8001/v1")]])
+    # EvaluationSession("../llms/qwen2-7b-instruct-gptq-int8").run(
+    #     [("semeval", prompt_type, "cause_concepts/semeval_qwen2-7b-instruct-gptq-int8_s1.3_t0.3_top10.json")
+    #      for prompt_type in ["ic", "ic1", "ic3", "ic4", "ic5", "cot"]])
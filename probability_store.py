@@ -0,0 +1,45 @@
+import json
+import sqlite3
+
+
+class ProbabilityStore:
+    """An append-only SQLite store of the span log10 probabilities computed for each model.
+       Rows are only ever inserted, so reruns and sweeps over strength and tolerance reuse earlier results.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS log_probabilities ("
+            " model_id TEXT NOT NULL,"
+            " template TEXT NOT NULL,"
+            " concepts TEXT NOT NULL,"
+            " log_probability REAL NOT NULL,"
+            " PRIMARY KEY (model_id, template, concepts))")
+        self.connection.commit()
+
+    def get(self, key):
+        """Get the stored log probability of a (model id, template, concepts) key, None if it was never stored."""
+        model_id, template, concepts = key
+        row = self.connection.execute(
+            "SELECT log_probability FROM log_probabilities WHERE model_id = ? AND template = ? AND concepts = ?",
+            (model_id, template, json.dumps(list(concepts), ensure_ascii=False))).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_many(self, records):
+        """Append (key, log probability) records, keys that are already stored are left unchanged."""
+        rows = list()
+        for (model_id, template, concepts), log_probability in records:
+            rows.append((model_id, template, json.dumps(list(concepts), ensure_ascii=False), log_probability))
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO log_probabilities VALUES (?, ?, ?, ?)", rows)
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM log_probabilities").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -1,320 +1,330 @@
+import weakref
+from collections import defaultdict
 
 
-def relation_extraction(sentence, head_entity, tail_entity, prompt_type="ic"):
-    """The interface that constitutes prompt to guide llms to conduct relation extraction."""
-    ic_incontext = (
-        "<Instruction> Select the most suitable relation between the given head and tail entities in the"
-        " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are from the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-origin\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are moved to the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-destination\n"
-        "</Instance>\n"
-        "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
+RELATION_IC_INCONTEXT = (
+    "<Instruction> Select the most suitable relation between the given head and tail entities in the"
+    " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are from the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-origin\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are moved to the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-destination\n"
+    "</Instance>\n"
+    "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    ic1_incontext = (
-        "<Instruction> Select the most suitable relation between the given head and tail entities in the"
-        " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are from the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n" 
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-origin\n"
-        "</Instance>\n"
-        "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
+RELATION_IC1_INCONTEXT = (
+    "<Instruction> Select the most suitable relation between the given head and tail entities in the"
+    " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are from the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n" 
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-origin\n"
+    "</Instance>\n"
+    "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    ic3_incontext = (
-        "<Instruction> Select the most suitable relation between the given head and tail entities in the"
-        " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are from the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-origin\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are moved to the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-destination\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These books talk about causal discovery.\n"
-        "Head Entity: books\n"
-        "Tail Entity: causal discovery\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: message-topic\n"
-        "</Instance>\n"
-        "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
+RELATION_IC3_INCONTEXT = (
+    "<Instruction> Select the most suitable relation between the given head and tail entities in the"
+    " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are from the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-origin\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are moved to the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-destination\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These books talk about causal discovery.\n"
+    "Head Entity: books\n"
+    "Tail Entity: causal discovery\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: message-topic\n"
+    "</Instance>\n"
+    "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    ic4_incontext = (
-        "<Instruction> Select the most suitable relation between the given head and tail entities in the"
-        " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are from the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-origin\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are moved to the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-destination\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These books talk about causal discovery.\n"
-        "Head Entity: books\n"
-        "Tail Entity: causal discovery\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: message-topic\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These eggs are contained in the box.\n"
-        "Head Entity: eggs\n"
-        "Tail Entity: box\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: content-container\n"
-        "</Instance>\n"
-        "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
+RELATION_IC4_INCONTEXT = (
+    "<Instruction> Select the most suitable relation between the given head and tail entities in the"
+    " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are from the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-origin\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are moved to the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-destination\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These books talk about causal discovery.\n"
+    "Head Entity: books\n"
+    "Tail Entity: causal discovery\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: message-topic\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These eggs are contained in the box.\n"
+    "Head Entity: eggs\n"
+    "Tail Entity: box\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: content-container\n"
+    "</Instance>\n"
+    "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    ic5_incontext = (
-        "<Instruction> Select the most suitable relation between the given head and tail entities in the"
-        " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are from the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-origin\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are moved to the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: entity-destination\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These books talk about causal discovery.\n"
-        "Head Entity: books\n"
-        "Tail Entity: causal discovery\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: message-topic\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These eggs are contained in the box.\n"
-        "Head Entity: eggs\n"
-        "Tail Entity: box\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: content-container\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: His mistake cause_concepts this accident.\n"
-        "Head Entity: mistake\n"
-        "Tail Entity: accident\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Relation Between the Head Entity and Tail Entity: cause-effect\n"
-        "</Instance>\n"
-        "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
+RELATION_IC5_INCONTEXT = (
+    "<Instruction> Select the most suitable relation between the given head and tail entities in the"
+    " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are from the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-origin\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are moved to the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: entity-destination\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These books talk about causal discovery.\n"
+    "Head Entity: books\n"
+    "Tail Entity: causal discovery\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: message-topic\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These eggs are contained in the box.\n"
+    "Head Entity: eggs\n"
+    "Tail Entity: box\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: content-container\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: His mistake cause_concepts this accident.\n"
+    "Head Entity: mistake\n"
+    "Tail Entity: accident\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity: cause-effect\n"
+    "</Instance>\n"
+    "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    cot_incontext = (
-        "<Instruction> Select the most suitable relation between the given head and tail entities in the"
-        " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are from the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Chain of Thought: Head entity apple is a fruit, which refers to the stuff entity in the"
-        " context. Tail entity store is a place, which refers to the location entity in the context."
-        " According to the context, apples are from the store, indicates that the store is the"
-        " origin of apples, hence the relation between apples and store is entity-origin.\n"
-        "Relation Between the Head Entity and Tail Entity: entity-origin\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: These apples are moved to the store at the corner.\n"
-        "Head Entity: apples\n"
-        "Tail Entity: store\n"
-        "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-        " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-        "Chain of Thought: Head entity apple is a fruit, which refers to the stuff entity in the"
-        " context. Tail entity store is a place, which refers to the location entity in the context."
-        " According to the context, apples are moved to the store, indicates that the store is the"
-        " destination of apples, hence the relation between apples and store is entity-destination.\n"
-        "Relation Between the Head Entity and Tail Entity: entity-destination\n"
-        "</Instance>\n"
-        "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
+RELATION_COT_INCONTEXT = (
+    "<Instruction> Select the most suitable relation between the given head and tail entities in the"
+    " given sentence. The relation type must be chosen from the candidate relations. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are from the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Chain of Thought: Head entity apple is a fruit, which refers to the stuff entity in the"
+    " context. Tail entity store is a place, which refers to the location entity in the context."
+    " According to the context, apples are from the store, indicates that the store is the"
+    " origin of apples, hence the relation between apples and store is entity-origin.\n"
+    "Relation Between the Head Entity and Tail Entity: entity-origin\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: These apples are moved to the store at the corner.\n"
+    "Head Entity: apples\n"
+    "Tail Entity: store\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Chain of Thought: Head entity apple is a fruit, which refers to the stuff entity in the"
+    " context. Tail entity store is a place, which refers to the location entity in the context."
+    " According to the context, apples are moved to the store, indicates that the store is the"
+    " destination of apples, hence the relation between apples and store is entity-destination.\n"
+    "Relation Between the Head Entity and Tail Entity: entity-destination\n"
+    "</Instance>\n"
+    "Hint: complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    ic_prompt = (ic_incontext
-                 + f"Given Sentence: {sentence}\n"
-                 + f"Head Entity: {head_entity}\n"
-                 + f"Tail Entity: {tail_entity}\n"
-                 "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-                 " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-                 "Relation Between the Head Entity and Tail Entity:")
+RELATION_IC_QUERY = (
+    "Given Sentence: {sentence}\n"
+    "Head Entity: {head_entity}\n"
+    "Tail Entity: {tail_entity}\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Relation Between the Head Entity and Tail Entity:")
 
-    ic1_prompt = (ic1_incontext
-                  + f"Given Sentence: {sentence}\n"
-                  + f"Head Entity: {head_entity}\n"
-                  + f"Tail Entity: {tail_entity}\n"
-                  "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-                  " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-                  "Relation Between the Head Entity and Tail Entity:")
+RELATION_COT_QUERY = (
+    "Given Sentence: {sentence}\n"
+    "Head Entity: {head_entity}\n"
+    "Tail Entity: {tail_entity}\n"
+    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
+    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
+    "Chain of Thought:")
 
-    ic3_prompt = (ic3_incontext
-                  + f"Given Sentence: {sentence}\n"
-                  + f"Head Entity: {head_entity}\n"
-                  + f"Tail Entity: {tail_entity}\n"
-                  "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-                  " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-                  "Relation Between the Head Entity and Tail Entity:")
+ENTITY_TYPING_IC_INCONTEXT = (
+    "<Instruction> Based on the contextual semantics of the given sentence, select the most"
+    " suitable entity type for the given entity from the candidate types. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: Michael Jordan is the best basketball player of all time.\n"
+    "Given Entity: Michael Jordan\n"
+    "Candidate Types: actor, author, athlete, director, politician, scholar,"
+    " soldier, airplane, car, food, game, ship, software, weapon\n"
+    "Entity Type of the Given Entity: athlete\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: Spielberg directed the famous movie Titanic 30 years ago.\n"
+    "Given Entity: Spielberg\n"
+    "Candidate Types: actor, author, athlete, director, politician, scholar,"
+    " soldier, airplane, car, food, game, ship, software, weapon\n"
+    "Entity Type of the Given Entity: director\n"
+    "</Instance>\n"
+    "Hint: Complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    ic4_prompt = (ic4_incontext
-                  + f"Given Sentence: {sentence}\n"
-                  + f"Head Entity: {head_entity}\n"
-                  + f"Tail Entity: {tail_entity}\n"
-                  "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-                  " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-                  "Relation Between the Head Entity and Tail Entity:")
+ENTITY_TYPING_IC_QUERY = (
+    "Given Sentence: {sentence}\n"
+    "Given Entity: {entity}\n"
+    "Candidate Types: actor, author, athlete, director, politician, scholar,"
+    " soldier, airplane, car, food, game, ship, software, weapon\n"
+    "Entity Type of the Given Entity:")
 
-    ic5_prompt = (ic5_incontext
-                  + f"Given Sentence: {sentence}\n"
-                  + f"Head Entity: {head_entity}\n"
-                  + f"Tail Entity: {tail_entity}\n"
-                  "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-                  " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-                  "Relation Between the Head Entity and Tail Entity:")
+EVENT_DETECTION_IC_INCONTEXT = (
+    "<Instruction> Based on the contextual semantics of the given sentence, select the most"
+    " suitable event type for the given trigger word from the candidate event types. </Instruction>\n"
+    "<Instance>\n"
+    "Given Sentence: Peter leaved the world last year in the small village.\n"
+    "Given Trigger Word: leaved\n"
+    "Candidate Event Types: conflict:attack, movement:transport, life:die, contact:meet, personnel:end-position,"
+    " transaction:transfer-money, personnel:elect, life:injure, transaction:transfer-ownership, contact:phone-write,"
+    " personnel:start-position, justice:trial-hearing, justice:charge-indict, justice:sentence, justice:arrest-jail,"
+    " conflict:demonstrate, life:marry, justice:convict, Justice:Sue\n"
+    "Event Type of the Given Trigger Word: life:die\n"
+    "</Instance>\n"
+    "<Instance>\n"
+    "Given Sentence: Maria left all her property to her youngest son.\n"
+    "Given Trigger Word: left\n"
+    "Candidate Event Types: conflict:attack, movement:transport, life:die, contact:meet, personnel:end-position,"
+    " transaction:transfer-money, personnel:elect, life:injure, transaction:transfer-ownership, contact:phone-write,"
+    " personnel:start-position, justice:trial-hearing, justice:charge-indict, justice:sentence, justice:arrest-jail,"
+    " conflict:demonstrate, life:marry, justice:convict, Justice:Sue\n"
+    "Event Type of the Given Trigger Word: transaction:transfer-money\n"
+    "</Instance>\n"
+    "Hint: Complete the remaining content and maintain consistency with the format of the above examples.\n"
+    "<Instance>\n")
 
-    cot_prompt = (cot_incontext
-                  + f"Given Sentence: {sentence}\n"
-                  + f"Head Entity: {head_entity}\n"
-                  + f"Tail Entity: {tail_entity}\n"
-                    "Candidate Relations: message-topic, entity-origin, entity-destination, content-container,"
-                    " cause-effect, component-whole, member-collection, instrument-agency, product-producer\n"
-                    "Chain of Thought:")
+EVENT_DETECTION_IC_QUERY = (
+    "Given Sentence: {sentence}\n"
+    "Given Trigger Word: {trigger}\n"
+    "Candidate Event Types: conflict:attack, movement:transport, life:die, contact:meet, personnel:end-position,"
+    " transaction:transfer-money, personnel:elect, life:injure, transaction:transfer-ownership, contact:phone-write,"
+    " personnel:start-position, justice:trial-hearing, justice:charge-indict, justice:sentence, justice:arrest-jail,"
+    " conflict:demonstrate, life:marry, justice:convict, Justice:Sue\n"
+    "Event Type of the Given Trigger Word:")
 
-    if prompt_type == "ic":
-        prompt = ic_prompt
-    elif prompt_type == "ic1":
-        prompt = ic1_prompt
-    elif prompt_type == "ic3":
-        prompt = ic3_prompt
-    elif prompt_type == "ic4":
-        prompt = ic4_prompt
-    elif prompt_type == "ic5":
-        prompt = ic5_prompt
-    elif prompt_type == "cot":
-        prompt = cot_prompt
-    else:
-        raise ValueError("Please select prompt from ic or cot.")
 
-    return prompt
+class PromptTemplate:
+    """A compiled prompt, the in-context prefix shared by every instance followed by the query of one instance.
+       The prefix comes first and never changes, so vLLM prefix caching reuses its KV blocks across prompts,
+       and its token ids are encoded once per tokenizer.
+    """
 
+    def __init__(self, prefix, query):
+        self.prefix = prefix
+        self.query = query
+        self.prefix_ids = weakref.WeakKeyDictionary()
 
-def entity_typing(sentence, entity, prompt_type="ic"):
-    """The interface that constitutes prompt to guide llms to conduct entity typing."""
-    ic_incontext = (
-        "<Instruction> Based on the contextual semantics of the given sentence, select the most"
-        " suitable entity type for the given entity from the candidate types. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: Michael Jordan is the best basketball player of all time.\n"
-        "Given Entity: Michael Jordan\n"
-        "Candidate Types: actor, author, athlete, director, politician, scholar,"
-        " soldier, airplane, car, food, game, ship, software, weapon\n"
-        "Entity Type of the Given Entity: athlete\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: Spielberg directed the famous movie Titanic 30 years ago.\n"
-        "Given Entity: Spielberg\n"
-        "Candidate Types: actor, author, athlete, director, politician, scholar,"
-        " soldier, airplane, car, food, game, ship, software, weapon\n"
-        "Entity Type of the Given Entity: director\n"
-        "</Instance>\n"
-        "Hint: Complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
+    def render(self, **fields):
+        """Render the prompt of an instance from the fields of the query."""
+        return self.prefix + self.query.format(**fields)
 
-    ic_prompt = (ic_incontext
-                 + f"Given Sentence: {sentence}\n"
-                 + f"Given Entity: {entity}\n"
-                 "Candidate Types: actor, author, athlete, director, politician, scholar,"
-                 " soldier, airplane, car, food, game, ship, software, weapon\n"
-                 "Entity Type of the Given Entity:")
+    def get_prefix_ids(self, tokenizer):
+        """Get the token ids of the prefix, or None if the tokenizer merges the prefix with a following query."""
+        if tokenizer not in self.prefix_ids:
+            prefix_ids = tokenizer.encode(self.prefix)
+            probe_query = self.query.format_map(defaultdict(lambda: "test"))
+            if tokenizer.encode(self.prefix + probe_query) != prefix_ids + tokenizer.encode(probe_query, add_special_tokens=False):
+                prefix_ids = None
+            self.prefix_ids[tokenizer] = prefix_ids
+        return self.prefix_ids[tokenizer]
 
-    prompt = ic_prompt
-    return prompt
 
+PROMPT_TEMPLATES = {
+    ("relation_extraction", "ic"): PromptTemplate(RELATION_IC_INCONTEXT, RELATION_IC_QUERY),
+    ("relation_extraction", "ic1"): PromptTemplate(RELATION_IC1_INCONTEXT, RELATION_IC_QUERY),
+    ("relation_extraction", "ic3"): PromptTemplate(RELATION_IC3_INCONTEXT, RELATION_IC_QUERY),
+    ("relation_extraction", "ic4"): PromptTemplate(RELATION_IC4_INCONTEXT, RELATION_IC_QUERY),
+    ("relation_extraction", "ic5"): PromptTemplate(RELATION_IC5_INCONTEXT, RELATION_IC_QUERY),
+    ("relation_extraction", "cot"): PromptTemplate(RELATION_COT_INCONTEXT, RELATION_COT_QUERY),
+    ("entity_typing", "ic"): PromptTemplate(ENTITY_TYPING_IC_INCONTEXT, ENTITY_TYPING_IC_QUERY),
+    ("event_detection", "ic"): PromptTemplate(EVENT_DETECTION_IC_INCONTEXT, EVENT_DETECTION_IC_QUERY),
+}
 
-def event_detection(sentence, trigger, prompt_type="ic"):
-    """The interface that constitutes prompt to guide llms to conduct event detection."""
-    ic_incontext = (
-        "<Instruction> Based on the contextual semantics of the given sentence, select the most"
-        " suitable event type for the given trigger word from the candidate event types. </Instruction>\n"
-        "<Instance>\n"
-        "Given Sentence: Peter leaved the world last year in the small village.\n"
-        "Given Trigger Word: leaved\n"
-        "Candidate Event Types: conflict:attack, movement:transport, life:die, contact:meet, personnel:end-position,"
-        " transaction:transfer-money, personnel:elect, life:injure, transaction:transfer-ownership, contact:phone-write,"
-        " personnel:start-position, justice:trial-hearing, justice:charge-indict, justice:sentence, justice:arrest-jail,"
-        " conflict:demonstrate, life:marry, justice:convict, Justice:Sue\n"
-        "Event Type of the Given Trigger Word: life:die\n"
-        "</Instance>\n"
-        "<Instance>\n"
-        "Given Sentence: Maria left all her property to her youngest son.\n"
-        "Given Trigger Word: left\n"
-        "Candidate Event Types: conflict:attack, movement:transport, life:die, contact:meet, personnel:end-position,"
-        " transaction:transfer-money, personnel:elect, life:injure, transaction:transfer-ownership, contact:phone-write,"
-        " personnel:start-position, justice:trial-hearing, justice:charge-indict, justice:sentence, justice:arrest-jail,"
-        " conflict:demonstrate, life:marry, justice:convict, Justice:Sue\n"
-        "Event Type of the Given Trigger Word: transaction:transfer-money\n"
-        "</Instance>\n"
-        "Hint: Complete the remaining content and maintain consistency with the format of the above examples.\n"
-        "<Instance>\n")
 
-    ic_prompt = (ic_incontext
-                 + f"Given Sentence: {sentence}\n"
-                 + f"Given Trigger Word: {trigger}\n"
-                 "Candidate Event Types: conflict:attack, movement:transport, life:die, contact:meet, personnel:end-position,"
-                 " transaction:transfer-money, personnel:elect, life:injure, transaction:transfer-ownership, contact:phone-write,"
-                 " personnel:start-position, justice:trial-hearing, justice:charge-indict, justice:sentence, justice:arrest-jail,"
-                 " conflict:demonstrate, life:marry, justice:convict, Justice:Sue\n"
-                 "Event Type of the Given Trigger Word:")
+def get_prompt_template(task, prompt_type):
+    """Get the compiled prompt template of a task and prompt type."""
+    if (task, prompt_type) not in PROMPT_TEMPLATES:
+        raise ValueError("Please select prompt from ic or cot.")
+    return PROMPT_TEMPLATES[(task, prompt_type)]
+
+
+def encode_prompt(tokenizer, text):
+    """Encode a text starting with a compiled prompt, only the text after the prefix of its template is encoded."""
+    for template in PROMPT_TEMPLATES.values():
+        if text.startswith(template.prefix):
+            prefix_ids = template.get_prefix_ids(tokenizer)
+            if prefix_ids is not None:
+                return prefix_ids + tokenizer.encode(text[len(template.prefix):], add_special_tokens=False)
+    return tokenizer.encode(text)
+
 
-    prompt = ic_prompt
-    return prompt
+def relation_extraction(sentence, head_entity, tail_entity, prompt_type="ic"):
+    """The interface that constitutes prompt to guide llms to conduct relation extraction."""
+    template = get_prompt_template("relation_extraction", prompt_type)
+    return template.render(sentence=sentence, head_entity=head_entity, tail_entity=tail_entity)
+
+
+def entity_typing(sentence, entity, prompt_type="ic"):
+    """The interface that constitutes prompt to guide llms to conduct entity typing, only the ic prompt is available."""
+    return get_prompt_template("entity_typing", "ic").render(sentence=sentence, entity=entity)
+
+
+def event_detection(sentence, trigger, prompt_type="ic"):
+    """The interface that constitutes prompt to guide llms to conduct event detection, only the ic prompt is available."""
+    return get_prompt_template("event_detection", "ic").render(sentence=sentence, trigger=trigger)
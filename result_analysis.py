@@ -3,6 +3,12 @@ import math
 from file_io import read_json_file
 
 
+def get_instability_bucket(num_wrong, num_attacks):
+    """Get the instability bucket of an attacked instance, it counts as unstable @k for every k up to its bucket."""
+    wrong_ratio = math.ceil(num_wrong / num_attacks * 100)
+    return min(wrong_ratio, 3)
+
+
 def compute_results(eval_path, attack_path):
     eval_file = read_json_file(eval_path)
     attack_file = read_json_file(attack_path)
@@ -17,15 +23,15 @@ def compute_results(eval_path, attack_path):
     for record in attack_file["success_attack_history"].values():
         num_wrong = len(record["success_attack"])
         num_correct = len(record["failed_attack"])
-        wrong_ratio = math.ceil(num_wrong / (num_wrong + num_correct) * 100)
-        if wrong_ratio >= 3:
+        instability_bucket = record.get("instability_bucket", get_instability_bucket(num_wrong, num_wrong + num_correct))
+        if instability_bucket == 3:
             num_at1 += 1
             num_at2 += 1
             num_at3 += 1
-        elif 2 <= wrong_ratio < 3:
+        elif instability_bucket == 2:
             num_at1 += 1
             num_at2 += 1
-        elif 1 <= wrong_ratio < 2:
+        elif instability_bucket == 1:
             num_at1 += 1
 
     instab_at1 = num_at1 / num_eval_right
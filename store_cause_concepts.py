@@ -1,15 +1,24 @@
 import os
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import queue
+import multiprocessing
 
-from file_io import read_json_file, write_json_file
-from llms_causal_discovery import discover_cause_concepts, compute_conditional_probability
+from file_io import read_json_file, write_json_file, replace_json_file
+from conceptnet_utils import get_conceptnet_index
+from probability_store import ProbabilityStore
+from llms_causal_discovery import ProbabilityCache, discover_cause_concepts, build_conditional_prompt, compute_span_log_probabilities
+from inference_backends import load_inference_backend
 
 
-def rank_by_correlation(tokenizer, model, cause_concepts, effect_concept, device="cuda:0"):
+DISCOVERY_WORKER = dict()
+
+
+def rank_by_correlation(tokenizer, model, cause_concepts, effect_concept, batch_size=32, cache=None, device="cuda:0"):
     """Rank the cause concepts by the correlation with effect concept."""
+    correlation_queries = [build_conditional_prompt(effect_concept, cause_concept) for cause_concept in cause_concepts]
+    correlations = compute_span_log_probabilities(tokenizer, model, correlation_queries, batch_size, cache, device=device)
+
     correlation_record = dict()
-    for cause_concept in cause_concepts:
-        correlation = compute_conditional_probability(tokenizer, model, effect_concept, cause_concept, device=device)
+    for cause_concept, correlation in zip(cause_concepts, correlations):
         correlation_record[cause_concept] = correlation
 
     sorted_correlation_record = dict(sorted(correlation_record.items(), key=lambda item: item[1], reverse=True))
@@ -17,11 +26,200 @@ def rank_by_correlation(tokenizer, model, cause_concepts, effect_concept, device
     return sorted_cause_concepts
 
 
-def store_for_semeval(model_path, strength, tolerance, device="cuda:0"):
-    """Store cause concepts for the relation labels of SemEval."""
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForCausalLM.from_pretrained(model_path, device_map=device)
+def discover_and_rank(tokenizer, model, effect_concept, strength, tolerance, batch_size=32, cache=None,
+                      search_options=None, device="cuda:0"):
+    """Discover the cause concepts of an effect concept and rank them, return them with the search stats."""
+    if search_options is None:
+        search_options = dict()
+    search_stats = dict()
+    cause_concepts = discover_cause_concepts(tokenizer, model, effect_concept, strength, tolerance, batch_size, cache,
+                                             stats=search_stats, device=device, **search_options)
+    cause_concepts = rank_by_correlation(tokenizer, model, cause_concepts, effect_concept, batch_size, cache, device=device)
+    return effect_concept, cause_concepts, search_stats
+
+
+def get_store_file_path(task_name, model_path, strength, tolerance, search_options=None):
+    """Get the file path of the cause concepts of a task, the search options other than the defaults are named in the file,
+       so that runs with other search options neither overwrite nor resume from each other.
+    """
+    if search_options is None:
+        search_options = dict()
+    store_file_parts = [task_name, model_path.split("/")[-1], f"s{strength}", f"t{tolerance}"]
+    if search_options.get("search_mode", "exhaustive") != "exhaustive":
+        store_file_parts.append(search_options["search_mode"])
+    for option_name in ["max_candidates", "max_pairs"]:
+        if search_options.get(option_name) is not None:
+            store_file_parts.append(f"{option_name}{search_options[option_name]}")
+    if search_options.get("candidate_mode", "related") != "related":
+        store_file_parts.append(search_options["candidate_mode"])
+        candidate_options = search_options.get("candidate_options")
+        if candidate_options is None:
+            candidate_options = dict()
+        for option_name in sorted(candidate_options.keys()):
+            store_file_parts.append(f"{option_name}{candidate_options[option_name]}")
+    store_file = "_".join(store_file_parts) + ".json"
+    return os.path.join("cause_concepts", store_file)
+
+
+def load_checkpoint(store_file_path):
+    """Load the cause concepts already discovered by an interrupted run."""
+    checkpoint_file_path = store_file_path.replace(".json", "_checkpoint.json")
+    if os.path.exists(checkpoint_file_path):
+        return checkpoint_file_path, read_json_file(checkpoint_file_path)
+    return checkpoint_file_path, dict()
+
+
+def load_search_stats(store_file_path):
+    """Load the search stats recorded for each effect concept, which are stored next to the cause concepts."""
+    stats_file_path = store_file_path.replace(".json", "_stats.json")
+    if os.path.exists(stats_file_path):
+        return stats_file_path, read_json_file(stats_file_path)
+    return stats_file_path, dict()
+
+
+def finish_checkpoint(checkpoint_file_path, store_file_path, effect_concepts, cause_concepts_record):
+    """Store the cause concepts in the order of effect concepts and remove the checkpoint."""
+    cause_concepts_record = {effect_concept: cause_concepts_record[effect_concept] for effect_concept in effect_concepts}
+    write_json_file(store_file_path, cause_concepts_record)
+    if os.path.exists(checkpoint_file_path):
+        os.remove(checkpoint_file_path)
+
+
+def store_cause_concepts_record(tokenizer, model, effect_concepts, store_file_path, strength, tolerance, batch_size=32,
+                                cache=None, search_options=None, device="cuda:0"):
+    """Discover and rank the cause concepts of each effect concept, then store them.
+       Search options are passed to discover_cause_concepts, the search stats of each effect concept are stored too.
+       A checkpoint is written after each effect concept so that an interrupted run resumes where it stopped.
+    """
+    checkpoint_file_path, cause_concepts_record = load_checkpoint(store_file_path)
+    stats_file_path, search_stats_record = load_search_stats(store_file_path)
+
+    for effect_concept in effect_concepts:
+        if effect_concept in cause_concepts_record:
+            continue
+        _, cause_concepts, search_stats = discover_and_rank(tokenizer, model, effect_concept, strength, tolerance,
+                                                            batch_size, cache, search_options, device=device)
+        search_stats_record[effect_concept] = search_stats
+        replace_json_file(stats_file_path, search_stats_record)
+        cause_concepts_record[effect_concept] = cause_concepts
+        replace_json_file(checkpoint_file_path, cause_concepts_record)
+
+    if cache is not None:
+        print("probability cache:", cache.stats())
+
+    finish_checkpoint(checkpoint_file_path, store_file_path, effect_concepts, cause_concepts_record)
+
+
+def load_discovery_backend(backend, model_path, device="cuda:0", backend_options=None):
+    """Load the inference backend that scores the concept spans of discovery, the device only places hf models.
+       Backend options are passed to the backend, e.g. {"share_prefix": False} turns off KV prefix reuse of hf models.
+    """
+    backend_options = dict(backend_options) if backend_options is not None else dict()
+    if backend == "hf":
+        backend_options["device"] = device
+    return load_inference_backend(backend, model_path, **backend_options)
+
+
+def init_discovery_worker(model_path, device_queue, cache_size, backend="hf", backend_options=None):
+    """Load a model replica on the device assigned to this worker process. A failure is kept and raised by the first
+       task of the worker, as the pool would otherwise respawn the worker, which then finds no device left.
+    """
+    try:
+        device = device_queue.get(timeout=60)
+        inference_backend = load_discovery_backend(backend, model_path, device, backend_options)
+    except queue.Empty:
+        DISCOVERY_WORKER["error"] = RuntimeError("Please check the discovery workers, no device is left for this worker.")
+        return
+    except Exception as error:
+        DISCOVERY_WORKER["error"] = error
+        return
+
+    DISCOVERY_WORKER["device"] = getattr(inference_backend, "device", "cpu")
+    DISCOVERY_WORKER["tokenizer"] = inference_backend.tokenizer
+    DISCOVERY_WORKER["model"] = inference_backend
+    DISCOVERY_WORKER["cache"] = open_probability_cache(inference_backend.name_or_path, cache_size)
+
+
+def discover_in_worker(effect_concept, strength, tolerance, batch_size, search_options):
+    """Discover and rank the cause concepts of an effect concept with the model replica of this worker process."""
+    if "error" in DISCOVERY_WORKER:
+        raise DISCOVERY_WORKER["error"]
+    tokenizer = DISCOVERY_WORKER["tokenizer"]
+    model = DISCOVERY_WORKER["model"]
+    cache = DISCOVERY_WORKER["cache"]
+    device = DISCOVERY_WORKER["device"]
+    return discover_and_rank(tokenizer, model, effect_concept, strength, tolerance, batch_size, cache, search_options,
+                             device=device)
+
 
+def discover_in_worker_task(task):
+    """Unpack a task for discover_in_worker."""
+    return discover_in_worker(*task)
+
+
+def store_cause_concepts_record_in_parallel(model_path, effect_concepts, store_file_path, strength, tolerance, devices,
+                                            batch_size=32, cache_size=1000000, search_options=None, backend="hf", backend_options=None):
+    """Discover the cause concepts of independent effect concepts with one worker process per listed device.
+       A device can be listed several times to share it between replicas, CUDA devices fall back to CPU if unavailable.
+       Workers share the persistent probability store, results are merged into the same checkpoint and store file.
+    """
+    checkpoint_file_path, cause_concepts_record = load_checkpoint(store_file_path)
+    stats_file_path, search_stats_record = load_search_stats(store_file_path)
+    pending_concepts = [effect_concept for effect_concept in effect_concepts if effect_concept not in cause_concepts_record]
+    if len(pending_concepts) == 0:
+        finish_checkpoint(checkpoint_file_path, store_file_path, effect_concepts, cause_concepts_record)
+        return
+
+    # Build or refresh the ConceptNet index once here, the workers then only map it.
+    get_conceptnet_index()
+
+    context = multiprocessing.get_context("spawn")
+    device_queue = context.Queue()
+    for device in devices:
+        device_queue.put(device)
+
+    with context.Pool(len(devices), initializer=init_discovery_worker,
+                      initargs=(model_path, device_queue, cache_size, backend, backend_options)) as pool:
+        tasks = [(effect_concept, strength, tolerance, batch_size, search_options) for effect_concept in pending_concepts]
+        for effect_concept, cause_concepts, search_stats in pool.imap_unordered(discover_in_worker_task, tasks):
+            search_stats_record[effect_concept] = search_stats
+            replace_json_file(stats_file_path, search_stats_record)
+            cause_concepts_record[effect_concept] = cause_concepts
+            replace_json_file(checkpoint_file_path, cause_concepts_record)
+    device_queue.close()
+    device_queue.join_thread()
+
+    finish_checkpoint(checkpoint_file_path, store_file_path, effect_concepts, cause_concepts_record)
+
+
+def open_probability_cache(model_path, cache_size=1000000):
+    """Open the probability cache of a model, backed by its persistent store in the probability_store folder."""
+    os.makedirs("probability_store", exist_ok=True)
+    store_file_path = os.path.join("probability_store", model_path.split("/")[-1] + ".sqlite")
+    return ProbabilityCache(cache_size, ProbabilityStore(store_file_path))
+
+
+def run_discovery(model_path, effect_concepts, store_file_path, strength, tolerance, batch_size=32, cache_size=1000000,
+                  device="cuda:0", devices=None, search_options=None, backend="hf", backend_options=None):
+    """Run discovery in this process on device, or across worker processes if several devices are listed.
+       The backend is the name of the inference backend that scores concept spans, hf runs the model in process.
+    """
+    if devices is not None and len(devices) > 1:
+        store_cause_concepts_record_in_parallel(model_path, effect_concepts, store_file_path, strength, tolerance, devices,
+                                                batch_size, cache_size, search_options, backend, backend_options)
+    else:
+        if devices is not None:
+            device = devices[0]
+        inference_backend = load_discovery_backend(backend, model_path, device, backend_options)
+        device = getattr(inference_backend, "device", device)
+        cache = open_probability_cache(inference_backend.name_or_path, cache_size)
+        store_cause_concepts_record(inference_backend.tokenizer, inference_backend, effect_concepts, store_file_path, strength,
+                                    tolerance, batch_size, cache, search_options, device=device)
+
+
+def store_for_semeval(model_path, strength, tolerance, batch_size=32, cache_size=1000000, device="cuda:0", devices=None,
+                      search_options=None, backend="hf", backend_options=None):
+    """Store cause concepts for the relation labels of SemEval."""
     samples = read_json_file("datasets/semeval.json")
     effect_concepts = list()
     for sample in samples:
@@ -31,22 +229,14 @@ def store_for_semeval(model_path, strength, tolerance, device="cuda:0"):
                 if effect_concept not in effect_concepts:
                     effect_concepts.append(effect_concept)
 
-    cause_concepts_record = dict()
-    for effect_concept in effect_concepts:
-        cause_concepts = discover_cause_concepts(tokenizer, model, effect_concept, strength, tolerance, device=device)
-        cause_concepts = rank_by_correlation(tokenizer, model, cause_concepts, effect_concept, device=device)
-        cause_concepts_record[effect_concept] = cause_concepts
-
-    store_file = "_".join(["semeval", model_path.split("/")[-1], f"s{strength}", f"t{tolerance}.json"])
-    store_file_path = os.path.join("cause_concepts", store_file)
-    write_json_file(store_file_path, cause_concepts_record)
+    store_file_path = get_store_file_path("semeval", model_path, strength, tolerance, search_options)
+    run_discovery(model_path, effect_concepts, store_file_path, strength, tolerance, batch_size, cache_size, device, devices,
+                  search_options, backend, backend_options)
 
 
-def store_for_few_nerd(model_path, strength, tolerance, device="cuda:0"):
+def store_for_few_nerd(model_path, strength, tolerance, batch_size=32, cache_size=1000000, device="cuda:0", devices=None,
+                       search_options=None, backend="hf", backend_options=None):
     """Store cause concepts for the entity types of Few-NERD."""
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForCausalLM.from_pretrained(model_path, device_map=device)
-
     samples = read_json_file("datasets/few_nerd.json")
     effect_concepts = list()
     for sample in samples:
@@ -55,22 +245,14 @@ def store_for_few_nerd(model_path, strength, tolerance, device="cuda:0"):
         if effect_concept not in effect_concepts:
             effect_concepts.append(effect_concept)
 
-    cause_concepts_record = dict()
-    for effect_concept in effect_concepts:
-        cause_concepts = discover_cause_concepts(tokenizer, model, effect_concept, strength, tolerance, device=device)
-        cause_concepts = rank_by_correlation(tokenizer, model, cause_concepts, effect_concept, device=device)
-        cause_concepts_record[effect_concept] = cause_concepts
+    store_file_path = get_store_file_path("few_nerd", model_path, strength, tolerance, search_options)
+    run_discovery(model_path, effect_concepts, store_file_path, strength, tolerance, batch_size, cache_size, device, devices,
+                  search_options, backend, backend_options)
 
-    store_file = "_".join(["few_nerd", model_path.split("/")[-1], f"s{strength}", f"t{tolerance}.json"])
-    store_file_path = os.path.join("cause_concepts", store_file)
-    write_json_file(store_file_path, cause_concepts_record)
 
-
-def store_for_ace05(model_path, strength, tolerance, device="cuda:0"):
+def store_for_ace05(model_path, strength, tolerance, batch_size=32, cache_size=1000000, device="cuda:0", devices=None,
+                    search_options=None, backend="hf", backend_options=None):
     """Store cause concepts for the event types of ACE 2005."""
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForCausalLM.from_pretrained(model_path, device_map=device)
-
     samples = read_json_file("datasets/ace05.json")
     effect_concepts = list()
     for sample in samples:
@@ -88,15 +270,9 @@ def store_for_ace05(model_path, strength, tolerance, device="cuda:0"):
                 if effect_concept not in effect_concepts:
                     effect_concepts.append(effect_concept)
 
-    cause_concepts_record = dict()
-    for effect_concept in effect_concepts:
-        cause_concepts = discover_cause_concepts(tokenizer, model, effect_concept, strength, tolerance, device=device)
-        cause_concepts = rank_by_correlation(tokenizer, model, cause_concepts, effect_concept, device=device)
-        cause_concepts_record[effect_concept] = cause_concepts
-
-    store_file = "_".join(["ace05", model_path.split("/")[-1], f"s{strength}", f"t{tolerance}.json"])
-    store_file_path = os.path.join("cause_concepts", store_file)
-    write_json_file(store_file_path, cause_concepts_record)
+    store_file_path = get_store_file_path("ace05", model_path, strength, tolerance, search_options)
+    run_discovery(model_path, effect_concepts, store_file_path, strength, tolerance, batch_size, cache_size, device, devices,
+                  search_options, backend, backend_options)
 
 
 def select_top_n(file_path, top_n):
@@ -117,7 +293,12 @@ def select_top_n(file_path, top_n):
 
 
 if __name__ == '__main__':
-    store_for_semeval("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, "cuda:0")
-    # store_for_few_nerd("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, "cuda:0")
-    # store_for_ace05("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, "cuda:0")
+    store_for_semeval("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, 32, 1000000, "cuda:0")
+    # store_for_few_nerd("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, 32, 1000000, "cuda:0")
+    # store_for_ace05("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, 32, 1000000, devices=["cuda:0", "cuda:1"])
+    # store_for_ace05("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, 32, 1000000, "cuda:0",
+    #                 search_options={"search_mode": "ordered", "max_candidates": 40})
+    # store_for_semeval("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, 32, 1000000, backend="vllm")
+    # store_for_few_nerd("../llms/qwen2-7b-instruct-gptq-int8", 1.3, 0.3, 32, 1000000, "cuda:0",
+    #                    search_options={"candidate_mode": "expanded", "candidate_options": {"max_hops": 2, "max_concepts": 200}})
     select_top_n("cause_concepts/semeval_qwen2-7b-instruct-gptq-int8_s1.3_t0.3.json", 10)
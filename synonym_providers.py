@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import requests
+
+from conceptnet_utils import get_synonym_concepts_batch
+
+
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class ConceptNetSynonyms:
+    """Offline synonyms from the Synonym edges of the memory-mapped ConceptNet index."""
+
+    name = "conceptnet"
+
+    def get_synonyms_batch(self, words):
+        """Get the synonyms of each word."""
+        return get_synonym_concepts_batch(words)
+
+
+class DatamuseSynonyms:
+    """Remote synonyms from the datamuse api, a request times out after timeout seconds and failed requests
+       are retried up to max retries times with exponential backoff.
+    """
+
+    name = "datamuse"
+
+    def __init__(self, base_url="https://api.datamuse.com", timeout=10, max_retries=3, retry_backoff=1.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.session = requests.Session()
+
+    def get_synonyms(self, word):
+        """Get the synonyms of a word."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(f"{self.base_url}/words", params={"rel_syn": word}, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return [entry["word"] for entry in response.json()]
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            time.sleep(self.retry_backoff * 2 ** attempt * (0.5 + random.random() / 2))
+
+    def get_synonyms_batch(self, words):
+        """Get the synonyms of each word, one request per word."""
+        return [self.get_synonyms(word) for word in words]
+
+
+class SynonymStore:
+    """An append-only SQLite store of the synonyms looked up from each provider."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS synonyms ("
+            " provider TEXT NOT NULL,"
+            " word TEXT NOT NULL,"
+            " synonyms TEXT NOT NULL,"
+            " PRIMARY KEY (provider, word))")
+        self.connection.commit()
+
+    def get_many(self, provider, words):
+        """Get the stored synonyms of the words of a provider as a dict, words never stored are left out."""
+        stored_synonyms = dict()
+        for word in words:
+            row = self.connection.execute("SELECT synonyms FROM synonyms WHERE provider = ? AND word = ?", (provider, word)).fetchone()
+            if row is not None:
+                stored_synonyms[word] = json.loads(row[0])
+        return stored_synonyms
+
+    def put_many(self, provider, word_synonyms):
+        """Append the synonyms of words of a provider, words that are already stored are left unchanged."""
+        rows = [(provider, word, json.dumps(synonyms, ensure_ascii=False)) for word, synonyms in word_synonyms.items()]
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO synonyms VALUES (?, ?, ?)", rows)
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM synonyms").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedSynonyms:
+    """Cache the synonyms of a provider in memory, in front of an optional persistent store,
+       so that each distinct word is only looked up from the provider once.
+    """
+
+    def __init__(self, provider, store=None):
+        self.provider = provider
+        self.store = store
+        self.cache = dict()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get_synonyms_batch(self, words):
+        """Get the synonyms of each word, the words missed by the cache and the store are looked up in one batch."""
+        missed_words = list(dict.fromkeys(word for word in words if word not in self.cache))
+        self.hits += len(words) - len(missed_words)
+        if len(missed_words) > 0 and self.store is not None:
+            stored_synonyms = self.store.get_many(self.provider.name, missed_words)
+            self.store_hits += len(stored_synonyms)
+            self.cache.update(stored_synonyms)
+            missed_words = [word for word in missed_words if word not in stored_synonyms]
+        if len(missed_words) > 0:
+            self.misses += len(missed_words)
+            looked_up_synonyms = dict(zip(missed_words, self.provider.get_synonyms_batch(missed_words)))
+            self.cache.update(looked_up_synonyms)
+            if self.store is not None:
+                self.store.put_many(self.provider.name, looked_up_synonyms)
+        return [list(self.cache[word]) for word in words]
+
+    def stats(self):
+        """Report the hit and miss counts of the cache."""
+        return {"hits": self.hits, "store_hits": self.store_hits, "misses": self.misses, "size": len(self.cache)}
+
+
+SYNONYM_PROVIDERS = {
+    "conceptnet": ConceptNetSynonyms,
+    "datamuse": DatamuseSynonyms,
+}
+
+
+def load_synonym_provider(provider_name="conceptnet", persistent=None, **provider_options):
+    """Load a synonym provider by its name behind a cache. The cache is persisted to synonym_store/<provider>.sqlite
+       if persistent, which defaults to remote providers only.
+    """
+    if provider_name not in SYNONYM_PROVIDERS:
+        raise ValueError("Please select synonym provider from conceptnet or datamuse.")
+    provider = SYNONYM_PROVIDERS[provider_name](**provider_options)
+    if persistent is None:
+        persistent = provider_name != "conceptnet"
+    store = None
+    if persistent:
+        os.makedirs("synonym_store", exist_ok=True)
+        store = SynonymStore(os.path.join("synonym_store", f"{provider_name}.sqlite"))
+    return CachedSynonyms(provider, store)
@@ -0,0 +1,350 @@
+import os
+import nltk
+from collections import namedtuple
+
+from file_io import read_json_file, replace_json_file, get_file_signature
+from query_interface import relation_extraction, entity_typing, event_detection
+
+
+def get_semeval_relation_info(samples):
+    """Obtain all relations and roles from SemEval."""
+    head_roles = list()
+    tail_roles = list()
+
+    for sample in samples:
+        relation = sample["relation_type"].lower()
+        if relation != "other":
+            head_role, tail_role = relation.split("-")
+            if head_role not in head_roles:
+                head_roles.append(head_role)
+            if tail_role not in tail_roles:
+                tail_roles.append(tail_role)
+
+    return head_roles, tail_roles
+
+
+def get_few_nerd_type_info(samples):
+    """Obtain all entity types from Few-NERD."""
+    entity_types = list()
+
+    for sample in samples:
+        entity_type = sample["entity_type"].lower()
+        if entity_type not in entity_types:
+            entity_types.append(entity_type)
+
+    return entity_types
+
+
+def get_ace05_type_info(samples):
+    """Obtain all event types from ACE 2005."""
+    event_subtypes = list()
+
+    for sample in samples:
+        event_type = sample["event_type"].lower()
+        split_contents = event_type.split(":")
+        for split_content in split_contents:
+            if "-" in split_content:
+                sub_split_contents = split_content.split("-")
+                for sub_split_content in sub_split_contents:
+                    if sub_split_content not in event_subtypes:
+                        event_subtypes.append(sub_split_content)
+            else:
+                if split_content not in event_subtypes:
+                    event_subtypes.append(split_content)
+
+    return event_subtypes
+
+
+def find_insert_index(pos_tags, end_idx):
+    """Find where a confounder is inserted: the first noun after the end idx, otherwise before the last token."""
+    for candidate_idx in range(end_idx + 1, len(pos_tags)):
+        _, pos_tag = pos_tags[candidate_idx]
+        if pos_tag[0] == "N":
+            return candidate_idx
+    return len(pos_tags) - 1
+
+
+def get_insert_indexes(dataset_path, insts, get_end_idx):
+    """Get the confounder insert index of every instance of a dataset, keyed by instance id.
+       Each sentence is POS tagged once and the indexes are cached next to the dataset, the cache is rebuilt
+       when the dataset or nltk changes.
+    """
+    cache_path = dataset_path.replace(".json", "_insert_indexes.json")
+    signature = {"dataset": get_file_signature(dataset_path), "nltk": nltk.__version__}
+    if os.path.exists(cache_path):
+        insert_cache = read_json_file(cache_path)
+        if insert_cache["signature"] == signature:
+            return insert_cache["insert_indexes"]
+
+    all_pos_tags = nltk.pos_tag_sents([inst["sentence"] for inst in insts])
+    insert_indexes = dict()
+    for inst_id, (inst, pos_tags) in enumerate(zip(insts, all_pos_tags)):
+        insert_indexes[str(inst_id)] = find_insert_index(pos_tags, get_end_idx(inst))
+    replace_json_file(cache_path, {"signature": signature, "insert_indexes": insert_indexes})
+    return insert_indexes
+
+
+AttackVariant = namedtuple("AttackVariant", ["instance_id", "insert_idx", "confounder", "expected"])
+
+
+class AttackSentence:
+    """Immutable tokens of an instance with its marked spans, the plain and marked attack sentences are rendered
+       around the prefix and suffix joins of an insert index, which are computed once per index.
+    """
+
+    def __init__(self, tokens, marks):
+        self.tokens = tuple(tokens)
+        marked_tokens = list(self.tokens)
+        for start_idx, end_idx, tag in marks:
+            marked_tokens[start_idx] = f"<{tag}> {marked_tokens[start_idx]}"
+            marked_tokens[end_idx] = f"{marked_tokens[end_idx]} </{tag}>"
+        self.marked_tokens = tuple(marked_tokens)
+        self.joins = dict()
+        self.marked_joins = dict()
+
+    @staticmethod
+    def get_joins(tokens, joins, insert_idx):
+        """Get the prefix and suffix joins around an insert index, with the spaces next to the inserted word."""
+        if insert_idx not in joins:
+            prefix = " ".join(tokens[:insert_idx]) + " " if insert_idx > 0 else ""
+            suffix = " " + " ".join(tokens[insert_idx:]) if insert_idx < len(tokens) else ""
+            joins[insert_idx] = (prefix, suffix)
+        return joins[insert_idx]
+
+    def render(self, variant):
+        """Render the sentence with the confounder of a variant inserted."""
+        prefix, suffix = self.get_joins(self.tokens, self.joins, variant.insert_idx)
+        return prefix + variant.confounder + suffix
+
+    def mark(self, variant=None):
+        """Render the sentence with its spans marked, and the confounder of a variant marked if given."""
+        if variant is None:
+            return " ".join(self.marked_tokens)
+        prefix, suffix = self.get_joins(self.marked_tokens, self.marked_joins, variant.insert_idx)
+        return f"{prefix}<c> {variant.confounder} </c>{suffix}"
+
+
+class TaskAdapter:
+    """Describe how the instances of a dataset are labeled, prompted, attacked and recorded.
+       The evaluation engine in main.py is shared by all tasks, a new dataset only needs a new adapter.
+       An attack variant is an (instance id, insert idx, confounder, expected label) tuple over the tokens of its instance.
+    """
+
+    name = None
+    dataset_path = None
+    max_tokens = 512
+    label_key = "type_label"
+    predict_key = "predict_type"
+    expected_key = "expected_type"
+    prediction_key = "prediction_type"
+
+    def __init__(self):
+        self.insts = read_json_file(self.dataset_path)
+
+    def is_evaluated(self, inst):
+        """Check whether an instance takes part in the evaluation."""
+        return True
+
+    def get_label(self, inst):
+        """Get the gold label of an instance."""
+        raise NotImplementedError
+
+    def get_candidate_labels(self):
+        """Get the labels a prediction is chosen from by the constrained scoring modes, the gold labels of the evaluated instances."""
+        candidate_labels = dict()
+        for inst in self.insts:
+            if self.is_evaluated(inst):
+                candidate_labels[self.get_label(inst)] = None
+        return list(candidate_labels)
+
+    def build_prompt(self, sentence, inst, prompt_type):
+        """Build the prompt asking for the label of an instance, whose sentence may carry a confounder."""
+        raise NotImplementedError
+
+    def parse_answer(self, output_text, prompt_type):
+        """Parse the predicted label from the generated text."""
+        return output_text.strip()
+
+    def get_marks(self, inst):
+        """Get the (start idx, end idx, tag) token spans marked in the recorded sentences of an instance."""
+        raise NotImplementedError
+
+    def build_attack_sentence(self, inst):
+        """Build the attack sentence of an instance, its spans are marked by token index."""
+        return AttackSentence(inst["sentence"], self.get_marks(inst))
+
+    def generate_variants(self, inst_id, inst, causes):
+        """Yield the attack variants of an instance, one per confounder of every alternative label."""
+        raise NotImplementedError
+
+    def build_eval_history(self, inst, label, pred):
+        """Build the record of a naive prediction."""
+        return {"sentence": self.build_attack_sentence(inst).mark(),
+                self.label_key: label,
+                self.predict_key: pred}
+
+    def build_attack_history(self, attack_sentence, label, variant, pred):
+        """Build the record of an attack prediction."""
+        return {"sentence": attack_sentence.mark(variant),
+                self.label_key: label,
+                self.expected_key: variant.expected,
+                self.prediction_key: pred}
+
+
+class SemEvalTask(TaskAdapter):
+    """Relation extraction on SemEval, confounders of other roles are inserted before the head or tail entity."""
+
+    name = "semeval"
+    dataset_path = "datasets/semeval.json"
+    label_key = "relation_label"
+    predict_key = "predict_relation"
+    expected_key = "expected_relation"
+    prediction_key = "prediction_relation"
+
+    def __init__(self):
+        super().__init__()
+        self.head_roles, self.tail_roles = get_semeval_relation_info(self.insts)
+
+    def is_evaluated(self, inst):
+        return self.get_label(inst) != "other"
+
+    def get_label(self, inst):
+        return inst["relation_type"].lower()
+
+    def build_prompt(self, sentence, inst, prompt_type):
+        return relation_extraction(sentence, inst["head_entity"]["span"], inst["tail_entity"]["span"], prompt_type)
+
+    def parse_answer(self, output_text, prompt_type):
+        answer = output_text.strip()
+        if prompt_type == "cot":
+            answer = answer.split("Relation Between the Head Entity and Tail Entity:")[-1].strip()
+        return answer
+
+    def get_marks(self, inst):
+        return [(inst["head_entity"]["start_idx"], inst["head_entity"]["end_idx"], "h"),
+                (inst["tail_entity"]["start_idx"], inst["tail_entity"]["end_idx"], "t")]
+
+    def generate_variants(self, inst_id, inst, causes):
+        h_entity_role, t_entity_role = self.get_label(inst).split("-")
+        for head_role in self.head_roles:
+            if head_role != h_entity_role:
+                for confounder in causes.get(head_role, list()):
+                    yield AttackVariant(inst_id, inst["head_entity"]["start_idx"], confounder, f"{head_role}-x")
+        for tail_role in self.tail_roles:
+            if tail_role != t_entity_role:
+                for confounder in causes.get(tail_role, list()):
+                    yield AttackVariant(inst_id, inst["tail_entity"]["start_idx"], confounder, f"x-{tail_role}")
+
+
+class TypingTask(TaskAdapter):
+    """Typing of one marked span, confounders of other types are inserted at the first noun after the span."""
+
+    span_tag = None
+
+    def __init__(self):
+        super().__init__()
+        self.types = self.get_types()
+        self.insert_indexes = None
+
+    def get_types(self):
+        """Get the types that confounders are drawn for."""
+        raise NotImplementedError
+
+    def get_span(self, inst):
+        """Get the text of the typed span."""
+        raise NotImplementedError
+
+    def get_start_idx(self, inst):
+        """Get the index of the first token of the typed span."""
+        raise NotImplementedError
+
+    def get_end_idx(self, inst):
+        """Get the index of the last token of the typed span."""
+        raise NotImplementedError
+
+    def is_alternative(self, candidate_type, label):
+        """Check whether a type differs from the label of an instance."""
+        return candidate_type != label
+
+    def get_marks(self, inst):
+        return [(self.get_start_idx(inst), self.get_end_idx(inst), self.span_tag)]
+
+    def generate_variants(self, inst_id, inst, causes):
+        if self.insert_indexes is None:
+            self.insert_indexes = get_insert_indexes(self.dataset_path, self.insts, self.get_end_idx)
+        type_label = self.get_label(inst)
+        insert_idx = self.insert_indexes[inst_id]
+        for candidate_type in self.types:
+            if self.is_alternative(candidate_type, type_label):
+                for confounder in causes.get(candidate_type, list()):
+                    yield AttackVariant(inst_id, insert_idx, confounder, candidate_type)
+
+
+class FewNerdTask(TypingTask):
+    """Entity typing on Few-NERD."""
+
+    name = "few_nerd"
+    dataset_path = "datasets/few_nerd.json"
+    span_tag = "e"
+
+    def get_types(self):
+        return get_few_nerd_type_info(self.insts)
+
+    def get_label(self, inst):
+        return inst["entity_type"].lower()
+
+    def get_span(self, inst):
+        return inst["entity"]["span"]
+
+    def get_start_idx(self, inst):
+        return inst["entity"]["start_idx"]
+
+    def get_end_idx(self, inst):
+        return inst["entity"]["end_idx"]
+
+    def build_prompt(self, sentence, inst, prompt_type):
+        return entity_typing(sentence, self.get_span(inst), prompt_type)
+
+
+class Ace05Task(TypingTask):
+    """Event detection on ACE 2005, any event subtype not contained in the label is an alternative."""
+
+    name = "ace05"
+    dataset_path = "datasets/ace05.json"
+    max_tokens = 600
+    span_tag = "t"
+
+    def get_types(self):
+        return get_ace05_type_info(self.insts)
+
+    def get_label(self, inst):
+        return inst["event_type"].lower()
+
+    def get_span(self, inst):
+        return inst["trigger"]["text"]
+
+    def get_start_idx(self, inst):
+        return inst["trigger"]["start"]
+
+    def get_end_idx(self, inst):
+        return inst["trigger"]["end"] - 1
+
+    def is_alternative(self, candidate_type, label):
+        return candidate_type not in label
+
+    def build_prompt(self, sentence, inst, prompt_type):
+        return event_detection(sentence, self.get_span(inst), prompt_type)
+
+
+TASK_ADAPTERS = {
+    "semeval": SemEvalTask,
+    "few_nerd": FewNerdTask,
+    "ace05": Ace05Task,
+}
+
+
+def get_task_adapter(task_name):
+    """Create the adapter of a task by its name."""
+    if task_name not in TASK_ADAPTERS:
+        raise ValueError("Please select task from semeval, few_nerd or ace05.")
+    return TASK_ADAPTERS[task_name]()
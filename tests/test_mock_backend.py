@@ -0,0 +1,66 @@
+import os
+import json
+
+import pytest
+
+import conceptnet_utils
+from store_cause_concepts import run_discovery
+
+
+EDGES = [("FormOf", "causes", "cause"), ("FormOf", "effects", "effect"),
+         ("RelatedTo", "cause", "fire"), ("RelatedTo", "cause", "rain"), ("RelatedTo", "cause", "smoke"),
+         ("RelatedTo", "effect", "result"), ("RelatedTo", "effect", "outcome"), ("RelatedTo", "fire", "smoke"),
+         ("Synonym", "result", "outcome")]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """A working directory with a small ConceptNet edge file, from which the index is built on first use."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(conceptnet_utils, "CONCEPTNET_INDEX", None)
+    for folder in ["conceptnet", "vocabulary", "datasets", "cause_concepts"]:
+        os.makedirs(folder)
+    with open("conceptnet/conceptnet_english.txt", "w", encoding="utf-8") as fp:
+        for relation, start, end in EDGES:
+            fp.write(f"/a/[/r/{relation}/,/c/en/{start}/,/c/en/{end}/]\t/r/{relation}\t/c/en/{start}\t/c/en/{end}\t{{}}\n")
+    words = sorted(set(word for _, start, end in EDGES for word in [start, end]))
+    with open("vocabulary/full_network.txt", "w", encoding="utf-8") as fp:
+        fp.write("\n".join(words) + "\n")
+    with open("conceptnet/concepts.txt", "w", encoding="utf-8") as fp:
+        fp.write("\n".join(words) + "\n")
+    return tmp_path
+
+
+def test_run_discovery_with_mock_backend(workdir):
+    run_discovery("mock", ["cause", "effect"], "cause_concepts/out.json", 0.1, 1.0, batch_size=8, device="cpu", backend="mock")
+
+    with open("cause_concepts/out.json", "r", encoding="utf-8") as fp:
+        cause_concepts_record = json.load(fp)
+    assert list(cause_concepts_record.keys()) == ["cause", "effect"]
+    assert set(cause_concepts_record["cause"]) <= {"fire", "rain", "smoke"}
+    assert sorted(cause_concepts_record["effect"]) == ["outcome", "result"]
+    assert not os.path.exists("cause_concepts/out_checkpoint.json")
+
+
+def test_evaluation_session_with_mock_backend(workdir):
+    pytest.importorskip("nltk")
+    from main import EvaluationSession
+
+    samples = list()
+    for idx, relation_type in enumerate(["Cause-Effect", "Effect-Cause", "Member-Collection", "Other"] * 3):
+        sentence = ["the", "storm", "caused", "a", "flood", "in", "town", str(idx)]
+        samples.append({"sentence": sentence,
+                        "head_entity": {"start_idx": 1, "end_idx": 1, "span": "storm"},
+                        "tail_entity": {"start_idx": 4, "end_idx": 4, "span": "flood"},
+                        "relation_type": relation_type})
+    with open("datasets/semeval.json", "w", encoding="utf-8") as fp:
+        json.dump(samples, fp)
+    causes = {"cause": ["fire", "rain"], "effect": ["result"], "member": ["team"], "collection": ["group"]}
+    with open("cause_concepts/semeval_mock.json", "w", encoding="utf-8") as fp:
+        json.dump(causes, fp)
+
+    EvaluationSession("mock", backend="mock").run([("semeval", "ic", "cause_concepts/semeval_mock.json")])
+
+    assert os.path.exists("evaluation_results/mock/semeval_naive_evaluation_ic.json")
+    assert os.path.exists("evaluation_results/mock/semeval_mock_ic.json")
+    assert not os.path.exists("evaluation_results/mock/semeval_mock_ic_log.jsonl")
@@ -0,0 +1,73 @@
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from inference_backends import OpenAIBackend
+
+
+class CompletionsHandler(BaseHTTPRequestHandler):
+    """Stub completions server, each request is refused once with 503 and answered with its choices shuffled."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompts = payload["prompt"]
+        with self.server.lock:
+            refused = tuple(prompts) not in self.server.seen_prompts
+            self.server.seen_prompts.add(tuple(prompts))
+            if refused:
+                self.server.num_refused += 1
+        if refused:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        time.sleep(random.random() / 20)
+        choices = [{"index": idx, "text": f" {prompt.upper()}"} for idx, prompt in enumerate(prompts)]
+        random.shuffle(choices)
+        body = json.dumps({"choices": choices}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def completions_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CompletionsHandler)
+    server.lock = threading.Lock()
+    server.seen_prompts = set()
+    server.num_refused = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_generate_keeps_prompt_order_and_retries_unavailable(completions_server):
+    base_url = f"http://127.0.0.1:{completions_server.server_address[1]}/v1"
+    backend = OpenAIBackend("stub", base_url=base_url, batch_size=3, concurrency=4, retry_backoff=0.01)
+    prompts = [f"prompt {idx}" for idx in range(20)]
+    options = [{"max_tokens": 4} if idx % 2 == 0 else {"max_tokens": 4, "stop": ["\n"]} for idx in range(20)]
+
+    texts = backend.generate(prompts, options)
+
+    assert texts == [f" PROMPT {idx}" for idx in range(20)]
+    # 10 prompts per option group in batches of 3 prompts, each batch refused once.
+    assert completions_server.num_refused == 8
+
+
+def test_run_sessions_without_manifests():
+    pytest.importorskip("nltk")
+    from main import run_sessions
+
+    assert run_sessions(list()) is None
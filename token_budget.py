@@ -0,0 +1,35 @@
+def round_up(length, multiple):
+    return (length + multiple - 1) // multiple * multiple
+
+
+def get_length_percentile(sorted_lengths, percentile):
+    """Get a percentile of sorted prompt lengths by the nearest rank."""
+    rank = max(1, round_up(len(sorted_lengths) * percentile, 100) // 100)
+    return sorted_lengths[min(rank, len(sorted_lengths)) - 1]
+
+
+def plan_token_budget(prompt_lengths, max_tokens, context_limit=None, prefill_prompts=16, block_size=16):
+    """Plan the context and scheduling limits of the engine from the token lengths of the prompts it will serve.
+       The context fits the longest prompt with max tokens generated after it, up to the context limit of the model,
+       and one scheduling step prefills about prefill prompts of the 95th percentile length.
+    """
+    sorted_lengths = sorted(prompt_lengths)
+    longest_length = sorted_lengths[-1]
+    if context_limit is not None and longest_length >= context_limit:
+        raise ValueError(f"Please shorten the prompts of up to {longest_length} tokens to fit the model context of {context_limit} tokens.")
+
+    max_model_len = round_up(longest_length + max_tokens, block_size)
+    if context_limit is not None:
+        max_model_len = min(max_model_len, context_limit)
+    p95_length = get_length_percentile(sorted_lengths, 95)
+    max_num_batched_tokens = max(max_model_len, round_up(p95_length * prefill_prompts, block_size))
+    return {"max_model_len": max_model_len,
+            "max_num_batched_tokens": max_num_batched_tokens,
+            "prompt_lengths": {"p50": get_length_percentile(sorted_lengths, 50),
+                               "p95": p95_length,
+                               "max": longest_length}}
+
+
+def order_by_length(prompt_lengths, bucket_size=32):
+    """Order prompt indexes into buckets of similar length, longest bucket first and the original order within a bucket."""
+    return sorted(range(len(prompt_lengths)), key=lambda idx: -(prompt_lengths[idx] // bucket_size))